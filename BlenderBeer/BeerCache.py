@@ -0,0 +1,78 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+import hashlib
+from collections import OrderedDict
+from .BeerLexer import classify_tokens
+from . import BeerProfile
+
+
+def hash_source(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TokenCache():
+    """
+    In-memory LRU cache of classified layer tokens.
+    Entries are keyed by (source path, content hash, tokenizer) and never by layer index,
+    so the cached tokens stay valid when a layer is moved in the stack.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def read_source(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def get_source_hash(self, path):
+        with BeerProfile.stage("read_source"):
+            return hash_source(self.read_source(path))
+
+    def get_tokens(self, path, tokenizer):
+        """ Return (content hash, classified tokens) for the shader at path. """
+        with BeerProfile.stage("read_source"):
+            text = self.read_source(path)
+            source_hash = hash_source(text)
+        BeerProfile.count("bytes", len(text.encode('utf-8')))
+
+        key = (path, source_hash, tokenizer)
+        tokens = self.entries.get(key)
+        if tokens is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            BeerProfile.count("tokens", len(tokens))
+            BeerProfile.set_value("cached", True)
+            return source_hash, tokens
+
+        self.misses += 1
+        with BeerProfile.stage("lex"):
+            raw_tokens = list(tokenizer(text))
+        with BeerProfile.stage("classify"):
+            tokens = tuple(classify_tokens(raw_tokens))
+        BeerProfile.count("tokens", len(tokens))
+        BeerProfile.set_value("cached", False)
+
+        self.entries[key] = tokens
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return source_hash, tokens
+
+    def stats(self):
+        return {
+            "entries" : len(self.entries),
+            "max_entries" : self.max_entries,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
@@ -0,0 +1,1103 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# The BEER shader compiler. It only reads plain LayerSpec and StackSpec objects,
+# so it runs without Blender, and from the command line:
+#   python -m BlenderBeer.BeerCompiler stacks/*.json -o generated -j 8
+
+import io
+import os
+import sys
+import json
+import hashlib
+import time
+import threading
+from enum import Enum
+from dataclasses import dataclass, field, fields, asdict
+from .BeerCache import TokenCache
+from .BeerLexer import tokenize, tokenize_pygments
+from . import BeerProfile
+from . import BeerInclude
+from .BeerGraph import prune_layers, can_hide, OutputPlan
+from .BeerTree import get_layer_tree
+from .BeerDedup import SharedFunctions
+from .BeerInclude import StackIncludes
+from .BeerUniforms import BLOCK_MODES, StackBlocks, get_baked_uniforms
+from .BeerOpacity import get_layer_alpha, source_alpha
+from .BeerStore import DeferredStore, write_if_changed
+
+token_cache = TokenCache()
+
+#Layers are lexed with the built-in GLSL tokenizer unless pygments is explicitly requested
+use_pygments = False
+
+#Generated code of each layer and the last compile report, keyed by the caller, a BeerMaterial pointer in Blender
+layer_code_cache = {}
+compile_reports = {}
+#Byte layout of the uniform blocks of the last compile, for callers that compile with uniform blocks
+uniform_layouts = {}
+
+#The caches above and the token caches are shared by every compile, one compile runs at a time
+compile_lock = threading.Lock()
+
+
+#Store of the worker processes of compile_batch
+batch_store = None
+
+#Part of every stack key, bump it when a change to the compiler changes the generated source
+STACK_KEY_VERSION = 5
+
+
+class CompileCancelled(Exception):
+    pass
+
+
+class Blends(Enum):
+    DEFAULT = 1
+    ADD = 2
+    SUBTRACT = 3
+    MULTIPLY = 4
+    DIVIDE = 5
+    SCREEN = 6
+    OVERLAY = 7
+    DIFFERENCE = 8
+    LIGHTEN = 9 
+    DARKEN = 10
+    DODGE = 11
+    BURN = 12
+
+
+@dataclass
+class LayerSpec():
+    """ The fields of a BeerLayer the compiler reads. """
+    index : int
+    source_path : str
+    solo_layer : bool = False
+    mute_layer : bool = False
+    masked_layer : bool = False
+    masking_index : int = 0
+    input_index : int = 0
+    blend : str = "DEFAULT"
+    #Whether the layer is opaque with its current parameters, None to use the uniform defaults of its source.
+    #Only trusted for layers BeerOpacity proves opaque for some uniform values.
+    opaque : bool = None
+    #Parameter values to compile in as constants, by uniform name, None to keep every uniform live
+    baked : dict = None
+
+    @classmethod
+    def from_layer(cls, layer):
+        return cls(
+            index=layer.index,
+            source_path=layer.material.malt.get_source_path(),
+            solo_layer=layer.solo_layer,
+            mute_layer=layer.mute_layer,
+            masked_layer=layer.masked_layer,
+            masking_index=layer.masking_index,
+            input_index=layer.input_index,
+            blend=layer.blend,
+            )
+
+    @classmethod
+    def from_dict(cls, data, base_dir=None):
+        unknown = set(data) - set(spec_field.name for spec_field in fields(cls))
+        if unknown:
+            raise ValueError("Unknown layer fields: " + ", ".join(sorted(unknown)))
+        spec = cls(**data)
+        if base_dir and not os.path.isabs(spec.source_path):
+            spec.source_path = os.path.join(base_dir, spec.source_path)
+        return spec
+
+    def as_dict(self):
+        return asdict(self)
+
+
+@dataclass
+class StackSpec():
+    """ A named layer stack, the input of a headless compile. """
+    name : str
+    layers : list = field(default_factory=list)
+    output_path : str = None
+    uniform_blocks : str = "NONE"
+    mask_early_out : bool = False
+
+    @classmethod
+    def from_layers(cls, name, layers):
+        return cls(name, [LayerSpec.from_layer(layer) for layer in layers])
+
+    @classmethod
+    def from_dict(cls, data, base_dir=None):
+        output_path = data.get("output_path")
+        if output_path and base_dir and not os.path.isabs(output_path):
+            output_path = os.path.join(base_dir, output_path)
+        layers = [LayerSpec.from_dict(layer, base_dir) for layer in data.get("layers", [])]
+        return cls(data["name"], layers, output_path, data.get("uniform_blocks", "NONE"), data.get("mask_early_out", False))
+
+    @classmethod
+    def load(cls, path):
+        """ The stacks of a JSON file holding a single stack or a list of them. """
+        with open(path) as f:
+            data = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        if isinstance(data, dict):
+            data = [data]
+        return [cls.from_dict(stack, base_dir) for stack in data]
+
+    def as_dict(self):
+        data = {"name" : self.name, "layers" : [layer.as_dict() for layer in self.layers]}
+        if self.output_path:
+            data["output_path"] = self.output_path
+        if self.uniform_blocks != "NONE":
+            data["uniform_blocks"] = self.uniform_blocks
+        if self.mask_early_out:
+            data["mask_early_out"] = True
+        return data
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+    def validate(self):
+        """ The problems that would make the stack fail to compile, or compile to broken GLSL. """
+        problems = []
+        if self.uniform_blocks not in BLOCK_MODES:
+            problems.append("unknown uniform block mode " + str(self.uniform_blocks))
+        indices = [layer.index for layer in self.layers]
+        for layer in self.layers:
+            name = "layer {}".format(layer.index)
+            if layer.index < 1 or indices.count(layer.index) > 1:
+                problems.append(name + ": index must be unique and greater than 0")
+            if layer.blend not in Blends.__members__:
+                problems.append(name + ": unknown blend mode " + str(layer.blend))
+            if layer.input_index >= layer.index or (layer.input_index and layer.input_index not in indices):
+                problems.append(name + ": input_index must name an earlier layer")
+            if layer.masked_layer and (layer.masking_index >= layer.index
+                or (layer.masking_index and layer.masking_index not in indices)):
+                problems.append(name + ": masking_index must name an earlier layer")
+            if not layer.source_path.endswith('.mesh.glsl'):
+                problems.append(name + ": source is not a .mesh.glsl file")
+            elif not os.path.isfile(layer.source_path):
+                problems.append(name + ": source not found " + layer.source_path)
+        return problems
+
+
+def get_prefix(index):
+    return "beergen" + str(index)
+
+def get_blend(blend):
+    if blend is Blends.DEFAULT:
+        return "blend_default"
+    if blend is Blends.ADD:
+        return "blend_add"
+    elif blend is Blends.SUBTRACT:
+        return "blend_subtract"
+    elif blend is Blends.MULTIPLY:
+        return "blend_multiply"
+    elif blend is Blends.DIVIDE:
+        return "blend_divide"
+    elif blend is Blends.SCREEN:
+        return "blend_screen"
+    elif blend is Blends.OVERLAY:
+        return "blend_overlay"
+    elif blend is Blends.DIFFERENCE:
+        return "blend_difference"
+    elif blend is Blends.LIGHTEN:
+        return "blend_lighten"
+    elif blend is Blends.DARKEN:
+        return "blend_darken"
+    elif blend is Blends.DODGE:
+        return "blend_dodge"
+    elif blend is Blends.BURN:
+        return "blend_burn"
+
+#using mix functions from blender/source/blender/gpu/shaders/material/gpu_shader_material_mix_rgb.glsl    
+def get_blend_source(blend):
+    if blend is Blends.DEFAULT:
+        return '''
+void blend_default(inout PixelOutput base, in PixelOutput blending){
+    base.line_color = alpha_blend(base.color, blending.line_color);
+    base.line_width = blending.line_width;
+    base.color = alpha_blend(base.color, blending.color);
+}
+        '''
+    elif blend is Blends.ADD:
+        return '''
+void mix_add(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    outcol = mix(col1, col1 + col2, fac);
+    outcol.a = col1.a;
+    }
+
+void blend_add(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_add(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_add(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.SUBTRACT:
+        return '''
+void mix_sub(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+  fac = clamp(fac, 0.0, 1.0);
+  outcol = mix(col1, col1 - col2, fac);
+  outcol.a = col1.a;
+}
+
+void blend_subtract(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_sub(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_sub(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.MULTIPLY:
+        return '''
+void mix_mult(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+  fac = clamp(fac, 0.0, 1.0);
+  outcol = mix(col1, col1 * col2, fac);
+  outcol.a = col1.a;
+}
+
+void blend_multiply(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_mult(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_mult(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.DIVIDE:
+        return '''
+void mix_div(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    float facm = 1.0 - fac;
+
+    outcol = col1;
+
+    if (col2.r != 0.0) {
+        outcol.r = facm * outcol.r + fac * outcol.r / col2.r;
+    }
+    if (col2.g != 0.0) {
+        outcol.g = facm * outcol.g + fac * outcol.g / col2.g;
+    }
+    if (col2.b != 0.0) {
+        outcol.b = facm * outcol.b + fac * outcol.b / col2.b;
+    }
+}
+
+void blend_divide(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_div(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_div(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.SCREEN:
+        return '''
+void mix_screen(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+  fac = clamp(fac, 0.0, 1.0);
+  float facm = 1.0 - fac;
+
+  outcol = vec4(1.0) - (vec4(facm) + fac * (vec4(1.0) - col2)) * (vec4(1.0) - col1);
+  outcol.a = col1.a;
+}
+
+void blend_screen(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_screen(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_screen(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.OVERLAY:
+        return '''
+void mix_overlay(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    float facm = 1.0 - fac;
+
+    outcol = col1;
+
+    if (outcol.r < 0.5) {
+        outcol.r *= facm + 2.0 * fac * col2.r;
+    }
+    else {
+        outcol.r = 1.0 - (facm + 2.0 * fac * (1.0 - col2.r)) * (1.0 - outcol.r);
+    }
+
+    if (outcol.g < 0.5) {
+        outcol.g *= facm + 2.0 * fac * col2.g;
+    }
+    else {
+        outcol.g = 1.0 - (facm + 2.0 * fac * (1.0 - col2.g)) * (1.0 - outcol.g);
+    }
+
+    if (outcol.b < 0.5) {
+        outcol.b *= facm + 2.0 * fac * col2.b;
+    }
+    else {
+        outcol.b = 1.0 - (facm + 2.0 * fac * (1.0 - col2.b)) * (1.0 - outcol.b);
+    }
+    }
+
+void blend_overlay(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_overlay(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_overlay(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.DIFFERENCE:
+        return '''
+void mix_diff(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    outcol = mix(col1, abs(col1 - col2), fac);
+    outcol.a = col1.a;
+}
+
+void blend_difference(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_diff(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_diff(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.LIGHTEN:
+        return '''
+void mix_light(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    outcol.rgb = mix(col1.rgb, max(col1.rgb, col2.rgb), fac);
+    outcol.a = col1.a;
+}
+
+void blend_lighten(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_light(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_light(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.DARKEN:
+        return '''
+void mix_dark(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    outcol.rgb = mix(col1.rgb, min(col1.rgb, col2.rgb), fac);
+    outcol.a = col1.a;
+}
+
+void blend_darken(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_dark(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_dark(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.DODGE:
+        return '''
+void mix_dodge(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    outcol = col1;
+
+    if (outcol.r != 0.0) {
+        float tmp = 1.0 - fac * col2.r;
+        if (tmp <= 0.0) {
+        outcol.r = 1.0;
+        }
+        else if ((tmp = outcol.r / tmp) > 1.0) {
+        outcol.r = 1.0;
+        }
+        else {
+        outcol.r = tmp;
+        }
+    }
+    if (outcol.g != 0.0) {
+        float tmp = 1.0 - fac * col2.g;
+        if (tmp <= 0.0) {
+        outcol.g = 1.0;
+        }
+        else if ((tmp = outcol.g / tmp) > 1.0) {
+        outcol.g = 1.0;
+        }
+        else {
+        outcol.g = tmp;
+        }
+    }
+    if (outcol.b != 0.0) {
+        float tmp = 1.0 - fac * col2.b;
+        if (tmp <= 0.0) {
+        outcol.b = 1.0;
+        }
+        else if ((tmp = outcol.b / tmp) > 1.0) {
+        outcol.b = 1.0;
+        }
+        else {
+        outcol.b = tmp;
+        }
+    }
+}
+
+void blend_dodge(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_dodge(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_dodge(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+    elif blend is Blends.BURN:
+        return '''
+void mix_burn(float fac, vec4 col1, vec4 col2, out vec4 outcol){
+    fac = clamp(fac, 0.0, 1.0);
+    float tmp, facm = 1.0 - fac;
+
+    outcol = col1;
+
+    tmp = facm + fac * col2.r;
+    if (tmp <= 0.0) {
+        outcol.r = 0.0;
+    }
+    else if ((tmp = (1.0 - (1.0 - outcol.r) / tmp)) < 0.0) {
+        outcol.r = 0.0;
+    }
+    else if (tmp > 1.0) {
+        outcol.r = 1.0;
+    }
+    else {
+        outcol.r = tmp;
+    }
+
+    tmp = facm + fac * col2.g;
+    if (tmp <= 0.0) {
+        outcol.g = 0.0;
+    }
+    else if ((tmp = (1.0 - (1.0 - outcol.g) / tmp)) < 0.0) {
+        outcol.g = 0.0;
+    }
+    else if (tmp > 1.0) {
+        outcol.g = 1.0;
+    }
+    else {
+        outcol.g = tmp;
+    }
+
+    tmp = facm + fac * col2.b;
+    if (tmp <= 0.0) {
+        outcol.b = 0.0;
+    }
+    else if ((tmp = (1.0 - (1.0 - outcol.b) / tmp)) < 0.0) {
+        outcol.b = 0.0;
+    }
+    else if (tmp > 1.0) {
+        outcol.b = 1.0;
+    }
+    else {
+        outcol.b = tmp;
+    }
+}
+
+void blend_burn(inout PixelOutput base, in PixelOutput blending){
+    base.line_width = blending.line_width;
+    mix_burn(blending.line_color.a, base.color, blending.line_color, base.line_color);
+
+    mix_burn(blending.color.a, base.color, blending.color, base.color);
+}
+        '''
+
+def get_layer_tokens(layer):
+    source = layer.source_path
+    if use_pygments:
+        return token_cache.get_tokens(source, tokenize_pygments)
+    return token_cache.get_tokens(source, tokenize)
+
+def get_stack_tokens(layers):
+    stack_tokens = []
+    for layer in layers:
+        with BeerProfile.layer(layer.index, layer.source_path):
+            stack_tokens.append(get_layer_tokens(layer))
+    return stack_tokens
+
+def get_shared_functions(stack_tokens):
+    with BeerProfile.stage("parse"):
+        stack_trees = [get_layer_tree(tokens) for source_hash, tokens in stack_tokens]
+    with BeerProfile.stage("deduplicate"):
+        return SharedFunctions(stack_trees)
+
+def get_stack_includes(layers, shared_functions):
+    with BeerProfile.stage("includes"):
+        source_paths = [layer.source_path for layer in layers]
+        return StackIncludes(shared_functions.stack_functions, source_paths)
+
+def get_stack_baked(layers, shared_functions):
+    """ The const declarations replacing the baked uniforms of each layer. """
+    return [get_baked_uniforms(layer_functions, layer.baked, get_prefix(layer.index)) if layer.baked else {}
+        for layer, layer_functions in zip(layers, shared_functions.stack_functions)]
+
+def get_baked_names(layers, baked):
+    """ Names of the baked uniforms of each layer that has some, for the compile report. """
+    return {layer.index : sorted(declaration.name for declaration in layer_baked)
+        for layer, layer_baked in zip(layers, baked) if layer_baked}
+
+def get_stack_blocks(layers, shared_functions, uniform_blocks, baked=None):
+    if uniform_blocks == "NONE":
+        return None
+    prefixes = [get_prefix(layer.index) for layer in layers]
+    return StackBlocks(shared_functions.stack_functions, prefixes, uniform_blocks, baked)
+
+def get_uniform_layout(layers, uniform_blocks):
+    """ Layout of the uniform blocks of the live layers, from the cached layer tokens. """
+    if uniform_blocks == "NONE":
+        return None
+    shared_functions = get_shared_functions(get_stack_tokens(layers))
+    baked = get_stack_baked(layers, shared_functions)
+    return get_stack_blocks(layers, shared_functions, uniform_blocks, baked).get_layout()
+
+def get_layer_state(layer, source_hash, shared_signature=(), uniform_blocks="NONE"):
+    return (
+        layer.source_path,
+        source_hash,
+        layer.index,
+        layer.solo_layer,
+        layer.mute_layer,
+        layer.masked_layer,
+        layer.masking_index,
+        layer.input_index,
+        layer.blend,
+        shared_signature,
+        uniform_blocks,
+        json.dumps(layer.baked, sort_keys=True) if layer.baked else None,
+        )
+
+def compile_single_layer(layer, shared_functions, position=0, blocks=None, baked=None):
+    index = layer.index
+    solo_layer = layer.solo_layer
+    mute_layer = layer.mute_layer
+    masked_layer = layer.masked_layer
+    masking_index = layer.masking_index
+    input_index = layer.input_index
+    blend_mode =  layer.blend
+
+    compiled_source = io.StringIO()
+    documentation = (
+        "\n" + "/*"
+        + "\n" + "LAYER INFO = ["
+        + "\n" + "layer:" + str(index)
+        + "\n" + "solo:" + str(solo_layer)
+        + "\n" + "mute:" + str(mute_layer)
+        + "\n" + "masked:" + str(masked_layer)
+        + "\n" + "m_index:" + str(masking_index)
+        + "\n" + "i_index:" + str(input_index)
+         + "\n" + "blend_mode:" + str(blend_mode)
+        + "\n" + "]"
+        + "\n" + "*/" + "\n"
+        )
+
+    compiled_source.write(documentation)
+    packed = frozenset()
+    if blocks is not None:
+        compiled_source.write(blocks.get_layer_source(position))
+        packed = blocks.get_packed(position)
+    with BeerProfile.stage("rename"):
+        shared_functions.write_layer(position, get_prefix(index), compiled_source, packed, baked)
+    return compiled_source.getvalue()
+
+def compile_layer_source(layers, uniform_blocks="NONE"):
+    compiled_source = []
+    stack_tokens = get_stack_tokens(layers)
+    shared_functions = get_shared_functions(stack_tokens)
+    includes = get_stack_includes(layers, shared_functions)
+    baked = get_stack_baked(layers, shared_functions)
+    blocks = get_stack_blocks(layers, shared_functions, uniform_blocks, baked)
+    compiled_source.append(includes.get_header())
+    if blocks is not None:
+        compiled_source.append(blocks.get_header())
+    for position, layer in enumerate(layers):
+        with BeerProfile.layer(layer.index, layer.source_path):
+            compiled_source.append(compile_single_layer(layer, shared_functions, position, blocks, baked[position]))
+    return compiled_source
+
+
+def get_output_name(location):
+    """ GLSL expression of a layer output location of an OutputPlan. """
+    kind, value = location
+    if kind == "PO":
+        return "PO"
+    if kind == "SLOT":
+        return "beergen_slot" + str(value)
+    if kind == "MASK":
+        return get_prefix(value) + "_mask"
+    #Not computed before its reader, left for the GLSL compiler to report
+    return get_prefix(value) + "_layer"
+
+def get_mask_name(location):
+    if location[0] == "MASK":
+        return get_output_name(location)
+    return get_output_name(location) + ".g"
+
+def compile_function_source(layers, plan=None, mask_early_out=False, opaque=frozenset()):
+    """
+    The COMMON_PIXEL_SHADER calling every layer and blending them into PO.
+    With mask_early_out, the layers the plan allows to are only shaded where their mask is not zero.
+    """
+    compiled_util = []
+    compiled_function = []
+    used_blendmodes = []
+    if plan is None:
+        plan = OutputPlan(layers, mask_early_out, opaque)
+
+    compiled_function.append("""
+        void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)\n
+        {\n
+        """)
+
+    with BeerProfile.stage("compose"):
+        if plan.saved_input is not None:
+            if plan.saved_input[0] == "MASK":
+                compiled_function.append("float " + get_output_name(plan.saved_input) + " = PO.g;" + "\n")
+            else:
+                compiled_function.append("PixelOutput " + get_output_name(plan.saved_input) + " = PO;" + "\n")
+
+        for layer, slot, declare, input_location, mask_location, keep_mask, early_out in plan.steps:
+            index = layer.index
+            solo_layer = layer.solo_layer
+            blend_mode = Blends[layer.blend]
+            output = get_output_name(("SLOT", slot))
+
+            blending = index in plan.blending
+            if blending and not solo_layer and blend_mode not in used_blendmodes:
+                used_blendmodes.append(blend_mode)
+
+            if declare:
+                compiled_function.append("PixelOutput " + output + " = " + get_output_name(input_location) + ";" + "\n")
+            elif input_location is not None:
+                compiled_function.append(output + " = " + get_output_name(input_location) + ";" + "\n")
+            if early_out:
+                compiled_function.append("if (" + get_mask_name(mask_location) + " != 0.0) {" + "\n")
+            compiled_function.append(get_prefix(index) + "_" + "COMMON_PIXEL_SHADER(S, " + output + ");" + "\n")
+            if mask_location is not None:
+                compiled_function.append(output + ".color *= " + get_mask_name(mask_location) + ";" + "\n")
+            if early_out:
+                #A zero mask zeroes the color, whatever the layer computes
+                compiled_function.append("} else {" + "\n")
+                compiled_function.append(output + ".color = vec4(0.0);" + "\n")
+                compiled_function.append("}" + "\n")
+            if blending:
+                if solo_layer:
+                    compiled_function.append("PO = " + output + ";" + "\n")
+                else:
+                    compiled_function.append(get_blend(blend_mode) + "(PO, " + output + ");" + "\n")
+            if keep_mask:
+                compiled_function.append("float " + get_prefix(index) + "_mask = " + output + ".g;" + "\n")
+
+    compiled_function.append("""
+        }\n
+        
+        """)
+
+    with BeerProfile.stage("blend_library"):
+        for used_blend in used_blendmodes:
+            compiled_util.append(get_blend_source(used_blend))
+
+    return compiled_util + compiled_function
+
+def get_source_alpha(source_path):
+    """ LayerAlpha of a layer source, also kept in source_alpha for BeerSync. Raises OSError when it can't be read. """
+    source_hash, tokens = get_layer_tokens(LayerSpec(0, source_path))
+    alpha = source_alpha[source_path] = get_layer_alpha(tokens)
+    return alpha
+
+def get_opaque_layers(layers):
+    """ Indices of the layers that hide the layers blended before them, as they always output alpha 1. """
+    opaque = set()
+    for layer in layers:
+        if not can_hide(layer):
+            continue
+        try:
+            alpha = get_source_alpha(layer.source_path)
+        except OSError:
+            continue
+        if alpha is not None and (alpha.is_opaque() if layer.opaque is None else layer.opaque):
+            opaque.add(layer.index)
+    return frozenset(opaque)
+
+def get_live_layers(layers):
+    """ The layers to compile, the indices of the pruned ones and of the opaque ones. """
+    opaque = get_opaque_layers(layers)
+    live_layers, pruned = prune_layers(layers, opaque)
+    return live_layers, pruned, opaque
+
+def compile_full_source(layers, uniform_blocks="NONE", mask_early_out=False):
+    live_layers, pruned, opaque = get_live_layers(layers)
+    layer_source = compile_layer_source(live_layers, uniform_blocks)
+    function_source = compile_function_source(live_layers, mask_early_out=mask_early_out, opaque=opaque)
+    return layer_source + function_source
+
+
+def get_stack_key(layers, uniform_blocks="NONE", mask_early_out=False, opaque=frozenset()):
+    """ Hash of everything the generated source depends on: the live layers, their sources and the include paths. """
+    description = [STACK_KEY_VERSION, use_pygments, BeerInclude.get_search_paths(), uniform_blocks, mask_early_out,
+        sorted(opaque)]
+    for layer in layers:
+        layer_description = layer.as_dict()
+        #The verdict is in the opaque indices already
+        del layer_description["opaque"]
+        layer_description["source_path"] = os.path.dirname(layer.source_path)
+        layer_description["source_hash"] = token_cache.get_source_hash(layer.source_path)
+        description.append(layer_description)
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+def compile_incremental(key, layers, cancelled=None, store=None, uniform_blocks="NONE", mask_early_out=False):
+    """
+    Compile the layer stack, regenerating only the layers whose state changed since the last compile under key.
+    cancelled is polled between layers, the compile raises CompileCancelled once it returns True.
+    With a ShaderStore, a stack compiled before is read back from the store instead.
+    uniform_blocks is one of BLOCK_MODES, the layout of the blocks is kept in uniform_layouts.
+    mask_early_out skips the shader of masked layers where their mask is zero.
+    The baked values of a layer are part of its state and of the stack key, so a stack compiled before with the
+    same values, baked or live, is reused.
+    """
+    with compile_lock:
+        start_time = time.perf_counter()
+        previous_code = layer_code_cache.get(key, {})
+        layer_code = {}
+        rebuilt = []
+        reused = []
+        rebuild_time = 0.0
+        live_layers, pruned, opaque = get_live_layers(layers)
+
+        stack_key = None
+        if store is not None:
+            stack_key = get_stack_key(live_layers, uniform_blocks, mask_early_out, opaque)
+            stored_source = store.read(stack_key)
+            if stored_source is not None:
+                set_uniform_layout(key, get_uniform_layout(live_layers, uniform_blocks))
+                baked_names = {}
+                if any(layer.baked for layer in live_layers):
+                    shared_functions = get_shared_functions(get_stack_tokens(live_layers))
+                    baked_names = get_baked_names(live_layers, get_stack_baked(live_layers, shared_functions))
+                compile_reports[key] = {
+                    "rebuilt" : [],
+                    "reused" : [layer.index for layer in live_layers],
+                    "pruned" : pruned,
+                    "rebuild_time" : 0.0,
+                    "total_time" : time.perf_counter() - start_time,
+                    "stored" : True,
+                    "peak_live_outputs" : OutputPlan(live_layers, mask_early_out, opaque).get_peak_live_outputs(),
+                    "opaque" : sorted(opaque),
+                    "baked" : baked_names,
+                }
+                return stored_source
+
+        stack_tokens = get_stack_tokens(live_layers)
+        shared_functions = get_shared_functions(stack_tokens)
+        includes = get_stack_includes(live_layers, shared_functions)
+        baked = get_stack_baked(live_layers, shared_functions)
+        blocks = get_stack_blocks(live_layers, shared_functions, uniform_blocks, baked)
+        compiled_source = [includes.get_header()]
+        if blocks is not None:
+            compiled_source.append(blocks.get_header())
+        set_uniform_layout(key, blocks.get_layout() if blocks is not None else None)
+        for position, layer in enumerate(live_layers):
+            if cancelled is not None and cancelled():
+                raise CompileCancelled()
+            with BeerProfile.layer(layer.index, layer.source_path):
+                source_hash, filtered_tokens = stack_tokens[position]
+                state = get_layer_state(layer, source_hash,
+                    shared_functions.get_layer_signature(position), uniform_blocks)
+                code = previous_code.get(state)
+                if code is None:
+                    layer_start = time.perf_counter()
+                    code = compile_single_layer(layer, shared_functions, position, blocks, baked[position])
+                    rebuild_time += time.perf_counter() - layer_start
+                    rebuilt.append(layer.index)
+                    BeerProfile.set_value("rebuilt", True)
+                else:
+                    reused.append(layer.index)
+                    BeerProfile.set_value("rebuilt", False)
+                layer_code[state] = code
+                compiled_source.append(code)
+        layer_code_cache[key] = layer_code
+
+        plan = OutputPlan(live_layers, mask_early_out, opaque)
+        compiled_source += compile_function_source(live_layers, plan)
+        compiled_source = "".join(compiled_source)
+        if store is not None:
+            store.put(compiled_source, stack_key)
+
+        compile_reports[key] = {
+            "rebuilt" : rebuilt,
+            "reused" : reused,
+            "pruned" : pruned,
+            "rebuild_time" : rebuild_time,
+            "total_time" : time.perf_counter() - start_time,
+            "stored" : False,
+            "peak_live_outputs" : plan.get_peak_live_outputs(),
+            "opaque" : sorted(opaque),
+            "baked" : get_baked_names(live_layers, baked),
+        }
+        return compiled_source
+
+def set_uniform_layout(key, layout):
+    if layout is None:
+        uniform_layouts.pop(key, None)
+    else:
+        uniform_layouts[key] = layout
+
+def compile_stack(stack):
+    return "".join(compile_full_source(stack.layers, stack.uniform_blocks, stack.mask_early_out))
+
+
+def get_output_path(stack, output_dir):
+    if stack.output_path:
+        return stack.output_path
+    return os.path.join(output_dir, stack.name + ".mesh.glsl")
+
+def get_layout_path(output_path):
+    """ The uniform block layout is written next to the shader, as name.layout.json """
+    if output_path.endswith(".mesh.glsl"):
+        output_path = output_path[:-len(".mesh.glsl")]
+    return output_path + ".layout.json"
+
+def init_worker(include_paths, pygments):
+    global use_pygments
+    BeerInclude.include_paths[:] = include_paths
+    use_pygments = pygments
+
+def compile_job(job):
+    """ Validate, compile and write one stack. Runs in the worker processes. """
+    stack, output_dir, check, cost = job
+    result = {"name" : stack.name, "output" : None, "bytes" : 0, "time" : 0.0, "cost" : None, "peak_live_outputs" : 0}
+    start = time.perf_counter()
+    result["errors"] = stack.validate()
+    if not result["errors"]:
+        try:
+            source = compile_stack(stack)
+            result["bytes"] = len(source)
+            live_layers, pruned, opaque = get_live_layers(stack.layers)
+            result["peak_live_outputs"] = OutputPlan(live_layers, opaque=opaque).get_peak_live_outputs()
+            if cost:
+                from .BeerCost import StackCost
+                result["cost"] = StackCost(source).as_dict()
+            if not check:
+                result["output"] = get_output_path(stack, output_dir)
+                output_dir = os.path.dirname(result["output"])
+                if output_dir:
+                    os.makedirs(output_dir, exist_ok=True)
+                #Unchanged files keep their mtime, so Malt and build tools don't reload them
+                write_if_changed(result["output"], source)
+                if stack.uniform_blocks != "NONE":
+                    layout = get_uniform_layout(live_layers, stack.uniform_blocks)
+                    write_if_changed(get_layout_path(result["output"]), json.dumps(layout, indent=1))
+        except Exception as error:
+            result["errors"].append("{}: {}".format(type(error).__name__, error))
+    result["time"] = time.perf_counter() - start
+    return result
+
+def find_spec_files(paths):
+    spec_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirs, files in os.walk(path):
+                subdirs.sort()
+                spec_files += [os.path.join(directory, name) for name in sorted(files) if name.endswith('.json')]
+        else:
+            spec_files.append(path)
+    return spec_files
+
+def compile_stacks(stacks, output_dir=".", jobs=None, check=False, include_paths=(), pygments=False, cost=False):
+    """ Compile stacks in a process pool, yielding the result of each one in order. """
+    jobs = jobs or os.cpu_count() or 1
+    work = [(stack, output_dir, check, cost) for stack in stacks]
+    if jobs == 1 or len(work) == 1:
+        init_worker(list(include_paths), pygments)
+        for job in work:
+            yield compile_job(job)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    #Large chunks keep the stacks sharing a layer on the same worker token cache
+    chunksize = max(1, len(work) // (jobs * 4))
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(list(include_paths), pygments)) as pool:
+        for result in pool.map(compile_job, work, chunksize=chunksize):
+            yield result
+
+
+def get_source_groups(stacks):
+    """ Positions of the stacks, grouped so that stacks sharing a layer source are in the same group, largest first. """
+    groups = []
+    for position, stack in enumerate(stacks):
+        sources = set(layer.source_path for layer in stack.layers)
+        positions = [position]
+        for group in [group for group in groups if group[0] & sources]:
+            groups.remove(group)
+            sources |= group[0]
+            positions += group[1]
+        groups.append((sources, positions))
+    return sorted((sorted(positions) for sources, positions in groups), key=len, reverse=True)
+
+def split_source_groups(groups, stacks, count):
+    """
+    The positions of the groups, cut into at most count chunks of about as many layers.
+    Groups are only split when they hold more than a chunk, and their stacks stay next to each other,
+    so a source shared by a large group is lexed once by each worker compiling a part of it.
+    """
+    sizes = [max(1, len(stack.layers)) for stack in stacks]
+    share = max(1, -(-sum(sizes) // count))
+    chunks = []
+    chunk = []
+    size = 0
+    for group in groups:
+        for position in group:
+            chunk.append(position)
+            size += sizes[position]
+            if size >= share:
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def init_batch_worker(include_paths, default_include_paths, pygments, store_directory):
+    global batch_store
+    init_worker(include_paths, pygments)
+    BeerInclude.set_default_include_paths(default_include_paths)
+    batch_store = DeferredStore(store_directory) if store_directory else None
+
+def compile_batch_group(group, store=None):
+    """
+    Compile the (key, stack, previous layer code) of a group one after the other, so the stacks share the
+    token cache and the layer trees. Returns a result for each stack, with the state a compile leaves behind.
+    """
+    results = []
+    for key, stack, previous_code in group:
+        result = {"key" : key, "name" : stack.name, "source" : None, "error" : None}
+        if previous_code is not None:
+            layer_code_cache[key] = previous_code
+        with BeerProfile.record_compile(stack.name) as record:
+            try:
+                result["source"] = compile_incremental(key, stack.layers, store=store,
+                    uniform_blocks=stack.uniform_blocks, mask_early_out=stack.mask_early_out)
+            except Exception as error:
+                result["error"] = "{}: {}".format(type(error).__name__, error)
+        result["time"] = record.total_time
+        result["record"] = record
+        if result["source"] is not None:
+            result["layer_code"] = layer_code_cache.get(key)
+            result["report"] = compile_reports.get(key)
+            result["layout"] = uniform_layouts.get(key)
+            result["alpha"] = {layer.source_path : source_alpha[layer.source_path]
+                for layer in stack.layers if layer.source_path in source_alpha}
+        results.append(result)
+    return results
+
+def compile_batch_job(group):
+    """ Compile a group in a worker process. Returns its results and the store writes left to the caller. """
+    results = compile_batch_group(group, batch_store)
+    writes = []
+    if batch_store is not None:
+        writes, batch_store.pending = batch_store.pending, []
+    return results, writes
+
+def merge_batch_result(result):
+    """ Keep the state a worker process compiled a stack to, as if the stack was compiled here. """
+    BeerProfile.add_record(result["record"])
+    if result["source"] is None:
+        return
+    key = result["key"]
+    with compile_lock:
+        #Stacks read back from the store leave no layer code behind
+        if result["layer_code"] is not None:
+            layer_code_cache[key] = result["layer_code"]
+        compile_reports[key] = result["report"]
+        set_uniform_layout(key, result["layout"])
+        source_alpha.update(result["alpha"])
+
+def compile_batch(requests, jobs=None, store=None):
+    """
+    Compile several stacks, each request a (key, StackSpec) pair, the key as in compile_incremental.
+    Returns a result for each request, in order, holding the source or the error and the compile time.
+    Stacks sharing a layer source are compiled one after the other, so the source is lexed once.
+    With more than one job the stacks are split in chunks of about as many layers, large groups of
+    stacks sharing a source included, and compiled in worker processes. Their compile state and store
+    writes are merged back into this process before returning.
+    """
+    stacks = [stack for key, stack in requests]
+    groups = get_source_groups(stacks)
+    jobs = min(jobs or os.cpu_count() or 1, len(stacks))
+    if jobs > 1:
+        #Twice as many chunks as workers, so a worker done early takes over the rest
+        groups = split_source_groups(groups, stacks, jobs * 2)
+    work = [[(requests[position][0], stacks[position], layer_code_cache.get(requests[position][0]))
+        for position in group] for group in groups]
+    jobs = min(jobs, len(work))
+    if jobs <= 1:
+        group_results = [compile_batch_group(group, store) for group in work]
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        #A forked Blender would share its GPU context and threads with the workers
+        context = multiprocessing.get_context("spawn")
+        initargs = (list(BeerInclude.include_paths), BeerInclude.get_default_include_paths(), use_pygments,
+            store.directory if store is not None else None)
+        group_results = []
+        with ProcessPoolExecutor(jobs, mp_context=context, initializer=init_batch_worker, initargs=initargs) as pool:
+            for results, writes in pool.map(compile_batch_job, work):
+                for result in results:
+                    merge_batch_result(result)
+                for source, stack_key in writes:
+                    store.put(source, stack_key)
+                group_results.append(results)
+    ordered = [None] * len(requests)
+    for group, results in zip(groups, group_results):
+        for position, result in zip(group, results):
+            ordered[position] = result
+    return ordered
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m BlenderBeer.BeerCompiler",
+        description="Compile BEER layer stack specs to Malt shaders, without Blender.")
+    parser.add_argument("specs", nargs="+", help="JSON stack specs, or directories searched for them")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory of the generated shaders")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("-I", "--include", action="append", default=[], help="extra #include search directory")
+    parser.add_argument("--check", action="store_true", help="validate and compile without writing files")
+    parser.add_argument("--pygments", action="store_true", help="lex with pygments instead of the built-in tokenizer")
+    parser.add_argument("--cost", action="store_true", help="print the estimated GPU cost of every stack")
+    parser.add_argument("--uniform-blocks", choices=BLOCK_MODES, default=None,
+        help="pack the layer uniforms into std140 blocks, overriding the mode of the specs")
+    parser.add_argument("--mask-early-out", action="store_true",
+        help="skip the shader of masked layers where their mask is zero, for every stack")
+    args = parser.parse_args(argv)
+
+    stacks = []
+    compiled = 0
+    failed = 0
+    for path in find_spec_files(args.specs):
+        try:
+            stacks += StackSpec.load(path)
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print("{}: invalid spec: {}".format(path, error), file=sys.stderr)
+            failed += 1
+    for stack in stacks:
+        if args.uniform_blocks:
+            stack.uniform_blocks = args.uniform_blocks
+        if args.mask_early_out:
+            stack.mask_early_out = True
+
+    start = time.perf_counter()
+    for result in compile_stacks(stacks, args.output_dir, args.jobs, args.check, args.include, args.pygments, args.cost):
+        if result["errors"]:
+            failed += 1
+            for error in result["errors"]:
+                print("{}: {}".format(result["name"], error), file=sys.stderr)
+        else:
+            compiled += 1
+            print("{}: {} bytes, {} live layer outputs at most, in {:.2f} ms{}".format(result["name"], result["bytes"],
+                result["peak_live_outputs"], result["time"] * 1000.0, " -> " + result["output"] if result["output"] else ""))
+            if result["cost"]:
+                total = result["cost"]["total"]
+                print("    {arithmetic} ops, {texture_samples} samples, {branches} branches, {loops} loops, "
+                    "{uniform_components} uniform components, {samplers} samplers".format(**total))
+                for warning in result["cost"]["warnings"]:
+                    print("    warning: " + warning)
+    print("{} stacks compiled, {} failed, in {:.2f} s".format(compiled, failed, time.perf_counter() - start))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# NumPy reference implementation of the BEER blend modes and of the layer composition
+# written by compile_function_source, for checking stack results without a GPU.
+# Every function works on arrays of any leading shape, colors have a trailing RGBA axis.
+
+import numpy as np
+from .BeerGraph import get_blending_layers, prune_layers, OutputPlan
+
+
+class PixelOutput():
+    """ The PixelOutput fields the blend functions read and write. """
+
+    def __init__(self, color, line_color=None, line_width=None):
+        self.color = np.asarray(color, dtype=np.float32)
+        if line_color is None:
+            line_color = np.zeros_like(self.color)
+        if line_width is None:
+            line_width = np.zeros(self.color.shape[:-1], dtype=np.float32)
+        self.line_color = np.asarray(line_color, dtype=np.float32)
+        self.line_width = np.asarray(line_width, dtype=np.float32)
+
+    def copy(self):
+        return PixelOutput(self.color.copy(), self.line_color.copy(), self.line_width.copy())
+
+
+def get_out(col1, out):
+    if out is None:
+        out = np.empty(np.broadcast_shapes(col1.shape, (4,)), dtype=np.float32)
+    return out
+
+def mix(x, y, a, out=None):
+    """ GLSL mix, computed as x + (y - x) * a """
+    out = np.subtract(y, x, out=out)
+    out *= a
+    out += x
+    return out
+
+def alpha_blend(base, blend, out=None):
+    """ Malt's alpha_blend, blend composited over base. """
+    blend_alpha = blend[..., 3:]
+    alpha = 1.0 - blend_alpha
+    alpha *= base[..., 3:]
+    alpha += blend_alpha
+    #(blend * blend_alpha + base * base_weight) / alpha, where the two weights add up to alpha
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = blend_alpha / alpha
+    out = mix(base, blend, weight, out)
+    transparent = alpha <= 0.0
+    #copyto with a mask is slow, only pay for it when some pixel needs it
+    if transparent.any():
+        np.copyto(out, 0.0, where=transparent)
+    out[..., 3:] = alpha
+    return out
+
+def get_fac(fac):
+    return np.clip(fac, 0.0, 1.0)[..., np.newaxis].astype(np.float32, copy=False)
+
+def keep_alpha(outcol, col1):
+    outcol[..., 3] = col1[..., 3]
+    return outcol
+
+#using mix functions from blender/source/blender/gpu/shaders/material/gpu_shader_material_mix_rgb.glsl
+#The expressions are rearranged to work in place on all four channels, the alpha of col1 is restored last.
+#Results go to out when given, it can't be col1 or col2.
+def mix_add(fac, col1, col2, out=None):
+    out = np.multiply(col2, get_fac(fac), out=get_out(col1, out))
+    out += col1
+    return keep_alpha(out, col1)
+
+def mix_sub(fac, col1, col2, out=None):
+    out = np.multiply(col2, get_fac(fac), out=get_out(col1, out))
+    np.subtract(col1, out, out=out)
+    return keep_alpha(out, col1)
+
+def mix_mult(fac, col1, col2, out=None):
+    out = np.multiply(col1, col2, out=get_out(col1, out))
+    return keep_alpha(mix(col1, out, get_fac(fac), out), col1)
+
+def mix_div(fac, col1, col2, out=None):
+    fac = get_fac(fac)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.divide(fac, col2, out=get_out(col1, out))
+        out += 1.0 - fac
+        out *= col1
+    zero = col2 == 0.0
+    if zero.any():
+        np.copyto(out, col1, where=zero)
+    return keep_alpha(out, col1)
+
+def mix_screen(fac, col1, col2, out=None):
+    #1.0 - (facm + fac * (1.0 - col2)) * (1.0 - col1) is col1 + fac * (col2 - col2 * col1)
+    out = np.multiply(col2, col1, out=get_out(col1, out))
+    np.subtract(col2, out, out=out)
+    out *= get_fac(fac)
+    out += col1
+    return keep_alpha(out, col1)
+
+def mix_overlay(fac, col1, col2, out=None):
+    #Both branches are col1 + k * w, with k = fac * (2.0 * col2 - 1.0),
+    #w is col1 below 0.5 and 1.0 - col1 above, that is 0.5 - abs(col1 - 0.5)
+    out = np.multiply(col2, 2.0, out=get_out(col1, out))
+    out -= 1.0
+    out *= get_fac(fac)
+    w = col1 - 0.5
+    np.abs(w, out=w)
+    np.subtract(0.5, w, out=w)
+    out *= w
+    out += col1
+    return keep_alpha(out, col1)
+
+def mix_diff(fac, col1, col2, out=None):
+    out = np.subtract(col1, col2, out=get_out(col1, out))
+    np.abs(out, out=out)
+    return keep_alpha(mix(col1, out, get_fac(fac), out), col1)
+
+def mix_light(fac, col1, col2, out=None):
+    out = np.maximum(col1, col2, out=get_out(col1, out))
+    return keep_alpha(mix(col1, out, get_fac(fac), out), col1)
+
+def mix_dark(fac, col1, col2, out=None):
+    out = np.minimum(col1, col2, out=get_out(col1, out))
+    return keep_alpha(mix(col1, out, get_fac(fac), out), col1)
+
+def mix_dodge(fac, col1, col2, out=None):
+    out = np.multiply(col2, get_fac(fac), out=get_out(col1, out))
+    np.subtract(1.0, out, out=out)
+    clipped = out <= 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(col1, out, out=out)
+        np.minimum(out, 1.0, out=out)
+    #Elsewhere a zero col1 stays zero after the division
+    if clipped.any():
+        np.copyto(out, col1 != 0.0, where=clipped)
+    return keep_alpha(out, col1)
+
+def mix_burn(fac, col1, col2, out=None):
+    fac = get_fac(fac)
+    #facm + fac * col2
+    out = np.subtract(col2, 1.0, out=get_out(col1, out))
+    out *= fac
+    out += 1.0
+    clipped = out <= 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(col1 - 1.0, out, out=out)
+    out += 1.0
+    np.clip(out, 0.0, 1.0, out=out)
+    if clipped.any():
+        np.copyto(out, 0.0, where=clipped)
+    return keep_alpha(out, col1)
+
+MIX_FUNCTIONS = {
+    "ADD" : mix_add,
+    "SUBTRACT" : mix_sub,
+    "MULTIPLY" : mix_mult,
+    "DIVIDE" : mix_div,
+    "SCREEN" : mix_screen,
+    "OVERLAY" : mix_overlay,
+    "DIFFERENCE" : mix_diff,
+    "LIGHTEN" : mix_light,
+    "DARKEN" : mix_dark,
+    "DODGE" : mix_dodge,
+    "BURN" : mix_burn,
+}
+
+def blend(mode, base, blending, out=None):
+    """
+    The blend_* function of a Blends name, returning the new base.
+    The result is written to the arrays of out when given, which can't be base or blending.
+    """
+    if out is None:
+        out = PixelOutput(np.empty(np.broadcast_shapes(base.color.shape, blending.color.shape), dtype=np.float32))
+    if mode == "DEFAULT":
+        #line_color is blended over base.color, before base.color is blended
+        alpha_blend(base.color, blending.line_color, out.line_color)
+        alpha_blend(base.color, blending.color, out.color)
+    else:
+        mix_function = MIX_FUNCTIONS[mode]
+        mix_function(blending.line_color[..., 3], base.color, blending.line_color, out.line_color)
+        mix_function(blending.color[..., 3], base.color, blending.color, out.color)
+    np.copyto(out.line_width, blending.line_width)
+    return out
+
+
+def composite_stack(layers, shade, po, mask_early_out=False):
+    """
+    Evaluate a layer stack the way the COMMON_PIXEL_SHADER of compile_function_source does.
+    shade(layer, input) returns the PixelOutput of the layer shader run on its input layer.
+    A dict of PixelOutputs keyed by layer index can be given instead, for layers rendered beforehand.
+    With mask_early_out, the layers OutputPlan skips where their mask is zero keep the line color
+    and width of their input there, with a zero color.
+    """
+    outputs = shade if isinstance(shade, dict) else None
+
+    live_layers, pruned = prune_layers(list(layers))
+    blending_layers = set(layer.index for layer in get_blending_layers(live_layers))
+    early_out = set()
+    if mask_early_out:
+        early_out = set(step[0].index for step in OutputPlan(live_layers, True).steps if step[6])
+    results = {0 : po}
+    compilation = po
+    #The blends alternate between two buffers, layer results are kept for the layers that read them
+    buffers = []
+    for layer in live_layers:
+        if outputs is not None:
+            result = outputs[layer.index]
+        else:
+            result = shade(layer, results[layer.input_index].copy())
+        if layer.masked_layer:
+            #The generated code scales color by the green channel of the masking layer
+            mask = results[layer.masking_index].color[..., 1:2]
+            result = PixelOutput(result.color * mask, result.line_color, result.line_width)
+            if layer.index in early_out:
+                skipped = mask[..., 0] == 0.0
+                source = results[layer.input_index]
+                result = PixelOutput(result.color,
+                    np.where(skipped[..., None], source.line_color, result.line_color),
+                    np.where(skipped, source.line_width, result.line_width))
+        results[layer.index] = result
+        if layer.index in blending_layers:
+            if layer.solo_layer:
+                compilation = result
+            else:
+                if not buffers:
+                    shape = np.broadcast_shapes(po.color.shape, result.color.shape)
+                    buffers = [PixelOutput(np.empty(shape, dtype=np.float32)) for i in range(2)]
+                out = buffers[0] if compilation is not buffers[0] else buffers[1]
+                compilation = blend(layer.blend, compilation, result, out)
+    if any(compilation is buffer for buffer in buffers):
+        return compilation
+    return compilation.copy()
@@ -0,0 +1,381 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Static estimate of the GPU cost of a generated BEER shader, computed on the CPU.
+# Every function is counted once, then the cost of the functions it calls is added for
+# each call site, so a layer costs its COMMON_PIXEL_SHADER and everything it reaches.
+
+import os
+import re
+from collections import OrderedDict
+from .BeerLexer import NAME, NAME_FUNCTION, KEYWORD_TYPE, OPERATOR, GENERIC, tokenize, classify_tokens
+from .BeerTree import ENTRY_POINT, LayerTree, significant, match_brackets, get_statement_end
+from .BeerPasses import Pass, pass_manager
+from .BeerCache import hash_source
+
+LAYER_PATTERN = re.compile(r'^_?beergen(\d+)_')
+
+#Minimums the GL spec guarantees for fragment shaders, the stack warns when it gets close to them
+MAX_UNIFORM_COMPONENTS = 1024
+MAX_TEXTURE_UNITS = 16
+WARNING_RATIO = 0.75
+
+ARITHMETIC_OPERATORS = frozenset(('+', '-', '*', '/', '%', '<', '>', '<=', '>=', '==', '!=',
+    '&&', '||', '^', '&', '|', '<<', '>>', '!', '~'))
+
+#Estimated in full rate ALU ops, transcendental functions run at a quarter rate
+BUILTIN_COSTS = {
+    'abs' : 1, 'sign' : 1, 'floor' : 1, 'ceil' : 1, 'fract' : 1, 'round' : 1, 'trunc' : 1,
+    'min' : 1, 'max' : 1, 'step' : 1, 'clamp' : 2, 'mix' : 2, 'mod' : 2, 'smoothstep' : 4,
+    'dot' : 1, 'cross' : 2, 'length' : 5, 'distance' : 6, 'normalize' : 6,
+    'reflect' : 3, 'refract' : 12, 'faceforward' : 3,
+    'sqrt' : 4, 'inversesqrt' : 4, 'exp' : 4, 'exp2' : 4, 'log' : 4, 'log2' : 4, 'pow' : 9,
+    'sin' : 4, 'cos' : 4, 'tan' : 8, 'asin' : 12, 'acos' : 12, 'atan' : 12,
+    'radians' : 1, 'degrees' : 1, 'dFdx' : 1, 'dFdy' : 1, 'fwidth' : 3,
+    'transpose' : 4, 'determinant' : 12, 'inverse' : 40,
+    #From the Malt pipeline, used by blend_default
+    'alpha_blend' : 10,
+}
+
+TEXTURE_FUNCTIONS = frozenset(('texture', 'textureLod', 'textureGrad', 'textureOffset', 'textureLodOffset',
+    'textureGradOffset', 'textureProj', 'textureProjLod', 'textureProjGrad', 'textureGather',
+    'textureGatherOffset', 'texelFetch', 'texelFetchOffset'))
+
+TYPE_COMPONENTS = {
+    'float' : 1, 'int' : 1, 'uint' : 1, 'bool' : 1, 'double' : 2,
+    'vec2' : 2, 'vec3' : 3, 'vec4' : 4, 'ivec2' : 2, 'ivec3' : 3, 'ivec4' : 4,
+    'uvec2' : 2, 'uvec3' : 3, 'uvec4' : 4, 'bvec2' : 2, 'bvec3' : 3, 'bvec4' : 4,
+    'mat2' : 4, 'mat3' : 9, 'mat4' : 16,
+    'mat2x2' : 4, 'mat2x3' : 6, 'mat2x4' : 8, 'mat3x2' : 6, 'mat3x3' : 9, 'mat3x4' : 12,
+    'mat4x2' : 8, 'mat4x3' : 12, 'mat4x4' : 16,
+}
+
+_source_costs = OrderedDict()
+_file_costs = {}
+
+
+class ShaderCost():
+    """ Estimated cost of a function or layer, per pixel. """
+
+    RUNTIME_FIELDS = ("arithmetic", "texture_samples", "branches", "loops", "unbounded_loops", "external_calls")
+
+    def __init__(self):
+        self.arithmetic = 0
+        self.texture_samples = 0
+        self.branches = 0
+        self.loops = 0
+        self.unbounded_loops = 0
+        self.external_calls = 0
+        self.uniforms = 0
+        self.uniform_components = 0
+        self.samplers = 0
+
+    def add(self, other, times=1):
+        """ Add the runtime cost of other, called times times. Uniforms are not added. """
+        for name in self.RUNTIME_FIELDS:
+            setattr(self, name, getattr(self, name) + getattr(other, name) * times)
+
+    def as_dict(self):
+        return {
+            "arithmetic" : self.arithmetic,
+            "texture_samples" : self.texture_samples,
+            "branches" : self.branches,
+            "loops" : self.loops,
+            "unbounded_loops" : self.unbounded_loops,
+            "external_calls" : self.external_calls,
+            "uniforms" : self.uniforms,
+            "uniform_components" : self.uniform_components,
+            "samplers" : self.samplers,
+        }
+
+    def summary(self):
+        return "{} ops, {} samples, {} branches, {} loops, {} uniforms".format(
+            self.arithmetic, self.texture_samples, self.branches, self.loops, self.uniforms)
+
+
+class FunctionCost():
+    """ The cost of a function body without its callees, and the functions it calls. """
+
+    def __init__(self, name, body, types=frozenset()):
+        self.name = name
+        self.cost = ShaderCost()
+        #(callee name, times) of every call site
+        self.calls = []
+        #Struct constructors look like calls
+        self.types = types
+        self.analyze(body)
+
+    def analyze(self, sig):
+        matches = match_brackets(sig)
+        #Loop bodies as (last token, iteration count), nested loops multiply
+        scopes = []
+        times = 1
+        cost = self.cost
+        for index, (ptype, value) in enumerate(sig):
+            while scopes and index > scopes[-1][0]:
+                scopes.pop()
+                times = scopes[-1][1] if scopes else 1
+            following = sig[index + 1][1] if index + 1 < len(sig) else None
+
+            if ptype == OPERATOR:
+                if value in ARITHMETIC_OPERATORS:
+                    cost.arithmetic += times
+                elif value == "?":
+                    cost.branches += times
+            elif value in ("if", "switch"):
+                cost.branches += times
+            elif value in ("for", "while", "do"):
+                loop = get_loop(sig, index, matches)
+                if loop is None:
+                    continue
+                end, iterations = loop
+                cost.loops += times
+                if iterations is None:
+                    cost.unbounded_loops += times
+                    iterations = 1
+                times *= iterations
+                scopes.append((end, times))
+            elif following == "(" and ptype in (NAME, NAME_FUNCTION, GENERIC) and value not in self.types:
+                if value in TEXTURE_FUNCTIONS:
+                    cost.texture_samples += times
+                elif value in BUILTIN_COSTS:
+                    cost.arithmetic += BUILTIN_COSTS[value] * times
+                else:
+                    self.calls.append((value, times))
+
+
+def get_iterations(header):
+    """ Iteration count of a for loop header with literal bounds, like int i = 0; i < 8; i++ """
+    parts = [[]]
+    for ptype, value in header:
+        if value == ";":
+            parts.append([])
+        else:
+            parts[-1].append((ptype, value))
+    if len(parts) != 3:
+        return None
+    init, condition, step = parts
+    start = 0
+    if len(init) >= 2 and init[-2][1] == "=" and init[-1][0].startswith("Token.Literal.Number"):
+        start = parse_number(init[-1][1])
+    if len(condition) != 3 or not condition[2][0].startswith("Token.Literal.Number"):
+        return None
+    bound = parse_number(condition[2][1])
+    if start is None or bound is None:
+        return None
+    operator = condition[1][1]
+    if operator == "<":
+        iterations = bound - start
+    elif operator == "<=":
+        iterations = bound - start + 1
+    elif operator == ">":
+        iterations = start - bound
+    elif operator == ">=":
+        iterations = start - bound + 1
+    else:
+        return None
+    return max(int(iterations), 0)
+
+def parse_number(value):
+    try:
+        return float(value.rstrip("uUfF"))
+    except ValueError:
+        return None
+
+def get_loop(sig, index, matches):
+    """ (last token of the body, iteration count or None) of the loop starting at index. """
+    value = sig[index][1]
+    if value == "do":
+        return get_statement_end(sig, index + 1, matches), None
+    open_index = index + 1
+    if open_index >= len(sig) or sig[open_index][1] != "(" or open_index not in matches:
+        return None
+    close_index = matches[open_index]
+    if value == "while" and close_index + 1 < len(sig) and sig[close_index + 1][1] == ";":
+        #The condition of a do while loop, counted with its do
+        return None
+    iterations = None
+    if value == "for":
+        iterations = get_iterations(sig[open_index + 1 : close_index])
+    return get_statement_end(sig, close_index + 1, matches), iterations
+
+def get_uniform_components(sig):
+    """ (names, components per name, is a sampler) of a uniform declaration. """
+    values = [value for ptype, value in sig]
+    position = values.index("uniform") + 1
+    while position < len(sig) and sig[position][0] != KEYWORD_TYPE and sig[position][0] != NAME:
+        position += 1
+    if position >= len(sig):
+        return [], 0, False
+    uniform_type = values[position]
+    sampler = "sampler" in uniform_type or "image" in uniform_type
+    #Struct uniforms are counted as one vec4 slot
+    components = TYPE_COMPONENTS.get(uniform_type, 4)
+    names = []
+    depth = 0
+    initializer = False
+    for index in range(position + 1, len(sig)):
+        value = values[index]
+        if value in ("(", "{"):
+            depth += 1
+        elif value in (")", "}"):
+            depth -= 1
+        elif depth == 0 and value == "=":
+            initializer = True
+        elif depth == 0 and value == ",":
+            initializer = False
+        elif depth == 0 and not initializer and sig[index][0] == NAME and value not in ("lowp", "mediump", "highp"):
+            count = 1
+            if index + 3 < len(sig) and values[index + 1] == "[" and values[index + 3] == "]":
+                count = int(parse_number(values[index + 2]) or 1)
+            names.append((value, count))
+    return names, components, sampler
+
+def get_layer_index(name):
+    match = LAYER_PATTERN.match(name)
+    return int(match.group(1)) if match else None
+
+
+class CostPass(Pass):
+    """ FunctionCost of every function of a tree, overloads counted as their most expensive version. """
+    name = "cost"
+
+    def run(self, tree, results):
+        types = tree.get_names("struct")
+        functions = {}
+        for declaration in tree.declarations:
+            if declaration.kind == "function":
+                function = FunctionCost(declaration.name, significant(declaration.tokens[declaration.param_close + 1:]), types)
+                previous = functions.get(declaration.name)
+                if previous is None or function.cost.arithmetic > previous.cost.arithmetic:
+                    functions[declaration.name] = function
+        return functions
+
+pass_manager.register(CostPass())
+
+
+class StackCost():
+    """ Cost of every layer and blend function of a generated shader, and of the whole pixel shader. """
+
+    def __init__(self, source):
+        tree = LayerTree(tuple(classify_tokens(tokenize(source))))
+        self.functions = pass_manager.run(tree, "cost")
+        self.layers = {}
+        self.blends = {}
+        self.uniforms = 0
+        self.uniform_components = 0
+        self.samplers = 0
+        self._closures = {}
+
+        for declaration in tree.declarations:
+            if declaration.kind == "uniform":
+                self.add_uniform(significant(declaration.tokens))
+
+        for name in self.functions:
+            index = get_layer_index(name)
+            if name == get_layer_entry(index):
+                self.layers.setdefault(index, ShaderCost()).add(self.get_closure(name))
+            elif name.startswith("blend_"):
+                self.blends[name] = self.get_closure(name)
+        self.total = self.get_closure(ENTRY_POINT) if ENTRY_POINT in self.functions else ShaderCost()
+        self.total.uniforms = self.uniforms
+        self.total.uniform_components = self.uniform_components
+        self.total.samplers = self.samplers
+        self.warnings = self.get_warnings()
+
+    def add_uniform(self, sig):
+        names, components, sampler = get_uniform_components(sig)
+        for name, count in names:
+            index = get_layer_index(name)
+            layer = self.layers.setdefault(index, ShaderCost()) if index is not None else None
+            self.uniforms += 1
+            if sampler:
+                self.samplers += count
+            else:
+                self.uniform_components += components * count
+            if layer is not None:
+                layer.uniforms += 1
+                if sampler:
+                    layer.samplers += count
+                else:
+                    layer.uniform_components += components * count
+
+    def get_closure(self, name, visiting=None):
+        """ Cost of a function including everything it calls, counted per call site. """
+        closure = self._closures.get(name)
+        if closure is not None:
+            return closure
+        visiting = visiting or set()
+        visiting.add(name)
+        function = self.functions[name]
+        closure = ShaderCost()
+        closure.add(function.cost)
+        for callee, times in function.calls:
+            if callee in self.functions and callee not in visiting:
+                closure.add(self.get_closure(callee, visiting), times)
+            elif callee not in self.functions:
+                closure.external_calls += times
+        visiting.discard(name)
+        self._closures[name] = closure
+        return closure
+
+    def get_warnings(self):
+        warnings = []
+        if self.uniform_components >= MAX_UNIFORM_COMPONENTS * WARNING_RATIO:
+            warnings.append("{} uniform components, drivers only guarantee {}".format(
+                self.uniform_components, MAX_UNIFORM_COMPONENTS))
+        if self.samplers >= MAX_TEXTURE_UNITS * WARNING_RATIO:
+            warnings.append("{} samplers, drivers only guarantee {} texture units".format(
+                self.samplers, MAX_TEXTURE_UNITS))
+        for index, layer in sorted(self.layers.items()):
+            if layer.unbounded_loops:
+                warnings.append("Layer {} has loops without a constant bound, counted as one iteration".format(index))
+        return warnings
+
+    def get_heaviest_layer(self):
+        if not self.layers:
+            return None
+        return max(self.layers, key=lambda index: self.layers[index].arithmetic + 4 * self.layers[index].texture_samples)
+
+    def as_dict(self):
+        return {
+            "total" : self.total.as_dict(),
+            "layers" : {index : cost.as_dict() for index, cost in sorted(self.layers.items())},
+            "blends" : {name : cost.as_dict() for name, cost in sorted(self.blends.items())},
+            "warnings" : list(self.warnings),
+        }
+
+def get_layer_entry(index):
+    if index is None:
+        return None
+    return "beergen{}_{}".format(index, ENTRY_POINT)
+
+
+def analyze_source(source, max_entries=16):
+    """ StackCost of a generated source, cached by content. """
+    key = hash_source(source)
+    cost = _source_costs.get(key)
+    if cost is None:
+        cost = StackCost(source)
+        _source_costs[key] = cost
+        while len(_source_costs) > max_entries:
+            _source_costs.popitem(last=False)
+    else:
+        _source_costs.move_to_end(key)
+    return cost
+
+def analyze_file(path):
+    """ StackCost of a generated shader file, None when it can not be read. """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    entry = _file_costs.get(path)
+    if entry is not None and entry[0] == (stat.st_mtime_ns, stat.st_size):
+        return entry[1]
+    try:
+        with open(path) as f:
+            cost = analyze_source(f.read())
+    except (OSError, UnicodeDecodeError):
+        return None
+    _file_costs[path] = ((stat.st_mtime_ns, stat.st_size), cost)
+    return cost
@@ -0,0 +1,168 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Functions that are identical in several layers are emitted once, under a prefix
+# derived from their normalized tokens. The uniforms a shared function reads are
+# passed in as extra parameters, so every layer keeps its own uniforms.
+
+import hashlib
+from .BeerLexer import rename_symbol
+from .BeerTree import ENTRY_POINT, is_space
+from .BeerPasses import Pass, pass_manager, write_segments
+
+
+def get_shared_prefix(key):
+    return "beershared" + key[:8]
+
+
+class DedupPass(Pass):
+    """ The canonical key of every live function a layer could share, the others are marked unshareable. """
+    name = "dedup"
+    requires = ("dead_functions",)
+
+    def run(self, tree, results):
+        dead = results["dead_functions"]
+        for declaration in tree.declarations:
+            if declaration.kind != "function":
+                continue
+            if tree.macros or tree.definitions[declaration.name] > 1 or declaration in dead or declaration.preprocessed:
+                declaration.shareable = False
+                continue
+            self.analyze(tree, declaration)
+        return [function.key for function in tree.functions.values() if function.key]
+
+    def analyze(self, tree, function):
+        uniforms = set()
+        callees = []
+        for index, symbol in function.references:
+            if index == function.name_index:
+                continue
+            if symbol.kind == "uniform" and symbol.name in tree.uniforms:
+                uniforms.add(symbol.name)
+            elif symbol.kind == "function":
+                callee = tree.functions.get(symbol.name)
+                if callee is None or callee is function or callee.key is None:
+                    function.shareable = False
+                    return
+                callees.append(callee)
+                uniforms |= callee.uniforms
+            else:
+                #Globals, structs, blocks and macros belong to the layer
+                function.shareable = False
+                return
+
+        function.uniforms = uniforms
+        function.callees = callees
+        key = hashlib.sha1()
+        for ptype, value in function.tokens:
+            if not is_space(ptype, value):
+                key.update(value.encode('utf-8'))
+                key.update(b"\0")
+        for name in sorted(uniforms):
+            uniform = tree.uniforms[name]
+            key.update("\1{} {}{}".format(uniform.uniform_type, name, uniform.array).encode('utf-8'))
+        for callee in callees:
+            key.update(b"\2" + callee.key.encode('utf-8'))
+        function.key = key.hexdigest()
+
+pass_manager.register(DedupPass())
+
+
+def get_uniform_param(uniform, prefix):
+    return uniform.uniform_type + " " + rename_symbol(uniform.name, prefix) + uniform.array
+
+
+class SharedFunctions():
+    """
+    The functions found in more than one layer of a stack.
+    Each one is written once, in place of its definition in the first layer that has it.
+    """
+
+    def __init__(self, stack_functions):
+        self.stack_functions = stack_functions
+        self.stack_keys = [pass_manager.run(tree, "dedup") for tree in stack_functions]
+        counts = {}
+        for keys in self.stack_keys:
+            for key in set(keys):
+                counts[key] = counts.get(key, 0) + 1
+        self.keys = set(key for key, count in counts.items() if count > 1)
+
+        self.owners = {}
+        for position, keys in enumerate(self.stack_keys):
+            for key in keys:
+                if key in self.keys and key not in self.owners:
+                    self.owners[key] = position
+
+    def get_layer_signature(self, position):
+        """ The shared keys a layer uses and whether it defines them, which decide how the layer is emitted. """
+        keys = set(self.stack_keys[position]) & self.keys
+        return tuple(sorted((key, self.owners[key] == position) for key in keys))
+
+    def get_names(self, tree, prefix):
+        """ The output name of every symbol of a layer, shared functions under their shared prefix. """
+        names = {}
+        for name, symbol in tree.symbols.items():
+            function = tree.functions.get(name) if symbol.kind == "function" else None
+            if function is not None and function.key in self.keys:
+                names[symbol] = rename_symbol(name, get_shared_prefix(function.key))
+            else:
+                names[symbol] = rename_symbol(name, prefix)
+        return names
+
+    def get_arguments(self, tree, prefix):
+        """ The uniforms passed to each shared function of a layer, named as in the caller. """
+        arguments = {}
+        for name, function in tree.functions.items():
+            if function.key in self.keys and function.uniforms:
+                arguments[tree.symbols[name]] = ", ".join(rename_symbol(uniform, prefix)
+                    for uniform in sorted(function.uniforms))
+        return arguments
+
+    def write_layer(self, position, prefix, out, packed=frozenset(), baked=None):
+        """
+        Write a layer without its hoisted includes and the functions its entry point does not reach.
+        The uniform declarations in packed are left out, they are members of a uniform block.
+        The ones in baked are replaced by their const declaration.
+        """
+        tree = self.stack_functions[position]
+        plan = pass_manager.run(tree, "rename")
+        dead = pass_manager.run(tree, "dead_functions")
+        names = self.get_names(tree, prefix)
+        arguments = self.get_arguments(tree, prefix)
+        after_removed = False
+        for declaration in tree.declarations:
+            if declaration in packed or declaration in dead or (after_removed and declaration.kind == "text"
+                and all(value.isspace() for ptype, value in declaration.tokens)):
+                after_removed = True
+                continue
+            after_removed = False
+            if baked and declaration in baked:
+                out.write(baked[declaration])
+                continue
+            if declaration.hoisted:
+                continue
+            if declaration.kind == "function" and declaration.key in self.keys:
+                if self.owners[declaration.key] == position:
+                    self.write_shared_function(tree, declaration, plan[declaration], out)
+                if declaration.name == ENTRY_POINT:
+                    out.write("\n")
+                    self.write_wrapper(declaration, prefix, out)
+                continue
+            write_segments(declaration.tokens, plan[declaration], out, names, arguments)
+
+    def write_shared_function(self, tree, function, segments, out):
+        prefix = get_shared_prefix(function.key)
+        extra_params = ", ".join(get_uniform_param(tree.uniforms[name], prefix)
+            for name in sorted(function.uniforms))
+        write_segments(function.tokens, segments, out, self.get_names(tree, prefix), self.get_arguments(tree, prefix), extra_params)
+
+    def write_wrapper(self, function, prefix, out):
+        """ Keep the per-layer entry point, forwarding to the shared function with the layer uniforms. """
+        tokens = function.tokens
+        out.write("".join([value for ptype, value in tokens[:function.name_index]]))
+        out.write(rename_symbol(function.name, prefix))
+        out.write("".join([value for ptype, value in tokens[function.name_index + 1 : function.param_close + 1]]))
+        arguments = function.get_param_names() + [rename_symbol(name, prefix) for name in sorted(function.uniforms)]
+        call = rename_symbol(function.name, get_shared_prefix(function.key)) + "(" + ", ".join(arguments) + ");"
+        if not function.returns_void:
+            call = "return " + call
+        out.write("\n{\n    " + call + "\n}")
@@ -0,0 +1,222 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Analysis of the layer graph formed by input_index and masking_index,
+# following the order compile_function_source evaluates the layers in,
+# and the layer positions after the stack edits of BeerMaterial.
+
+
+def get_layer_map(layers):
+    return {layer.index : layer for layer in layers}
+
+def get_layer_dependencies(layer):
+    """ Indices of the layer outputs read by this layer. 0 is the incoming PO. """
+    dependencies = []
+    if layer.input_index:
+        dependencies.append(layer.input_index)
+    if layer.masked_layer and layer.masking_index:
+        dependencies.append(layer.masking_index)
+    return dependencies
+
+def can_hide(layer):
+    """ Whether the layer overwrites the color and lines of PO when it is opaque. """
+    return layer.blend == "DEFAULT" and not layer.masked_layer and not layer.mute_layer
+
+def get_blending_layers(layers, opaque=frozenset()):
+    """
+    Layers blended into PO that are not overwritten afterwards.
+    A solo layer replaces PO, hiding every layer blended before it.
+    An opaque DEFAULT layer, its index in opaque, overwrites the color and the lines of PO, hiding
+    the layers blended before it too. A solo layer before it is kept, it also sets the other PO fields.
+    """
+    layers = list(layers)
+    start = 0
+    solo = None
+    for position, layer in enumerate(layers):
+        if layer.solo_layer and not layer.mute_layer:
+            start = position
+            solo = None
+        elif layer.index in opaque and can_hide(layer):
+            if layers[start].solo_layer and not layers[start].mute_layer:
+                solo = layers[start]
+            start = position
+    blending = [layer for layer in layers[start:] if not layer.mute_layer]
+    if solo is not None:
+        blending.insert(0, solo)
+    return blending
+
+def get_reachable_layers(layers, opaque=frozenset()):
+    """ Indices of the layers that can affect the final PO. """
+    layer_map = get_layer_map(layers)
+    reachable = set()
+    stack = [layer.index for layer in get_blending_layers(layers, opaque)]
+    while stack:
+        index = stack.pop()
+        if index in reachable or index not in layer_map:
+            continue
+        reachable.add(index)
+        stack += get_layer_dependencies(layer_map[index])
+    return reachable
+
+def prune_layers(layers, opaque=frozenset()):
+    """ Split the stack into the layers to compile and the indices of the pruned ones. """
+    reachable = get_reachable_layers(layers, opaque)
+    live_layers = []
+    pruned = []
+    for layer in layers:
+        if layer.index in reachable:
+            live_layers.append(layer)
+        else:
+            pruned.append(layer.index)
+    return live_layers, pruned
+
+def get_output_reads(layers):
+    """
+    For every layer output read by a layer of the stack, 0 being the incoming PO:
+    the position of its last reader, and whether every reader only reads it as a mask.
+    """
+    reads = {}
+    for position, layer in enumerate(layers):
+        if layer.masked_layer:
+            last, mask_only = reads.get(layer.masking_index, (position, True))
+            reads[layer.masking_index] = (position, mask_only)
+        reads[layer.input_index] = (position, False)
+    return reads
+
+
+def can_skip_masked(layer, blending):
+    """
+    Whether the shader of a masked layer can be skipped where its mask is zero, blending a zero color instead.
+    The mask only scales color, so the skipped layer leaves the input line color and width in its output.
+    That is only invisible when nothing reads the output but its blend, the blend is not a solo that copies
+    every field, and a later blend overwrites the line color and width of PO, as every blend mode does.
+    The position checks are left to OutputPlan.
+    """
+    return layer.masked_layer and layer.index in blending and not layer.solo_layer
+
+
+class OutputPlan():
+    """
+    Where compile_function_source keeps the layer outputs.
+    Outputs live in PixelOutput slots that are freed after their last reader and reused by later layers.
+    A layer that is the last reader of its input is shaded in place, in the slot of the input.
+    Outputs only read as masks are reduced to their .g channel, and the incoming PO is only copied
+    when it is still read after the first blend overwrites it.
+    Locations are ("PO", 0), ("SLOT", slot), ("MASK", index) or ("MISSING", index) for a layer
+    that is not computed before its reader.
+    With mask_early_out, masked layers whose shader can be skipped where the mask is zero are flagged,
+    see can_skip_masked.
+    """
+
+    def __init__(self, layers, mask_early_out=False, opaque=frozenset()):
+        layers = list(layers)
+        reads = get_output_reads(layers)
+        blending = set(layer.index for layer in get_blending_layers(layers, opaque))
+        blend_positions = [position for position, layer in enumerate(layers) if layer.index in blending]
+        first_blend = blend_positions[0] if blend_positions else len(layers)
+        last_blend = blend_positions[-1] if blend_positions else -1
+
+        self.steps = []
+        self.saved_input = None
+        self.slots = 0
+        self.blending = blending
+        free = []
+        locations = {0 : ("PO", 0)}
+
+        def allocate():
+            if free:
+                return free.pop(free.index(min(free))), False
+            self.slots += 1
+            return self.slots - 1, True
+
+        if 0 in reads and reads[0][0] > first_blend:
+            if reads[0][1]:
+                locations[0] = ("MASK", 0)
+            else:
+                slot, declare = allocate()
+                locations[0] = ("SLOT", slot)
+            self.saved_input = locations[0]
+
+        for position, layer in enumerate(layers):
+            input_location = locations.get(layer.input_index, ("MISSING", layer.input_index))
+            mask_location = None
+            dependencies = {layer.input_index}
+            if layer.masked_layer:
+                mask_location = locations.get(layer.masking_index, ("MISSING", layer.masking_index))
+                dependencies.add(layer.masking_index)
+            in_place = (input_location[0] == "SLOT" and reads[layer.input_index][0] == position
+                and not (layer.masked_layer and layer.masking_index == layer.input_index))
+            if in_place:
+                slot, declare = input_location[1], False
+                input_location = None
+            else:
+                slot, declare = allocate()
+
+            read = reads.get(layer.index)
+            live = read is not None and read[0] > position
+            keep_mask = live and read[1]
+            early_out = (mask_early_out and not live and position < last_blend
+                and can_skip_masked(layer, blending))
+            self.steps.append((layer, slot, declare, input_location, mask_location, keep_mask, early_out))
+
+            for index in dependencies:
+                location = locations.get(index)
+                if location is not None and location[0] == "SLOT" and reads[index][0] == position:
+                    if not (in_place and index == layer.input_index):
+                        free.append(location[1])
+            if keep_mask:
+                locations[layer.index] = ("MASK", layer.index)
+            if live and not keep_mask:
+                locations[layer.index] = ("SLOT", slot)
+            else:
+                free.append(slot)
+
+    def get_peak_live_outputs(self):
+        """ Most layer outputs kept in PixelOutputs at once, the size of the slot pool. """
+        return self.slots
+
+
+def get_layer_inserts(length, position, count):
+    """
+    Insert count layers at position of a stack of length layers, at the end when position is None.
+    Returns the (from, to) moves that bring the layers added at the end to their place, and their positions.
+    """
+    if position is None:
+        position = length
+    position = max(0, min(position, length))
+    moves = [(length + offset, position + offset) for offset in range(count) if position != length]
+    return moves, list(range(position, position + count))
+
+def get_layer_deletes(length, indices, active):
+    """ The valid positions of indices, last first as they are removed, and the active position afterwards. """
+    indices = sorted(set(index for index in indices if 0 <= index < length), reverse=True)
+    if not indices:
+        return [], active
+    return indices, min(max(0, indices[-1] - 1), length - len(indices) - 1)
+
+def get_layer_moves(length, indices, offset, active):
+    """
+    Move the layers at indices by offset positions, keeping their order.
+    Layers stop at the ends of the stack and at the layers moved before them.
+    Returns the (from, to) moves in the order they are done, the new positions and the new active position.
+    """
+    indices = sorted(set(index for index in indices if 0 <= index < length), reverse=offset > 0)
+    if not indices or offset == 0:
+        return [], sorted(indices), active
+    limit = -1 if offset < 0 else length
+    #Original position of the layer at each position, to find the active layer after the moves
+    order = list(range(length))
+    moves = []
+    positions = []
+    for index in indices:
+        if offset < 0:
+            target = max(index + offset, limit + 1)
+        else:
+            target = min(index + offset, limit - 1)
+        if target != index:
+            moves.append((index, target))
+            order.insert(target, order.pop(index))
+        positions.append(target)
+        limit = target
+    if active in order:
+        active = order.index(active)
+    return moves, sorted(positions), active
@@ -0,0 +1,89 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# The #include directives of every layer are written once at the top of the generated shader.
+# The included files are not scanned, BeerTree only renames the symbols a layer declares.
+
+import os
+import re
+
+PIPELINE_INCLUDE = "Pipelines/NPR_Pipeline.glsl"
+INCLUDE_PATTERN = re.compile(r'#\s*include\s*[<"]([^>"]+)[>"]')
+
+#Extra directories searched for included files, after the directory of the including file
+include_paths = []
+
+_default_paths = None
+
+
+def parse_include(directive):
+    match = INCLUDE_PATTERN.match(directive.strip())
+    if match is None:
+        return None
+    return match.group(1)
+
+def format_include(name):
+    return '#include "{}"'.format(name)
+
+def get_default_include_paths():
+    """ The shader library directories of Malt, when it can be imported. """
+    global _default_paths
+    if _default_paths is None:
+        _default_paths = []
+        try:
+            import Malt
+        except ImportError:
+            return _default_paths
+        for directory, subdirs, files in os.walk(os.path.dirname(Malt.__file__)):
+            if os.path.basename(directory) == "Shaders":
+                _default_paths.append(directory)
+    return _default_paths
+
+def set_default_include_paths(paths):
+    """ Use paths as the Malt shader library directories, for worker processes that may not import Malt. """
+    global _default_paths
+    _default_paths = list(paths)
+
+def get_search_paths():
+    return include_paths + get_default_include_paths()
+
+def resolve_include(name, directory, search_paths):
+    directories = [directory] if directory else []
+    for base in directories + search_paths:
+        path = os.path.join(base, name)
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+    return None
+
+
+class StackIncludes():
+    """
+    The includes of a layer stack, deduplicated by the file they resolve to.
+    The generated shader is not in the directory of the layers, so an include found next to its layer
+    is written with its absolute path, and one found on the search paths keeps its name.
+    """
+
+    def __init__(self, stack_functions, source_paths, search_paths=None):
+        if search_paths is None:
+            search_paths = get_search_paths()
+        self.keys = [resolve_include(PIPELINE_INCLUDE, None, search_paths) or PIPELINE_INCLUDE]
+        self.directives = [format_include(PIPELINE_INCLUDE)]
+        for layer_functions, source_path in zip(stack_functions, source_paths):
+            directory = os.path.dirname(source_path)
+            for declaration in layer_functions.includes:
+                directive = declaration.tokens[0][1].strip()
+                name = parse_include(directive)
+                if name is None:
+                    key = directive
+                else:
+                    path = resolve_include(name, directory, search_paths)
+                    key = path or name
+                    if path is not None and path != resolve_include(name, None, search_paths):
+                        directive = format_include(os.path.abspath(path).replace(os.sep, "/"))
+                    else:
+                        directive = format_include(name)
+                if declaration.hoisted and key not in self.keys:
+                    self.keys.append(key)
+                    self.directives.append(directive)
+
+    def get_header(self):
+        return "".join(directive + "\n" for directive in self.directives)
@@ -0,0 +1,302 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+import re
+
+NAME = "Token.Name"
+NAME_FUNCTION = "Token.Name.Function"
+KEYWORD_TYPE = "Token.Keyword.Type"
+TEXT = "Token.Text"
+COMMENT = "Token.Comment"
+OPERATOR = "Token.Operator"
+PUNCTUATION = "Token.Punctuation"
+OTHER = "Token.Other"
+GENERIC = "Token.Generic"
+PREPROC = "Token.Comment.Preproc"
+WHITESPACE = "Token.Text.Whitespace"
+
+#Same rules, in the same order, as the pygments GLSL lexer.
+#Whitespace is emitted as Token.Text, like pygments did before 2.11, which is what the classifier expects.
+GLSL_KEYWORDS = (
+    'attribute', 'const', 'uniform', 'varying', 'buffer', 'shared', 'in', 'out',
+    'layout', 'flat', 'smooth', 'noperspective', 'centroid', 'sample', 'patch',
+    'inout', 'lowp', 'mediump', 'highp', 'precision', 'invariant', 'precise',
+    'coherent', 'volatile', 'restrict', 'readonly', 'writeonly',
+    'break', 'continue', 'do', 'for', 'while', 'switch', 'case', 'default', 'if', 'else',
+    'subroutine', 'discard', 'return', 'struct',
+)
+
+GLSL_CONSTANTS = ('true', 'false')
+
+GLSL_TYPES = (
+    'void', 'atomic_uint',
+    'float', 'vec2', 'vec3', 'vec4', 'double', 'dvec2', 'dvec3', 'dvec4',
+    'int', 'ivec2', 'ivec3', 'ivec4', 'uint', 'uvec2', 'uvec3', 'uvec4',
+    'bool', 'bvec2', 'bvec3', 'bvec4',
+    'mat2', 'mat3', 'mat4', 'dmat2', 'dmat3', 'dmat4',
+    'mat2x2', 'mat2x3', 'mat2x4', 'dmat2x2', 'dmat2x3', 'dmat2x4',
+    'mat3x2', 'mat3x3', 'mat3x4', 'dmat3x2', 'dmat3x3', 'dmat3x4',
+    'mat4x2', 'mat4x3', 'mat4x4', 'dmat4x2', 'dmat4x3', 'dmat4x4',
+    'sampler1D', 'sampler2D', 'sampler3D', 'samplerCube',
+    'sampler1DArray', 'sampler2DArray', 'samplerCubeArray', 'sampler2DRect', 'samplerBuffer',
+    'sampler2DMS', 'sampler2DMSArray',
+    'sampler1DShadow', 'sampler2DShadow', 'samplerCubeShadow',
+    'sampler1DArrayShadow', 'sampler2DArrayShadow', 'samplerCubeArrayShadow', 'sampler2DRectShadow',
+    'isampler1D', 'isampler2D', 'isampler3D', 'isamplerCube',
+    'isampler1DArray', 'isampler2DArray', 'isamplerCubeArray', 'isampler2DRect', 'isamplerBuffer',
+    'isampler2DMS', 'isampler2DMSArray',
+    'usampler1D', 'usampler2D', 'usampler3D', 'usamplerCube',
+    'usampler1DArray', 'usampler2DArray', 'usamplerCubeArray', 'usampler2DRect', 'usamplerBuffer',
+    'usampler2DMS', 'usampler2DMSArray',
+    'image1D', 'image2D', 'image3D', 'imageCube',
+    'image1DArray', 'image2DArray', 'imageCubeArray', 'image2DRect', 'imageBuffer',
+    'image2DMS', 'image2DMSArray',
+    'iimage1D', 'iimage2D', 'iimage3D', 'iimageCube',
+    'iimage1DArray', 'iimage2DArray', 'iimageCubeArray', 'iimage2DRect', 'iimageBuffer',
+    'iimage2DMS', 'iimage2DMSArray',
+    'uimage1D', 'uimage2D', 'uimage3D', 'uimageCube',
+    'uimage1DArray', 'uimage2DArray', 'uimageCubeArray', 'uimage2DRect', 'uimageBuffer',
+    'uimage2DMS', 'uimage2DMSArray',
+)
+
+GLSL_RESERVED = (
+    'common', 'partition', 'active', 'asm', 'class', 'union', 'enum', 'typedef', 'template', 'this',
+    'resource', 'goto', 'inline', 'noinline', 'public', 'static', 'extern', 'external', 'interface',
+    'long', 'short', 'half', 'fixed', 'unsigned', 'superp', 'input', 'output',
+    'hvec2', 'hvec3', 'hvec4', 'fvec2', 'fvec3', 'fvec4', 'sampler3DRect', 'filter', 'sizeof', 'cast',
+    'namespace', 'using',
+)
+
+def words(word_list):
+    return r'\b(?:' + '|'.join(sorted(word_list, key=len, reverse=True)) + r')\b'
+
+GLSL_RULES = (
+    ("Token.Comment.Preproc", r'#(?:.*\\\n)*.*$'),
+    ("Token.Comment.Single", r'//.*$'),
+    ("Token.Comment.Multiline", r'/(?:\\\n)?[*](?:.|\n)*?[*](?:\\\n)?/'),
+    ("Token.Operator", r'\+|-|~|!=?|\*|/|%|<<|>>|<=?|>=?|==?|&&?|\^|\|\|?'),
+    ("Token.Operator", r'[?:]'),
+    ("Token.Operator", r'\bdefined\b'),
+    ("Token.Punctuation", r'[;{}(),\[\]]'),
+    ("Token.Literal.Number.Float", r'[+-]?\d*\.\d+(?:[eE][-+]?\d+)?'),
+    ("Token.Literal.Number.Float", r'[+-]?\d+\.\d*(?:[eE][-+]?\d+)?'),
+    ("Token.Literal.Number.Hex", r'0[xX][0-9a-fA-F]*'),
+    ("Token.Literal.Number.Oct", r'0[0-7]*'),
+    ("Token.Literal.Number.Integer", r'[1-9][0-9]*'),
+    ("Token.Keyword", words(GLSL_KEYWORDS)),
+    ("Token.Keyword.Constant", words(GLSL_CONSTANTS)),
+    (KEYWORD_TYPE, words(GLSL_TYPES)),
+    ("Token.Keyword.Reserved", words(GLSL_RESERVED)),
+    ("Token.Name.Builtin", r'gl_\w*'),
+    (NAME, r'[a-zA-Z_]\w*'),
+    (PUNCTUATION, r'\.'),
+    (TEXT, r'\s+'),
+)
+
+GLSL_TOKEN_TYPES = tuple(ttype for ttype, rule in GLSL_RULES)
+GLSL_PATTERN = re.compile(
+    '|'.join('(?P<t{}>{})'.format(i, rule) for i, (ttype, rule) in enumerate(GLSL_RULES)),
+    re.MULTILINE)
+
+
+def prepare_source(text):
+    """ Normalize the source the same way pygments does before lexing. """
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = text.strip('\n')
+    if not text.endswith('\n'):
+        text += '\n'
+    return text
+
+def tokenize(text):
+    """ Built-in GLSL tokenizer, yields (token type, value) pairs. """
+    text = prepare_source(text)
+    match = GLSL_PATTERN.match
+    token_types = GLSL_TOKEN_TYPES
+    pos = 0
+    end = len(text)
+    while pos < end:
+        m = match(text, pos)
+        if m is not None:
+            value = m.group()
+            if value:
+                yield token_types[m.lastindex - 1], value
+                pos = m.end()
+                continue
+        value = text[pos]
+        if value == '\n':
+            yield TEXT, value
+        else:
+            yield "Token.Error", value
+        pos += 1
+
+def lex_passes(token_generator):
+    """ Two-pass reference classifier. classify_tokens produces the same output in one pass. """
+
+    tokens = list(token_generator)
+    r_tokens = reversed(tokens)
+    nu_tokens = []
+    mu_tokens = []
+
+    dot_flag = False
+    name_flag = False
+    type_flag = False
+    function_flag = False
+    comment_flag = False
+    declared_functions = []
+
+    for ttype, value in r_tokens:
+        ptype = str(ttype)
+        if str(ttype) == "Token.Name":
+            if function_flag:
+                ptype = "Token.Name.Function"
+            if not name_flag:
+                name_flag = True
+            else:
+                ptype = "Token.Keyword.Type"
+        elif str(ttype) != "Token.Text" and str(ttype) != "Token.Comment":
+            name_flag = False
+            if str(value) == "(":
+                function_flag = True
+            else:
+                function_flag = False
+        nu_tokens.append((ptype, value))
+    nu_tokens.reverse()
+    tokens = nu_tokens.copy()
+
+    for ttype, value in tokens:
+        ptype = str(ttype)
+        if comment_flag:
+            if '\n' in str(value) or '\r' in str(value):
+                comment_flag = False
+            else:
+                ptype = "Token.Comment"
+        else:
+            if str(value) == "#":
+                comment_flag = True
+
+            if dot_flag:
+                if str(ttype) != "Token.Operator" and str(ttype) != "Token.Punctuation":
+                    ptype = "Token.Other"
+                else:
+                    dot_flag = False
+            if str(value) == ".":
+                dot_flag = True
+
+            if str(ttype) == "Token.Keyword.Type":
+                type_flag = True
+            else:
+                if str(ttype) == "Token.Name.Function":
+                    if type_flag:
+                        declared_functions.append(value)
+                    else:
+                        if str(value) not in declared_functions:
+                            ptype = "Token.Generic"
+                elif str(ttype) != "Token.Text" and str(ttype) != "Token.Comment":
+                    type_flag = False
+        mu_tokens.append((ptype, value))
+
+    return mu_tokens
+
+
+class SymbolClassifier():
+    """
+    Forward half of the classification: tracks preprocessor lines, member
+    access after '.', and which functions were declared with a return type.
+    """
+
+    def __init__(self):
+        self.dot_flag = False
+        self.type_flag = False
+        self.comment_flag = False
+        self.declared_functions = set()
+
+    def classify(self, ttype, value):
+        ptype = ttype
+        if self.comment_flag:
+            if '\n' in value or '\r' in value:
+                self.comment_flag = False
+            else:
+                ptype = COMMENT
+            return ptype
+
+        if value == "#":
+            self.comment_flag = True
+
+        if self.dot_flag:
+            if ttype != OPERATOR and ttype != PUNCTUATION:
+                ptype = OTHER
+            else:
+                self.dot_flag = False
+        if value == ".":
+            self.dot_flag = True
+
+        if ttype == KEYWORD_TYPE:
+            self.type_flag = True
+        elif ttype == NAME_FUNCTION:
+            if self.type_flag:
+                self.declared_functions.add(value)
+            elif value not in self.declared_functions:
+                ptype = GENERIC
+        elif ttype != TEXT and ttype != COMMENT:
+            self.type_flag = False
+        return ptype
+
+
+def classify_tokens(token_generator):
+    """
+    Single pass equivalent of lex_passes.
+    A name is only held back until the next token that is not Text or Comment:
+    a following name makes it a type, a following '(' makes it a function.
+    """
+    type_names = {}
+    classifier = SymbolClassifier()
+    pending = []
+
+    for ttype, value in token_generator:
+        ptype = type_names.get(ttype)
+        if ptype is None:
+            ptype = type_names[ttype] = str(ttype)
+
+        if pending:
+            if ptype == TEXT or ptype == COMMENT:
+                pending.append((ptype, value))
+                continue
+            name = pending[0][1]
+            if ptype == NAME:
+                pending[0] = (KEYWORD_TYPE, name)
+            elif value == "(":
+                pending[0] = (NAME_FUNCTION, name)
+            for pending_type, pending_value in pending:
+                yield classifier.classify(pending_type, pending_value), pending_value
+            pending = []
+
+        if ptype == NAME:
+            pending.append((ptype, value))
+        else:
+            yield classifier.classify(ptype, value), value
+
+    for pending_type, pending_value in pending:
+        yield classifier.classify(pending_type, pending_value), pending_value
+
+
+def rename_symbol(value, prefix):
+    if value.startswith("_"):
+        return "_" + prefix + value
+    return prefix + "_" + value
+
+def is_blank(ptype):
+    """ Whitespace and comments, but not preprocessor lines. """
+    return ptype == TEXT or ptype == WHITESPACE or (ptype.startswith(COMMENT) and ptype != PREPROC)
+
+def tokenize_pygments(text):
+    import pygments
+    import pygments.lexers
+    lexer = pygments.lexers.get_lexer_by_name("glsl")
+    return pygments.lex(text, lexer)
+
+def lex_source(text):
+    return classify_tokens(tokenize(text))
+
+def lex_source_pygments(text):
+    return classify_tokens(tokenize_pygments(text))
@@ -2,15 +2,23 @@
 
 from tempfile import template
 from typing import Text
+import os
+import time
 import bpy
 from bpy.props import EnumProperty
+from bpy.app.handlers import persistent
 from BlenderMalt import MaltProperties
 from BlenderMalt import MaltMaterial
-from pygments.token import Comment, Generic, Keyword, Name, Operator, Other, Punctuation
 from enum import Enum
-import pygments
-import pygments.lexers
-
+from contextlib import contextmanager
+from . import BeerProfile
+from . import BeerSync
+from . import BeerScheduler
+from .BeerStore import get_shader_store, write_if_changed
+from . import BeerCompiler
+from . import BeerCost
+from .BeerCompiler import Blends, LayerSpec, StackSpec, compile_incremental
+from .BeerGraph import get_layer_inserts, get_layer_deletes, get_layer_moves
 
 
 def update_index(self, context):
@@ -30,6 +38,7 @@ def update_masking(self, context):
     else:
         self["masking_index"] = 0
         self["masked_layer"] = False
+    update_layer(self, context)
 
 def update_input(self, context):
     if self["index"]:
@@ -40,6 +49,72 @@ def update_input(self, context):
             self["input_index"] = 0
     else:
         self["input_index"] = 0
+    update_layer(self, context)
+
+def update_layer(self, context):
+    beer_mat = self.id_data.beer
+    if is_batched(beer_mat):
+        return
+    invalidate_compile_blocker(beer_mat)
+    request_auto_compile(beer_mat)
+
+def update_auto_compile(self, context):
+    request_auto_compile(self)
+
+def request_auto_compile(beer_mat):
+    if beer_mat.is_beer_mat and beer_mat.auto_compile:
+        BeerScheduler.request_compile(beer_mat)
+
+
+#Nesting depth of the open batches of each BEER material, keyed by pointer
+_batches = {}
+
+def is_batched(beer_mat):
+    return beer_mat.as_pointer() in _batches
+
+#Why each BEER material can not compile, keyed by pointer, with the pointers of its layer materials
+_compile_blockers = {}
+
+def invalidate_compile_blocker(beer_mat):
+    _compile_blockers.pop(beer_mat.as_pointer(), None)
+
+@persistent
+def on_depsgraph_update(scene, depsgraph):
+    if not _compile_blockers:
+        return
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Material):
+            pointer = update.id.original.as_pointer()
+            for key, (pointers, blocker) in list(_compile_blockers.items()):
+                if pointer in pointers:
+                    del _compile_blockers[key]
+
+@persistent
+def on_load(dummy):
+    _compile_blockers.clear()
+
+def regenerate_missing_shaders():
+    """
+    Compile the BEER materials whose generated shader is gone, like the shaders of a .blend saved on
+    another machine or evicted from the store since. The shaders still there are kept in the store.
+    """
+    store = get_shader_store()
+    for material in bpy.data.materials:
+        beer_mat = material.beer
+        if not beer_mat.is_beer_mat or not beer_mat.material:
+            continue
+        source_path = beer_mat.material.malt.shader_source
+        if source_path and os.path.isfile(bpy.path.abspath(source_path)):
+            if store is not None:
+                store.pin(bpy.path.abspath(source_path))
+        else:
+            BeerScheduler.request_compile(beer_mat)
+    return None
+
+@persistent
+def on_load_post(dummy):
+    #Run after the other load_post handlers, BeerScheduler.on_load drops the pending requests
+    bpy.app.timers.register(regenerate_missing_shaders, first_interval=0.0, persistent=True)
 
 
 def filter_beer(self, object):
@@ -56,20 +131,6 @@ void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
 }
 '''
 
-class Blends(Enum):
-    DEFAULT = 1
-    ADD = 2
-    SUBTRACT = 3
-    MULTIPLY = 4
-    DIVIDE = 5
-    SCREEN = 6
-    OVERLAY = 7
-    DIFFERENCE = 8
-    LIGHTEN = 9 
-    DARKEN = 10
-    DODGE = 11
-    BURN = 12
-
 def blend_enums():
     enum = []
     for blend_mode in Blends:
@@ -97,505 +158,17 @@ def layer_enum_to_index(enum):
     layer_index = enum.lstrip("LAYER")
     return int(layer_index)
 
-def get_prefix(index):
-    return "beergen" + str(index)
-
-def get_blend(blend):
-    if blend is Blends.DEFAULT:
-        return "blend_default"
-    if blend is Blends.ADD:
-        return "blend_add"
-    elif blend is Blends.SUBTRACT:
-        return "blend_subtract"
-    elif blend is Blends.MULTIPLY:
-        return "blend_multiply"
-    elif blend is Blends.DIVIDE:
-        return "blend_divide"
-    elif blend is Blends.SCREEN:
-        return "blend_screen"
-    elif blend is Blends.OVERLAY:
-        return "blend_overlay"
-    elif blend is Blends.DIFFERENCE:
-        return "blend_difference"
-    elif blend is Blends.LIGHTEN:
-        return "blend_lighten"
-    elif blend is Blends.DARKEN:
-        return "blend_darken"
-    elif blend is Blends.DODGE:
-        return "blend_dodge"
-    elif blend is Blends.BURN:
-        return "blend_burn"
-
-#using mix functions from blender/source/blender/gpu/shaders/material/gpu_shader_material_mix_rgb.glsl    
-def get_blend_source(blend):
-    if blend is Blends.DEFAULT:
-        return '''
-void blend_default(inout PixelOutput base, in PixelOutput blending){
-    base.line_color = alpha_blend(base.color, blending.line_color);
-    base.line_width = blending.line_width;
-    base.color = alpha_blend(base.color, blending.color);
-}
-        '''
-    elif blend is Blends.ADD:
-        return '''
-void mix_add(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    outcol = mix(col1, col1 + col2, fac);
-    outcol.a = col1.a;
-    }
-
-void blend_add(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_add(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_add(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.SUBTRACT:
-        return '''
-void mix_sub(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-  fac = clamp(fac, 0.0, 1.0);
-  outcol = mix(col1, col1 - col2, fac);
-  outcol.a = col1.a;
-}
-
-void blend_subtract(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_sub(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_sub(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.MULTIPLY:
-        return '''
-void mix_mult(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-  fac = clamp(fac, 0.0, 1.0);
-  outcol = mix(col1, col1 * col2, fac);
-  outcol.a = col1.a;
-}
-
-void blend_multiply(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_mult(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_mult(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.DIVIDE:
-        return '''
-void mix_div(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    float facm = 1.0 - fac;
-
-    outcol = col1;
-
-    if (col2.r != 0.0) {
-        outcol.r = facm * outcol.r + fac * outcol.r / col2.r;
-    }
-    if (col2.g != 0.0) {
-        outcol.g = facm * outcol.g + fac * outcol.g / col2.g;
-    }
-    if (col2.b != 0.0) {
-        outcol.b = facm * outcol.b + fac * outcol.b / col2.b;
-    }
-}
-
-void blend_divide(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_div(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_div(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.SCREEN:
-        return '''
-void mix_screen(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-  fac = clamp(fac, 0.0, 1.0);
-  float facm = 1.0 - fac;
-
-  outcol = vec4(1.0) - (vec4(facm) + fac * (vec4(1.0) - col2)) * (vec4(1.0) - col1);
-  outcol.a = col1.a;
-}
-
-void blend_screen(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_screen(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_screen(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.OVERLAY:
-        return '''
-void mix_overlay(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    float facm = 1.0 - fac;
-
-    outcol = col1;
-
-    if (outcol.r < 0.5) {
-        outcol.r *= facm + 2.0 * fac * col2.r;
-    }
-    else {
-        outcol.r = 1.0 - (facm + 2.0 * fac * (1.0 - col2.r)) * (1.0 - outcol.r);
-    }
-
-    if (outcol.g < 0.5) {
-        outcol.g *= facm + 2.0 * fac * col2.g;
-    }
-    else {
-        outcol.g = 1.0 - (facm + 2.0 * fac * (1.0 - col2.g)) * (1.0 - outcol.g);
-    }
-
-    if (outcol.b < 0.5) {
-        outcol.b *= facm + 2.0 * fac * col2.b;
-    }
-    else {
-        outcol.b = 1.0 - (facm + 2.0 * fac * (1.0 - col2.b)) * (1.0 - outcol.b);
-    }
-    }
-
-void blend_overlay(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_overlay(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_overlay(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.DIFFERENCE:
-        return '''
-void mix_diff(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    outcol = mix(col1, abs(col1 - col2), fac);
-    outcol.a = col1.a;
-}
-
-void blend_difference(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_diff(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_diff(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.LIGHTEN:
-        return '''
-void mix_light(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    outcol.rgb = mix(col1.rgb, max(col1.rgb, col2.rgb), fac);
-    outcol.a = col1.a;
-}
-
-void blend_lighten(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_light(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_light(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.DARKEN:
-        return '''
-void mix_dark(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    outcol.rgb = mix(col1.rgb, min(col1.rgb, col2.rgb), fac);
-    outcol.a = col1.a;
-}
-
-void blend_darken(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_dark(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_dark(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.DODGE:
-        return '''
-void mix_dodge(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    outcol = col1;
-
-    if (outcol.r != 0.0) {
-        float tmp = 1.0 - fac * col2.r;
-        if (tmp <= 0.0) {
-        outcol.r = 1.0;
-        }
-        else if ((tmp = outcol.r / tmp) > 1.0) {
-        outcol.r = 1.0;
-        }
-        else {
-        outcol.r = tmp;
-        }
-    }
-    if (outcol.g != 0.0) {
-        float tmp = 1.0 - fac * col2.g;
-        if (tmp <= 0.0) {
-        outcol.g = 1.0;
-        }
-        else if ((tmp = outcol.g / tmp) > 1.0) {
-        outcol.g = 1.0;
-        }
-        else {
-        outcol.g = tmp;
-        }
-    }
-    if (outcol.b != 0.0) {
-        float tmp = 1.0 - fac * col2.b;
-        if (tmp <= 0.0) {
-        outcol.b = 1.0;
-        }
-        else if ((tmp = outcol.b / tmp) > 1.0) {
-        outcol.b = 1.0;
-        }
-        else {
-        outcol.b = tmp;
-        }
-    }
-}
-
-void blend_dodge(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_dodge(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_dodge(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-    elif blend is Blends.BURN:
-        return '''
-void mix_burn(float fac, vec4 col1, vec4 col2, out vec4 outcol){
-    fac = clamp(fac, 0.0, 1.0);
-    float tmp, facm = 1.0 - fac;
-
-    outcol = col1;
-
-    tmp = facm + fac * col2.r;
-    if (tmp <= 0.0) {
-        outcol.r = 0.0;
-    }
-    else if ((tmp = (1.0 - (1.0 - outcol.r) / tmp)) < 0.0) {
-        outcol.r = 0.0;
-    }
-    else if (tmp > 1.0) {
-        outcol.r = 1.0;
-    }
-    else {
-        outcol.r = tmp;
-    }
-
-    tmp = facm + fac * col2.g;
-    if (tmp <= 0.0) {
-        outcol.g = 0.0;
-    }
-    else if ((tmp = (1.0 - (1.0 - outcol.g) / tmp)) < 0.0) {
-        outcol.g = 0.0;
-    }
-    else if (tmp > 1.0) {
-        outcol.g = 1.0;
-    }
-    else {
-        outcol.g = tmp;
-    }
-
-    tmp = facm + fac * col2.b;
-    if (tmp <= 0.0) {
-        outcol.b = 0.0;
-    }
-    else if ((tmp = (1.0 - (1.0 - outcol.b) / tmp)) < 0.0) {
-        outcol.b = 0.0;
-    }
-    else if (tmp > 1.0) {
-        outcol.b = 1.0;
-    }
-    else {
-        outcol.b = tmp;
-    }
-}
-
-void blend_burn(inout PixelOutput base, in PixelOutput blending){
-    base.line_width = blending.line_width;
-    mix_burn(blending.line_color.a, base.color, blending.line_color, base.line_color);
-
-    mix_burn(blending.color.a, base.color, blending.color, base.color);
-}
-        '''
-
-def lex_passes(token_generator):
-
-    tokens = list(token_generator)
-    r_tokens = reversed(tokens)
-    nu_tokens = []
-    mu_tokens = []
-
-    dot_flag = False
-    name_flag = False
-    type_flag = False
-    function_flag = False
-    comment_flag = False
-    declared_functions = []
-
-    for ttype, value in r_tokens:
-        ptype = str(ttype)
-        if str(ttype) == "Token.Name":
-            if function_flag:
-                ptype = "Token.Name.Function"
-            if not name_flag:
-                name_flag = True
-            else: 
-                ptype = "Token.Keyword.Type"
-        elif str(ttype) != "Token.Text" and str(ttype) != "Token.Comment":
-            name_flag = False
-            if str(value) == "(":
-                function_flag = True
-            else:
-                function_flag = False
-        nu_tokens.append((ptype, value))
-    nu_tokens.reverse()
-    tokens = nu_tokens.copy()
-    
-    for ttype, value in tokens:
-        ptype = str(ttype)
-        if comment_flag:
-            if '\n' in str(value) or '\r' in str(value):
-                comment_flag = False
-            else:
-                ptype = "Token.Comment"
-        else:
-            if str(value) == "#":
-                comment_flag = True
-            
-            if dot_flag:
-                if str(ttype) != "Token.Operator" and str(ttype) != "Token.Punctuation":
-                    ptype = "Token.Other"
-                else:
-                    dot_flag = False
-            if str(value) == ".":
-                dot_flag = True
-
-            if str(ttype) == "Token.Keyword.Type":
-                type_flag = True
-            else:
-                if str(ttype) == "Token.Name.Function":
-                    if type_flag:
-                        declared_functions.append(value)
-                    else:
-                        if str(value) not in declared_functions:
-                            ptype = "Token.Generic"
-                elif str(ttype) != "Token.Text" and str(ttype) != "Token.Comment":
-                    type_flag = False
-        print(ptype, value)
-        mu_tokens.append((ptype, value))
-
-    return mu_tokens
-    
-def compile_layer_source(layers):
-    compiled_source = []
-    compiled_source.append('#include "Pipelines/NPR_Pipeline.glsl"' + '\n')
-    for layer in layers:
-        index = layer.index
-        solo_layer = layer.solo_layer
-        mute_layer = layer.mute_layer
-        masked_layer = layer.masked_layer
-        masking_index = layer.masking_index
-        input_index = layer.input_index
-        material = layer.material
-        blend_mode =  layer.blend
-
-        documentation = (
-            "\n" + "/*"
-            + "\n" + "LAYER INFO = ["
-            + "\n" + "layer:" + str(index)
-            + "\n" + "solo:" + str(solo_layer)
-            + "\n" + "mute:" + str(mute_layer)
-            + "\n" + "masked:" + str(masked_layer)
-            + "\n" + "m_index:" + str(masking_index)
-            + "\n" + "i_index:" + str(input_index)
-             + "\n" + "blend_mode:" + str(blend_mode)
-            + "\n" + "]"
-            + "\n" + "*/" + "\n"
-            )
-
-        compiled_source.append(documentation)
-
-        source = material.malt.get_source_path()
-        shader = open(source)
-        lexer = pygments.lexers.get_lexer_by_name("glsl")
-        tokens = pygments.lex(shader.read(), lexer)
-        filtered_tokens = lex_passes(tokens)
-        for ttype, value in filtered_tokens:
-            if str(ttype) == "Token.Name" or str(ttype) == "Token.Name.Function":
-                if str(value) != "location":
-                    private_mod = ""
-                    prefix_suff = "_"
-                    if str(value).startswith("_"):
-                        private_mod = "_"
-                        prefix_suff = ""
-                    value = private_mod + get_prefix(index) + prefix_suff + value
-            compiled_source.append(value)
-    return compiled_source
-
-
-def compile_function_source(layers):
-    compiled_util = []
-    compiled_function = []
-    used_blendmodes = []
-
-    compiled_function.append("""
-        void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)\n
-        {\n
-            PixelOutput beergen0_layer = PO;\n
-            PixelOutput compilation_layer = PO;\n
-        """)
-
-    for layer in layers:
-        index = layer.index
-        solo_layer = layer.solo_layer
-        mute_layer = layer.mute_layer
-        masked_layer = layer.masked_layer
-        masking_index = layer.masking_index
-        input_index = layer.input_index
-        blend_mode =  layer.blend
-        blend_mode = Blends[layer.blend]
-
-        if blend_mode not in used_blendmodes:
-            used_blendmodes.append(blend_mode)
-
-        compiled_function.append("PixelOutput " + get_prefix(index) + "_" + "layer = " + get_prefix(input_index) + "_" + "layer;" + "\n")
-        compiled_function.append(get_prefix(index) + "_" + "COMMON_PIXEL_SHADER(S, " + get_prefix(index) + "_" + "layer);" + "\n")
-        if masked_layer: 
-            compiled_function.append(get_prefix(index) + "_" + "layer.color *= " + get_prefix(masking_index) + "_" + "layer.g;" + "\n")
-        if not mute_layer:
-            if solo_layer:
-                compiled_function.append("compilation_layer = " + get_prefix(index) + "_" + "layer;" + "\n")
-            else: 
-                compiled_function.append(get_blend(blend_mode) + "(compilation_layer, " + get_prefix(index) + "_" + "layer);" + "\n")
-        
-    compiled_function.append("""
-            PO = compilation_layer;\n
-        }\n
-        
-        """)
-
-    for used_blend in used_blendmodes:
-        compiled_util.append(get_blend_source(used_blend))
-
-    return compiled_util + compiled_function
-
-def compile_full_source(layers):
-    print("compiling")
-    print("compiling layer shaders")
-    layer_source = compile_layer_source(layers)
-    print("compiling function")
-    function_source = compile_function_source(layers)
-    print("compiling complete")
-    return layer_source + function_source
-
-
 class BeerLayer(bpy.types.PropertyGroup):
     index: bpy.props.IntProperty(update=update_index, default=1)
-    solo_layer : bpy.props.BoolProperty(name="Solo", default=False)
-    mute_layer : bpy.props.BoolProperty(name="Mute", default=False)
-    masked_layer : bpy.props.BoolProperty(name="Mask", default=False)
+    solo_layer : bpy.props.BoolProperty(name="Solo", default=False, update=update_layer)
+    mute_layer : bpy.props.BoolProperty(name="Mute", default=False, update=update_layer)
+    masked_layer : bpy.props.BoolProperty(name="Mask", default=False, update=update_layer)
     masking_index : bpy.props.IntProperty(name="Masking Layer", update=update_masking, default=0)
     input_index : bpy.props.IntProperty(name="Input Layer", update=update_input, default=0)
-    material : bpy.props.PointerProperty(type=bpy.types.Material, poll=filter_beer)
-    blend : bpy.props.EnumProperty(name="Blend Mode", items=blend_enums(), default="DEFAULT")
+    material : bpy.props.PointerProperty(type=bpy.types.Material, poll=filter_beer, update=update_layer)
+    blend : bpy.props.EnumProperty(name="Blend Mode", items=blend_enums(), default="DEFAULT", update=update_layer)
+    select : bpy.props.BoolProperty(name="Select", default=False,
+        description="Include the layer in move and delete operations")
 
     def mat_setup(self, material):
         self["material"] = material
@@ -622,18 +195,35 @@ class BeerLayer(bpy.types.PropertyGroup):
             row.operator('beer.compile_layers', text='Update BEER Material')
 
     def reindex(self, index):
-        self["index"] = index+1
+        if self.get("index") != index+1:
+            self["index"] = index+1
 
 class BeerMaterial(bpy.types.PropertyGroup):
     layers : bpy.props.CollectionProperty(name="Shader", type=BeerLayer)
     material : bpy.props.PointerProperty(type=bpy.types.Material)
     is_beer_mat : bpy.props.BoolProperty(name="BEER Material", default=False)
     shader_index : bpy.props.IntProperty(name="BEER Material", default=0)
+    auto_compile : bpy.props.BoolProperty(name="Auto Compile", default=False, update=update_auto_compile,
+        description="Recompile in the background when layers or their shader files change")
+    mask_early_out : bpy.props.BoolProperty(name="Mask Early Out", default=False, update=update_auto_compile,
+        description="Skip the shader of masked layers on the pixels where their mask is zero")
+    parameter_mode : bpy.props.EnumProperty(name="Parameters", default="LIVE", update=update_auto_compile,
+        items=(('LIVE', "Live", "Layer parameters are uniforms, edits show without a recompile"),
+            ('BAKE', "Baked", "Layer parameters are compiled in as constants, for final renders")),
+        description="Keep layer parameters as uniforms, or bake their current values into the shader")
 
     def draw_ui(self, layout):
         
         row = layout.row() 
         row.operator('beer.compile_layers', text='Update BEER Material')
+        row.prop(self, "auto_compile")
+        layout.operator('beer.compile_all_materials')
+        row = layout.row()
+        row.prop(self, "mask_early_out")
+        layout.prop(self, "parameter_mode")
+        blocker = self.get_compile_blocker()
+        if blocker is not None:
+            layout.label(text=blocker[1], icon='ERROR')
         row = layout.row()
 
         row.template_list("BEER_UL_LayerList", "", self, "layers", self, "shader_index")
@@ -642,6 +232,7 @@ class BeerMaterial(bpy.types.PropertyGroup):
 
         col.operator("beer.new_layer", icon='ADD', text="")
         col.operator("beer.delete_layer", icon='REMOVE', text="")
+        col.operator("beer.import_layers", icon='IMPORT', text="")
 
         col.separator()
 
@@ -671,47 +262,210 @@ class BeerMaterial(bpy.types.PropertyGroup):
         return os.path.join(self.get_generated_source_dir(),'{}-{}{}'.format(file_prefix, self["material"].name, ".mesh.glsl"))
 
     def update_file(self, source):
-        source_dir = self.get_generated_source_dir()
-        source_path = self.get_generated_source_path()
-        import pathlib
-        pathlib.Path(source_dir).mkdir(parents=True, exist_ok=True)
-        with open(source_path,'w') as f:
-            f.write(source)
-        self.copy_properties()
-        return source_path
+        """ Point the material at the generated source. Returns True when Malt has to recompile it. """
+        store = get_shader_store()
+        with BeerProfile.stage("file_write"):
+            if store is not None:
+                #Stored shaders are named after their content, an existing file never changes
+                source_path = store.put(source)
+                written = False
+            else:
+                source_path = self.get_generated_source_path()
+                written = write_if_changed(source_path, source)
+        report = self.get_compile_report()
+        if report is not None:
+            #Kept with the .blend, so BeerSync can undo a cull before the first compile of a session
+            self["opaque_layers"] = list(report.get("opaque", ()))
+        recompile = written or self.material.malt.shader_source != source_path
+        if self.material.malt.shader_source != source_path:
+            self.material.malt.shader_source = source_path
+        record = BeerProfile.get_current_record() or BeerProfile.get_last_record(self.material.name)
+        if record is not None:
+            record.recompile = recompile
+        with BeerProfile.stage("property_copy"):
+            self.copy_properties()
+        return recompile
         
     def mat_setup(self, material ):
         self["material"] = material
         self["is_beer_mat"] = True
-        material.malt.shader_source = self.update_file(default_shader)
-
-    def index_layers(self):
-        index = 0
-        while index < len(self.layers):
-            self.layers[index].reindex(index)
-            name = "Layer " + str(self.layers[index].index)
-            if self.layers[index].material:
-                name = name + " - " + str(self.layers[index].material.name)
-            self.layers[index].name = name
-            index = index + 1
-
-    def copy_layer_property(self, layer):
-        overrides = {}
-        resources = {}
-        layer_parameters = layer.material.malt.parameters.get_parameters(resources, overrides)
-        for key, value in layer_parameters.items():
-            private_mod = ""
-            prefix_suff = "_"
-            if str(key).startswith("_"):
-                private_mod = "_"
-                prefix_suff = ""
-            new_key = private_mod + get_prefix(layer["index"]) + prefix_suff + key
-            if new_key in self.material.malt.parameters: 
-                self.material.malt.parameters[new_key] = value
+        self.update_file(default_shader)
+
+    def index_layers(self, start=0, stop=None):
+        """ Number and name the layers from start to stop, the layers outside the range are left as they are. """
+        if stop is None:
+            stop = len(self.layers)
+        for index in range(start, min(stop, len(self.layers))):
+            layer = self.layers[index]
+            layer.reindex(index)
+            name = "Layer {}".format(index + 1)
+            if layer.material:
+                name = "{} - {}".format(name, layer.material.name)
+            if layer.name != name:
+                layer.name = name
+        if not is_batched(self):
+            invalidate_compile_blocker(self)
+            request_auto_compile(self)
+
+    @contextmanager
+    def batch(self):
+        """ Suppress the layer update callbacks, running them once when the outermost batch ends. """
+        key = self.as_pointer()
+        _batches[key] = _batches.get(key, 0) + 1
+        try:
+            yield self
+        finally:
+            _batches[key] -= 1
+            if _batches[key] == 0:
+                del _batches[key]
+                invalidate_compile_blocker(self)
+                request_auto_compile(self)
+
+    def get_selected_indices(self):
+        """ Positions of the selected layers, or of the active layer when none is selected. """
+        indices = [index for index, layer in enumerate(self.layers) if layer.select]
+        if not indices and 0 <= self.shader_index < len(self.layers):
+            indices = [self.shader_index]
+        return indices
+
+    def insert_layers(self, position=None, count=1, materials=None):
+        """ Insert count layers at position, or one layer for each of materials. Returns the new positions. """
+        if materials is not None:
+            count = len(materials)
+        moves, positions = get_layer_inserts(len(self.layers), position, count)
+        with self.batch():
+            for offset in range(count):
+                self.layers.add()
+            for index, target in moves:
+                self.layers.move(index, target)
+            if materials is not None:
+                for position, material in zip(positions, materials):
+                    self.layers[position].material = material
+            if positions:
+                self.index_layers(positions[0])
+        return positions
+
+    def delete_layers(self, indices):
+        indices, active = get_layer_deletes(len(self.layers), indices, self.shader_index)
+        if not indices:
+            return
+        with self.batch():
+            for index in indices:
+                self.layers.remove(index)
+            self.index_layers(indices[-1])
+            self.shader_index = active
+
+    def move_layers(self, indices, offset):
+        """
+        Move the layers at indices by offset positions, keeping their order.
+        Layers stop at the ends of the stack and at the layers moved before them. Returns the new positions.
+        """
+        moves, positions, active = get_layer_moves(len(self.layers), indices, offset, self.shader_index)
+        if not moves:
+            return positions
+        with self.batch():
+            for index, target in moves:
+                self.layers.move(index, target)
+            moved = [position for move in moves for position in move]
+            self.index_layers(min(moved), max(moved) + 1)
+            self.shader_index = active
+        return positions
+
+    def find_compile_blocker(self):
+        if not self.layers:
+            return (None, "No layers to compile")
+        for layer in self.layers:
+            if not layer.material:
+                return (layer.index, "Layer {} has no material".format(layer.index))
+            if not layer.material.malt.get_source_path().endswith('.mesh.glsl'):
+                return (layer.index, "Layer {} is not a mesh shader".format(layer.index))
+            if layer.material.malt.compiler_error != '':
+                return (layer.index, "Layer {} has compile errors".format(layer.index))
+        return None
+
+    def get_compile_blocker(self):
+        """ (layer index, message) of the first layer that stops the stack from compiling, or None. """
+        key = self.as_pointer()
+        entry = _compile_blockers.get(key)
+        if entry is None:
+            pointers = frozenset(layer.material.as_pointer() for layer in self.layers if layer.material)
+            entry = (pointers, self.find_compile_blocker())
+            _compile_blockers[key] = entry
+        return entry[1]
+
+    def can_compile(self):
+        return self.get_compile_blocker() is None
+
+    def get_layer_specs(self):
+        """ LayerSpec of every layer, with the opacity of its current parameters and the values to bake. """
+        layers = []
+        for layer in self.layers:
+            spec = LayerSpec.from_layer(layer)
+            spec.opaque = BeerSync.get_layer_opacity(layer.material)
+            if self.parameter_mode == "BAKE":
+                spec.baked = BeerSync.get_bake_values(layer.material)
+            layers.append(spec)
+        return layers
+
+    def get_stack_spec(self):
+        return StackSpec(self.material.name, self.get_layer_specs(),
+            mask_early_out=self.mask_early_out)
+
+    def compile_incremental(self):
+        """ Compile the layer stack, regenerating only the layers whose state changed. """
+        layers = self.get_layer_specs()
+        return compile_incremental(self.as_pointer(), layers, store=get_shader_store(),
+            mask_early_out=self.mask_early_out)
+
+    def get_compile_report(self):
+        return BeerCompiler.compile_reports.get(self.as_pointer())
+
+    def get_cost(self):
+        """ BeerCost.StackCost of the generated shader, None before the first compile. """
+        if not self.material or not self.material.malt.shader_source:
+            return None
+        return BeerCost.analyze_file(bpy.path.abspath(self.material.malt.shader_source))
+
+    def invalidate_layer_code(self):
+        BeerCompiler.layer_code_cache.pop(self.as_pointer(), None)
 
     def copy_properties(self):
-        for layer in self.layers:
-            self.copy_layer_property(layer)
+        #Later edits of the layer materials are pushed by BeerSync as they happen
+        BeerSync.link_material(self)
+
+def compile_materials(materials=None, jobs=None):
+    """
+    Compile BEER materials in one batch, every BEER material of the file when materials is None.
+    The sources are generated by BeerCompiler.compile_batch, in jobs worker processes, the CPU count when None.
+    They are then written back to the materials here, on the main thread.
+    Returns the wall time and, for each material, its compile and write time or why it failed.
+    """
+    start = time.perf_counter()
+    if materials is None:
+        materials = bpy.data.materials
+    batch = []
+    compiled = []
+    for material in materials:
+        beer_mat = material.beer
+        if not beer_mat.is_beer_mat:
+            continue
+        blocker = beer_mat.get_compile_blocker()
+        entry = {"name" : material.name, "time" : 0.0, "error" : blocker[1] if blocker is not None else None}
+        batch.append(entry)
+        if blocker is None:
+            BeerScheduler.cancel_compile(beer_mat)
+            compiled.append((beer_mat, entry))
+    requests = [(beer_mat.as_pointer(), beer_mat.get_stack_spec()) for beer_mat, entry in compiled]
+    results = BeerCompiler.compile_batch(requests, jobs, get_shader_store())
+    for (beer_mat, entry), result in zip(compiled, results):
+        entry["error"] = result["error"]
+        entry["time"] = result["time"]
+        if result["error"] is None:
+            write_start = time.perf_counter()
+            beer_mat.update_file(result["source"])
+            entry["time"] += time.perf_counter() - write_start
+    return {"wall_time" : time.perf_counter() - start, "materials" : batch}
+
 
 class BeerMaterialOperator(bpy.types.Operator):
     bl_idname = "material.new_beer"
@@ -736,6 +490,7 @@ class BEER_UL_LayerList(bpy.types.UIList):
 
         # Make sure your code supports all 3 layout types
         if self.layout_type in {'DEFAULT', 'COMPACT'}:
+            layout.prop(item, "select", text="")
             layout.label(text=item.name, icon = custom_icon)
 
         elif self.layout_type in {'GRID'}:
@@ -748,42 +503,72 @@ class LayerNewOperator(bpy.types.Operator):
 
     bl_idname = "beer.new_layer"
     bl_label = "Add a new layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    count: bpy.props.IntProperty(name="Count", default=1, min=1)
 
     def execute(self, context):
-        ob = context.object
-        ob.active_material.beer.layers.add()
-        ob.active_material.beer.index_layers()
+        beer_mat = context.object.active_material.beer
+        beer_mat.insert_layers(count=self.count)
+
+        return{'FINISHED'}
+
+
+class LayerImportOperator(bpy.types.Operator):
+    """Add a layer for each selected mesh shader, with a new Malt material."""
+
+    bl_idname = "beer.import_layers"
+    bl_label = "Import Layers"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    directory: bpy.props.StringProperty(subtype='DIR_PATH')
+    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement)
+    filter_glob: bpy.props.StringProperty(default="*.mesh.glsl", options={'HIDDEN'})
+
+    def execute(self, context):
+        import os
+        materials = []
+        for file in sorted(file.name for file in self.files):
+            if not file.endswith('.mesh.glsl'):
+                continue
+            material = bpy.data.materials.new(name=file[:-len('.mesh.glsl')])
+            material.malt.shader_source = os.path.join(self.directory, file)
+            materials.append(material)
+        beer_mat = context.object.active_material.beer
+        beer_mat.insert_layers(materials=materials)
+        self.report({'INFO'}, "Imported {} layers".format(len(materials)))
 
         return{'FINISHED'}
 
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
 
 class LayerDeleteOperatorOperator(bpy.types.Operator):
-    """Delete the selected item from the list."""
+    """Delete the selected items from the list, or the active one when none is selected."""
 
     bl_idname = "beer.delete_layer"
     bl_label = "Deletes an item"
+    bl_options = {'REGISTER', 'UNDO'}
 
     @classmethod
     def poll(cls, context):
         return context.object.active_material.beer.layers
 
     def execute(self, context):
-        layers = context.object.active_material.beer.layers
-        shader_index =  context.object.active_material.beer.shader_index
-
-        
-        layers.remove(shader_index)
-        context.object.active_material.beer.shader_index = min(max(0, shader_index - 1), len(layers) - 1)
-        context.object.active_material.beer.index_layers()
+        beer_mat = context.object.active_material.beer
+        beer_mat.delete_layers(beer_mat.get_selected_indices())
 
         return{'FINISHED'}
 
 
 class LayerMoveOperator(bpy.types.Operator):
-    """Move an item in the list."""
+    """Move the selected items in the list, or the active one when none is selected."""
 
     bl_idname = "beer.move_layer"
     bl_label = "Move an item in the list"
+    bl_options = {'REGISTER', 'UNDO'}
 
     direction: bpy.props.EnumProperty(items=(('UP', 'Up', ""),
                                               ('DOWN', 'Down', ""),))
@@ -791,74 +576,158 @@ class LayerMoveOperator(bpy.types.Operator):
     def poll(cls, context):
         return context.object.active_material.beer.layers
 
-    def move_index(self, context):
-        """ Move index of an item render queue while clamping it. """
-
-        index = context.object.active_material.beer.shader_index
-        list_length = len(context.object.active_material.beer.layers) - 1  # (index starts at 0)
-        new_index = index + (-1 if self.direction == 'UP' else 1)
-
-        context.object.active_material.beer.shader_index = max(0, min(new_index, list_length))
-
     def execute(self, context):
-        layers = context.object.active_material.beer.layers
-        index = context.object.active_material.beer.shader_index
-
-        neighbor = index + (-1 if self.direction == 'UP' else 1)
-        layers.move(neighbor, index)
-        self.move_index(context)
-        context.object.active_material.beer.index_layers()
+        beer_mat = context.object.active_material.beer
+        beer_mat.move_layers(beer_mat.get_selected_indices(), -1 if self.direction == 'UP' else 1)
 
         return{'FINISHED'}
 
+
 class CompileLayerOperator(bpy.types.Operator):
     bl_idname = "beer.compile_layers"
     bl_label = "Update the BEER Material."
 
     @classmethod
     def poll(cls, context):
-        layers = context.object.active_material.beer.layers
-        if layers:
-            safe = True
-            for layer in layers:
-                if layer.material:
-                    layer_safe = layer.material.malt.get_source_path().endswith('.mesh.glsl')
-                    layer_safe = layer_safe and layer.material.malt.compiler_error == ''
-                    safe = safe and layer_safe
-                else: 
-                    return False
-            return safe
-        return False
+        blocker = context.object.active_material.beer.get_compile_blocker()
+        if blocker is not None and hasattr(cls, "poll_message_set"):
+            cls.poll_message_set(blocker[1])
+        return blocker is None
 
     def execute(self, context):
         beer_mat = context.object.active_material.beer
-        layers = beer_mat.layers
-        compiled_source = "".join(compile_full_source(layers))
-        print("saving source")
-        beer_mat.update_file(compiled_source)
-        print("finished")
+        BeerScheduler.cancel_compile(beer_mat)
+        with BeerProfile.record_compile(beer_mat.material.name) as record:
+            compiled_source = beer_mat.compile_incremental()
+            beer_mat.update_file(compiled_source)
+        message = record.summary()
+        report = beer_mat.get_compile_report()
+        if report["pruned"]:
+            message += ", pruned unreachable layers " + ", ".join(str(index) for index in report["pruned"])
+        message += ", {} live layer outputs at most".format(report["peak_live_outputs"])
+        if report["baked"]:
+            message += ", baked {} uniforms".format(sum(len(names) for names in report["baked"].values()))
+        self.report({'INFO'}, message)
+        return{'FINISHED'}
+
+
+class CompileAllMaterialsOperator(bpy.types.Operator):
+    """Update every BEER material, generating their shaders in parallel."""
+
+    bl_idname = "beer.compile_all_materials"
+    bl_label = "Update All BEER Materials"
+
+    selected_only : bpy.props.BoolProperty(name="Selected Only", default=False,
+        description="Only update the BEER materials of the selected objects")
+    jobs : bpy.props.IntProperty(name="Jobs", default=0, min=0,
+        description="Worker processes generating the shaders, 0 for the CPU count")
+
+    @classmethod
+    def poll(cls, context):
+        return any(material.beer.is_beer_mat for material in bpy.data.materials)
+
+    def execute(self, context):
+        materials = None
+        if self.selected_only:
+            materials = list(dict.fromkeys(slot.material for ob in context.selected_objects
+                for slot in ob.material_slots if slot.material))
+        batch = compile_materials(materials, self.jobs or None)
+        updated = 0
+        for entry in batch["materials"]:
+            if entry["error"] is not None:
+                self.report({'WARNING'}, "{}: {}".format(entry["name"], entry["error"]))
+            else:
+                updated += 1
+                self.report({'INFO'}, "{}: {:.2f} ms".format(entry["name"], entry["time"] * 1000.0))
+        self.report({'INFO'}, "Updated {} of {} BEER materials in {:.2f} ms".format(
+            updated, len(batch["materials"]), batch["wall_time"] * 1000.0))
+        return{'FINISHED'}
+
+
+class ExportCompileTraceOperator(bpy.types.Operator):
+    """Export the timings of the last BEER compile of the active material as a JSON trace."""
+
+    bl_idname = "beer.export_compile_trace"
+    bl_label = "Export BEER Compile Trace"
+
+    filepath : bpy.props.StringProperty(subtype='FILE_PATH')
+
+    @classmethod
+    def poll(cls, context):
+        ob = context.object
+        return ob is not None and ob.active_material is not None and BeerProfile.get_last_record(ob.active_material.name) is not None
+
+    def execute(self, context):
+        record = BeerProfile.get_last_record(context.object.active_material.name)
+        record.export_json(bpy.path.abspath(self.filepath))
+        return{'FINISHED'}
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "beer_compile_trace.json"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+class ShaderStoreCleanupOperator(bpy.types.Operator):
+    """Trim the shared store of generated BEER shaders."""
+
+    bl_idname = "beer.shader_store_cleanup"
+    bl_label = "Clean Up BEER Shader Store"
+
+    clear : bpy.props.BoolProperty(name="Clear", default=False,
+        description="Remove every stored shader not used in this session, not only the ones over the size cap")
+
+    @classmethod
+    def poll(cls, context):
+        return get_shader_store() is not None
+
+    def execute(self, context):
+        store = get_shader_store()
+        removed = store.clear() if self.clear else store.cleanup()
+        stats = store.stats()
+        self.report({'INFO'}, "Removed {} files, {} shaders stored in {:.1f} MB".format(
+            removed, stats["files"], stats["bytes"] / (1024.0 * 1024.0)))
         return{'FINISHED'}
 
 
 def register():
     bpy.utils.register_class(BeerMaterialOperator)
     bpy.utils.register_class(CompileLayerOperator)
+    bpy.utils.register_class(CompileAllMaterialsOperator)
+    bpy.utils.register_class(ExportCompileTraceOperator)
+    bpy.utils.register_class(ShaderStoreCleanupOperator)
     bpy.utils.register_class(BEER_UL_LayerList)
     bpy.utils.register_class(LayerNewOperator)
+    bpy.utils.register_class(LayerImportOperator)
     bpy.utils.register_class(LayerDeleteOperatorOperator)
     bpy.utils.register_class(LayerMoveOperator)
     bpy.utils.register_class(BeerLayer)
     bpy.utils.register_class(BeerMaterial)
     bpy.types.Material.beer = bpy.props.PointerProperty(type=BeerMaterial)
+    bpy.app.handlers.depsgraph_update_post.append(on_depsgraph_update)
+    bpy.app.handlers.load_post.append(on_load)
+    bpy.app.handlers.load_post.append(on_load_post)
+    bpy.app.handlers.undo_post.append(on_load)
+    bpy.app.handlers.redo_post.append(on_load)
 
 
 def unregister():
+    bpy.app.handlers.redo_post.remove(on_load)
+    bpy.app.handlers.undo_post.remove(on_load)
+    bpy.app.handlers.load_post.remove(on_load_post)
+    bpy.app.handlers.load_post.remove(on_load)
+    bpy.app.handlers.depsgraph_update_post.remove(on_depsgraph_update)
     del bpy.types.Material.beer
     bpy.utils.unregister_class(BeerMaterial)
     bpy.utils.unregister_class(BeerLayer)
     bpy.utils.unregister_class(LayerMoveOperator)
     bpy.utils.unregister_class(LayerDeleteOperatorOperator)
+    bpy.utils.unregister_class(LayerImportOperator)
     bpy.utils.unregister_class(LayerNewOperator)
     bpy.utils.unregister_class(BEER_UL_LayerList)
+    bpy.utils.unregister_class(ShaderStoreCleanupOperator)
+    bpy.utils.unregister_class(ExportCompileTraceOperator)
+    bpy.utils.unregister_class(CompileAllMaterialsOperator)
     bpy.utils.unregister_class(CompileLayerOperator)
     bpy.utils.unregister_class(BeerMaterialOperator)
\ No newline at end of file
@@ -0,0 +1,269 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Proves from its source that a layer always outputs alpha 1, in both PO.color and PO.line_color.
+# Only the top level statements of COMMON_PIXEL_SHADER are followed. The last write of each alpha
+# has to be a literal 1, or a uniform, then the layer is opaque while that uniform is 1.
+# Writes under a branch or a loop, early returns and calls that take PO make the proof fail.
+
+from collections import OrderedDict
+from .BeerLexer import NAME, NAME_FUNCTION, KEYWORD_TYPE, OPERATOR, GENERIC, PREPROC, tokenize
+from .BeerTree import ENTRY_POINT, significant, get_layer_tree
+from .BeerUniforms import parse_default
+
+ALPHA_FIELDS = ("color", "line_color")
+ALPHA_SWIZZLES = ("a", "w", "q")
+SWIZZLE_COMPONENTS = {"x" : 0, "y" : 1, "z" : 2, "w" : 3, "r" : 0, "g" : 1, "b" : 2, "a" : 3, "s" : 0, "t" : 1, "p" : 2, "q" : 3}
+SCALAR_TYPES = ("float", "int", "uint")
+VECTOR_SIZES = {"vec4" : 4, "vec3" : 3, "vec2" : 2}
+
+#Source paths and their last analysis, read by BeerSync to check the opacity of a layer against its parameters
+source_alpha = {}
+
+
+class LayerAlpha():
+    """ The uniform values a layer needs to be opaque, as (name, component) pairs, component None for scalars. """
+
+    def __init__(self, requirements, defaults):
+        self.requirements = requirements
+        self.names = frozenset(name for name, component in requirements)
+        self.defaults = defaults
+
+    def is_opaque(self, values=None):
+        """ Whether the layer is opaque with the given uniform values, the source defaults filling the others. """
+        for name, component in self.requirements:
+            value = values.get(name) if values is not None else None
+            if value is None:
+                value = self.defaults.get(name)
+                if value is None:
+                    return False
+            if component is not None:
+                try:
+                    value = value[component]
+                except (TypeError, IndexError):
+                    return False
+            elif not isinstance(value, (int, float)):
+                try:
+                    value = value[0] if len(value) == 1 else None
+                except TypeError:
+                    return False
+            if value != 1.0:
+                return False
+        return True
+
+
+def split_arguments(sig):
+    """ The comma separated arguments of a token list, split at depth 0. """
+    arguments = [[]]
+    depth = 0
+    for token in sig:
+        value = token[1]
+        if value in ("(", "["):
+            depth += 1
+        elif value in (")", "]"):
+            depth -= 1
+        if value == "," and depth == 0:
+            arguments.append([])
+        else:
+            arguments[-1].append(token)
+    return arguments
+
+def is_call(sig, start):
+    """ Whether the parenthesis at start opens the arguments of a call that can write them, not a constructor. """
+    return start > 0 and sig[start - 1][0] in (NAME_FUNCTION, GENERIC, NAME)
+
+
+class AlphaAnalysis():
+
+    def __init__(self, tree):
+        self.uniforms = {}
+        self.macros = {}
+        for declaration in tree.declarations:
+            if declaration.kind == "uniform" and declaration.name and declaration.uniform_type and not declaration.conditional:
+                if not declaration.array:
+                    self.uniforms[declaration.name] = declaration
+            elif declaration.kind == "preproc" and declaration.name == "#define":
+                words = declaration.tokens[0][1].split(None, 2)
+                if len(words) == 3 and "(" not in words[1]:
+                    self.macros[words[1]] = words[2]
+
+    def expand(self, sig, depth=0):
+        """ A single object-like macro is replaced by its tokens. """
+        if len(sig) == 1 and sig[0][1] in self.macros and depth < 8:
+            expanded = significant(list(tokenize(self.macros[sig[0][1]])))
+            return self.expand(expanded, depth + 1)
+        return sig
+
+    def get_scalar(self, sig):
+        sig = self.expand(sig)
+        if len(sig) == 1:
+            ptype, value = sig[0]
+            if ptype.startswith("Token.Literal.Number"):
+                try:
+                    number = float(value.rstrip("fFuU"))
+                except ValueError:
+                    return None
+                return frozenset() if number == 1.0 else None
+            uniform = self.uniforms.get(value)
+            if uniform is not None and uniform.uniform_type in SCALAR_TYPES:
+                return frozenset(((value, None),))
+            return None
+        if len(sig) == 3 and sig[1][1] == "." and sig[2][1] in SWIZZLE_COMPONENTS:
+            uniform = self.uniforms.get(sig[0][1])
+            if uniform is not None and uniform.uniform_type in VECTOR_SIZES:
+                return frozenset(((sig[0][1], SWIZZLE_COMPONENTS[sig[2][1]]),))
+        return None
+
+    def get_vec4(self, sig):
+        """ The requirements for the alpha of a vec4 expression to be 1, None when it can not be proven. """
+        sig = self.expand(sig)
+        if len(sig) == 1:
+            uniform = self.uniforms.get(sig[0][1])
+            if uniform is not None and uniform.uniform_type == "vec4":
+                return frozenset(((sig[0][1], 3),))
+            return None
+        if len(sig) < 4 or sig[0][1] != "vec4" or sig[1][1] != "(" or sig[-1][1] != ")":
+            return None
+        arguments = split_arguments(sig[2:-1])
+        if len(arguments) == 1:
+            #vec4(x) only fills alpha with x when x is a scalar
+            return self.get_scalar(arguments[0])
+        #With several arguments, a scalar last argument is the alpha
+        return self.get_scalar(arguments[-1])
+
+    def analyze(self, function):
+        sig = significant(function.tokens)
+        values = [value for ptype, value in sig]
+        if "{" not in values:
+            return None
+        param_names = function.get_param_names()
+        output = None
+        param_sig = sig[values.index("(") + 1 : values.index(")")]
+        for argument in split_arguments(param_sig):
+            argument_values = [value for ptype, value in argument]
+            if "PixelOutput" in argument_values:
+                output = argument_values[-1]
+        if output is None or output not in param_names:
+            return None
+        for text in self.macros.values():
+            if output in text:
+                return None
+        #Locals and parameters hide the uniforms of the same name
+        for index, (ptype, value) in enumerate(sig):
+            if ptype == NAME and index > 0 and sig[index - 1][0] == KEYWORD_TYPE:
+                self.uniforms.pop(value, None)
+        for name in param_names:
+            self.uniforms.pop(name, None)
+
+        body = sig[values.index("{") + 1 : -1]
+        state = {"color" : None, "line_color" : None}
+        depth = 0
+        statement = []
+        for index, token in enumerate(body):
+            ptype, value = token
+            if ptype == PREPROC:
+                return None
+            if value == "return" and index < len(body) - 2:
+                return None
+            if value == "{":
+                depth += 1
+            elif value == "}":
+                depth -= 1
+            statement.append(token)
+            if value in (";", "{", "}"):
+                if not self.apply(statement, output, state, depth == 0 and value == ";"):
+                    return None
+                statement = []
+        if state["color"] is None or state["line_color"] is None:
+            return None
+        return state["color"] | state["line_color"]
+
+    def apply(self, statement, output, state, top_level):
+        """ Update state with the writes of a statement to the output, False when it writes all of it. """
+        target = None
+        for index, (ptype, value) in enumerate(statement):
+            if value != output or ptype != NAME:
+                continue
+            field = None
+            swizzle = None
+            end = index + 1
+            if end + 1 < len(statement) and statement[end][1] == ".":
+                field = statement[end + 1][1]
+                end += 2
+                if end + 1 < len(statement) and statement[end][1] == ".":
+                    swizzle = statement[end + 1][1]
+                    end += 2
+            if field is not None and field not in ALPHA_FIELDS:
+                continue
+            following = statement[end][1] if end < len(statement) else None
+            after = statement[end + 1][1] if end + 1 < len(statement) else None
+            #Assignments, compound assignments, increments and indexed writes
+            writes = following in ("=", "[") or (statement[end][0] == OPERATOR and (after == "="
+                or (following in ("+", "-") and after == following)))
+            if index > 1 and statement[index - 1][1] in ("+", "-") and statement[index - 2][1] == statement[index - 1][1]:
+                writes = True
+            if index > 0 and statement[index - 1][1] in ("(", ","):
+                #An argument of a call can be an out parameter, constructors only read
+                open_index = index - 1
+                nesting = 0
+                while open_index >= 0:
+                    open_value = statement[open_index][1]
+                    if open_value == ")":
+                        nesting += 1
+                    elif open_value == "(":
+                        if nesting == 0:
+                            break
+                        nesting -= 1
+                    open_index -= 1
+                if open_index >= 0 and is_call(statement, open_index):
+                    writes = True
+            if not writes:
+                continue
+            if swizzle is not None and not any(char in ALPHA_SWIZZLES for char in swizzle):
+                continue
+            if field is None:
+                return False
+            if top_level and index == 0 and following == "=":
+                target = (field, swizzle, end + 1)
+            else:
+                state[field] = None
+        if target is not None:
+            field, swizzle, start = target
+            rhs = statement[start:-1]
+            if swizzle is None:
+                state[field] = self.get_vec4(rhs)
+            elif swizzle in ALPHA_SWIZZLES:
+                state[field] = self.get_scalar(rhs)
+            else:
+                state[field] = None
+        return True
+
+
+_layer_alpha = OrderedDict()
+
+def get_layer_alpha(tokens, max_entries=64):
+    """ LayerAlpha of a cached token stream, None when the layer is not provably opaque for any uniform values. """
+    entry = _layer_alpha.get(id(tokens))
+    if entry is not None and entry[0] is tokens:
+        _layer_alpha.move_to_end(id(tokens))
+        return entry[1]
+    tree = get_layer_tree(tokens)
+    alpha = None
+    entry_point = tree.functions.get(ENTRY_POINT)
+    if entry_point is not None:
+        analysis = AlphaAnalysis(tree)
+        requirements = analysis.analyze(entry_point)
+        if requirements is not None:
+            defaults = {}
+            for name, component in requirements:
+                uniform = analysis.uniforms[name]
+                sig = significant(uniform.tokens)
+                values = [value for ptype, value in sig]
+                if "=" in values:
+                    default = parse_default(sig[values.index("=") + 1 : -1], uniform.uniform_type)
+                    if default is not None:
+                        defaults[name] = default[0] if len(default) == 1 else default
+            alpha = LayerAlpha(requirements, defaults)
+    _layer_alpha[id(tokens)] = (tokens, alpha)
+    while len(_layer_alpha) > max_entries:
+        _layer_alpha.popitem(last=False)
+    return alpha
@@ -3,6 +3,19 @@
 import bpy
 from BlenderMalt import MaltProperties
 from BlenderMalt import MaltMaterial
+from . import BeerProfile
+from . import BeerStore
+
+
+class BeerPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    use_shader_store : bpy.props.BoolProperty(name="Shader Store", default=False,
+        description="Keep the generated shaders in the Blender user data directory, shared by every .blend file. "
+        "Materials point to them by absolute path, so saved files only find them on this machine")
+
+    def draw(self, context):
+        self.layout.prop(self, "use_shader_store")
 
 
 class BEER_PT_MainPanel(bpy.types.Panel):
@@ -30,13 +43,124 @@ class BEER_PT_MainPanel(bpy.types.Panel):
                 row = layout.row()
                 ob.active_material.beer.draw_ui(layout)
 
-            
+
+class BEER_PT_CompileStats(bpy.types.Panel):
+    bl_label = "Compile Stats"
+    bl_idname = "BEER_PT_COMPILESTATS"
+    bl_parent_id = "BEER_PT_MAINPANEL"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'BEER'
+    bl_options = {'DEFAULT_CLOSED'}
+    COMPAT_ENGINES = {'MALT'}
+
+    @classmethod
+    def poll(cls, context):
+        ob = context.object
+        return ob is not None and ob.active_material and ob.active_material.beer.is_beer_mat
+
+    def draw(self, context):
+        layout = self.layout
+        ob = context.object
+        if ob is None or not ob.active_material:
+            return
+        record = BeerProfile.get_last_record(ob.active_material.name)
+        if record is None:
+            layout.label(text="Not compiled yet")
+            return
+
+        layout.label(text=record.summary())
+        report = ob.active_material.beer.get_compile_report()
+        if report is not None:
+            layout.label(text="{} live layer outputs at most".format(report["peak_live_outputs"]))
+        col = layout.column(align=True)
+        for stage in BeerProfile.STAGES:
+            row = col.row()
+            row.label(text=stage.replace("_", " ").capitalize())
+            row.label(text="{:.2f} ms".format(record.stages[stage] * 1000.0))
+
+        col = layout.column(align=True)
+        for layer in record.layers:
+            layer_time = sum(layer["stages"].values()) * 1000.0
+            row = col.row()
+            row.label(text="Layer " + str(layer["index"]))
+            row.label(text="{} B, {} tokens".format(layer["bytes"], layer["tokens"]))
+            row.label(text="{:.2f} ms".format(layer_time), icon='FILE_REFRESH' if layer.get("rebuilt") else 'NONE')
+
+        layout.operator("beer.export_compile_trace", text="Export JSON Trace")
+
+        store = BeerStore.get_shader_store()
+        if store is not None:
+            stats = store.stats()
+            col = layout.column(align=True)
+            col.label(text="Shader store: {} files, {:.1f} / {:.0f} MB".format(stats["files"],
+                stats["bytes"] / (1024.0 * 1024.0), stats["max_bytes"] / (1024.0 * 1024.0)))
+            col.label(text="{} hits, {} misses, {} evicted".format(stats["hits"], stats["misses"], stats["evictions"]))
+            row = layout.row(align=True)
+            row.operator("beer.shader_store_cleanup", text="Clean Up").clear = False
+            row.operator("beer.shader_store_cleanup", text="Clear").clear = True
+
+
+
+class BEER_PT_GPUCost(bpy.types.Panel):
+    bl_label = "GPU Cost"
+    bl_idname = "BEER_PT_GPUCOST"
+    bl_parent_id = "BEER_PT_MAINPANEL"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'BEER'
+    bl_options = {'DEFAULT_CLOSED'}
+    COMPAT_ENGINES = {'MALT'}
+
+    @classmethod
+    def poll(cls, context):
+        ob = context.object
+        return ob is not None and ob.active_material and ob.active_material.beer.is_beer_mat
+
+    def draw(self, context):
+        layout = self.layout
+        ob = context.object
+        if ob is None or not ob.active_material:
+            return
+        cost = ob.active_material.beer.get_cost()
+        if cost is None:
+            layout.label(text="Not compiled yet")
+            return
+
+        layout.label(text="Estimated per pixel, without the Malt pipeline")
+        layout.label(text=cost.total.summary())
+        layout.label(text="{} uniform components, {} samplers".format(cost.total.uniform_components, cost.total.samplers))
+        for warning in cost.warnings:
+            layout.label(text=warning, icon='ERROR')
+
+        heaviest = cost.get_heaviest_layer()
+        col = layout.column(align=True)
+        for index, layer in sorted(cost.layers.items()):
+            row = col.row()
+            row.label(text="Layer " + str(index), icon='SORTTIME' if index == heaviest and len(cost.layers) > 1 else 'NONE')
+            row.label(text="{} ops, {} samples".format(layer.arithmetic, layer.texture_samples))
+            row.label(text="{} branches, {} loops".format(layer.branches, layer.loops))
+            row.label(text="{} uniforms".format(layer.uniforms))
+
+        col = layout.column(align=True)
+        for name, blend in sorted(cost.blends.items()):
+            row = col.row()
+            row.label(text=name.replace("blend_", "Blend ").title())
+            row.label(text="{} ops, {} branches".format(blend.arithmetic, blend.branches))
+
+
 def register():
+    bpy.utils.register_class(BeerPreferences)
     bpy.utils.register_class(BEER_PT_MainPanel)
+    bpy.utils.register_class(BEER_PT_CompileStats)
+    bpy.utils.register_class(BEER_PT_GPUCost)
 
 
 def unregister():
+    bpy.utils.unregister_class(BEER_PT_GPUCost)
+    bpy.utils.unregister_class(BEER_PT_CompileStats)
     bpy.utils.unregister_class(BEER_PT_MainPanel)
+    bpy.utils.unregister_class(BeerPreferences)
 
 
 if __name__ == "__main__":
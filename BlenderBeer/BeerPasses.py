@@ -0,0 +1,155 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Passes over the LayerTree of a layer. Each pass runs at most once per tree, after the passes it
+# requires, and its result is kept on the tree for the passes and writers that come after it.
+# Renaming and dead function removal are defined here, deduplication in BeerDedup and cost in BeerCost.
+
+from .BeerTree import ENTRY_POINT, Symbol, is_space
+
+#Rename plan segments, besides the token index to copy the tokens up to, the Symbols, the split directives
+#and the calls, kept as the (closing parenthesis token index, Symbol, has arguments) of the declaration
+VOID_PARAM = "VOID_PARAM"
+PARAMS_END = "PARAMS_END"
+EMPTY_PARAMS_END = "EMPTY_PARAMS_END"
+
+
+class Pass():
+    """ An analysis of a LayerTree, named so other passes can require it. """
+    name = None
+    requires = ()
+
+    def run(self, tree, results):
+        raise NotImplementedError()
+
+
+class PassManager():
+
+    def __init__(self):
+        self.passes = {}
+
+    def register(self, tree_pass):
+        self.passes[tree_pass.name] = tree_pass
+
+    def run(self, tree, name):
+        """ The result of a pass on tree, running it and the passes it requires the first time. """
+        results = tree.results
+        if name in results:
+            return results[name]
+        tree_pass = self.passes[name]
+        for required in tree_pass.requires:
+            self.run(tree, required)
+        results[name] = tree_pass.run(tree, results)
+        return results[name]
+
+pass_manager = PassManager()
+
+
+def get_segments(declaration):
+    """ The rename plan of a declaration, its tokens split around the places renaming changes. """
+    tokens = declaration.tokens
+    replacements = dict(declaration.references)
+    if declaration.directives:
+        replacements.update(declaration.directives)
+    markers = {call[0] : call for call in declaration.calls}
+    if declaration.kind == "function":
+        has_params = declaration.void_param is None and any(not is_space(*token)
+            for token in tokens[declaration.param_open + 1 : declaration.param_close])
+        markers[declaration.param_close] = PARAMS_END if has_params else EMPTY_PARAMS_END
+        if declaration.void_param is not None:
+            markers[declaration.void_param] = (VOID_PARAM, tokens[declaration.void_param][1])
+
+    segments = []
+    last = 0
+    for index in sorted(set(replacements) | set(markers)):
+        if index > last:
+            segments.append(index)
+            last = index
+        marker = markers.get(index)
+        if marker is not None:
+            segments.append(marker)
+            if marker[0] == VOID_PARAM:
+                last = index + 1
+        replacement = replacements.get(index)
+        if replacement is not None:
+            segments.append(replacement)
+            last = index + 1
+    return segments
+
+def write_segments(tokens, segments, out, names, arguments=None, extra_params=None):
+    """
+    Write a declaration from its rename plan.
+    names maps every Symbol to its output name, arguments maps a function Symbol to the uniforms passed to it.
+    With extra_params, a function is written taking them after its own parameters.
+    """
+    values = [value for ptype, value in tokens]
+    parts = []
+    append = parts.append
+    last = 0
+    for segment in segments:
+        segment_type = segment.__class__
+        if segment_type is int:
+            parts += values[last:segment]
+            last = segment
+        elif segment_type is Symbol:
+            append(names[segment])
+            last += 1
+        elif segment_type is list:
+            for piece in segment:
+                append(piece if piece.__class__ is str else names[piece])
+            last += 1
+        elif segment_type is str:
+            if extra_params:
+                append(", " + extra_params if segment == PARAMS_END else extra_params)
+        elif segment[0] == VOID_PARAM:
+            if not extra_params:
+                append(segment[1])
+            last += 1
+        else:
+            call_arguments = arguments.get(segment[1]) if arguments else None
+            if call_arguments:
+                append(", " + call_arguments if segment[2] else call_arguments)
+    parts += values[last:]
+    out.write("".join(parts))
+
+
+class RenamePass(Pass):
+    """ The rename plan of every declaration, which does not depend on the layer prefix. """
+    name = "rename"
+
+    def run(self, tree, results):
+        return {declaration : get_segments(declaration) for declaration in tree.declarations}
+
+
+class DeadFunctionPass(Pass):
+    """ The functions and prototypes COMMON_PIXEL_SHADER can not reach, none for layers without it. """
+    name = "dead_functions"
+
+    def run(self, tree, results):
+        entry_point = tree.symbols.get(ENTRY_POINT)
+        if entry_point is None or entry_point.kind != "function":
+            return frozenset()
+        live = set([entry_point])
+        stack = [entry_point]
+        #Functions named outside of functions, in macros and initializers, are kept too
+        for declaration in tree.declarations:
+            if declaration.kind != "function" and declaration.kind != "prototype":
+                for symbol in tree.get_referenced(declaration):
+                    if symbol.kind == "function" and symbol not in live:
+                        live.add(symbol)
+                        stack.append(symbol)
+        while stack:
+            symbol = stack.pop()
+            for declaration in symbol.declarations:
+                for callee in tree.get_referenced(declaration):
+                    if callee.kind == "function" and callee not in live:
+                        live.add(callee)
+                        stack.append(callee)
+        dead = set()
+        for symbol in tree.symbols.values():
+            if symbol.kind == "function" and symbol not in live:
+                dead.update(symbol.declarations)
+        return frozenset(dead)
+
+
+pass_manager.register(RenamePass())
+pass_manager.register(DeadFunctionPass())
@@ -0,0 +1,178 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+STAGES = (
+    "read_source",
+    "lex",
+    "classify",
+    "parse",
+    "deduplicate",
+    "includes",
+    "rename",
+    "compose",
+    "blend_library",
+    "file_write",
+    "property_copy",
+)
+
+
+class CompileRecord():
+    """ Timings and counters of a single BEER compile. """
+
+    def __init__(self, name):
+        self.name = name
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.total_time = 0.0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.layers = []
+        self.events = []
+        self.current_layer = None
+        #Whether the written shader made Malt recompile, None until it is written
+        self.recompile = None
+
+    def begin_layer(self, index, source):
+        for layer in self.layers:
+            if layer["index"] == index:
+                self.current_layer = layer
+                return
+        self.current_layer = {
+            "index" : index,
+            "source" : source,
+            "bytes" : 0,
+            "tokens" : 0,
+            "stages" : dict.fromkeys(STAGES, 0.0),
+        }
+        self.layers.append(self.current_layer)
+
+    def end_layer(self):
+        self.current_layer = None
+
+    def add_time(self, name, start, elapsed):
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+        layer_index = None
+        if self.current_layer is not None:
+            layer_stages = self.current_layer["stages"]
+            layer_stages[name] = layer_stages.get(name, 0.0) + elapsed
+            layer_index = self.current_layer["index"]
+        self.events.append((name, start, elapsed, layer_index))
+
+    def count(self, key, value):
+        if self.current_layer is not None:
+            self.current_layer[key] = self.current_layer.get(key, 0) + value
+
+    def set(self, key, value):
+        if self.current_layer is not None:
+            self.current_layer[key] = value
+
+    def finish(self):
+        self.total_time = time.perf_counter() - self.start
+
+    def as_dict(self):
+        return {
+            "name" : self.name,
+            "timestamp" : self.timestamp,
+            "total_time" : self.total_time,
+            "recompile" : self.recompile,
+            "stages" : dict(self.stages),
+            "layers" : [dict(layer, stages=dict(layer["stages"])) for layer in self.layers],
+        }
+
+    def as_trace(self):
+        """ Chrome trace event format, readable by chrome://tracing and Perfetto. """
+        events = []
+        events.append({
+            "name" : self.name, "cat" : "compile", "ph" : "X", "pid" : 1, "tid" : 1,
+            "ts" : 0.0, "dur" : self.total_time * 1e6,
+        })
+        for name, start, elapsed, layer_index in self.events:
+            event = {
+                "name" : name, "cat" : "stage", "ph" : "X", "pid" : 1, "tid" : 1,
+                "ts" : (start - self.start) * 1e6, "dur" : elapsed * 1e6,
+            }
+            if layer_index is not None:
+                event["args"] = {"layer" : layer_index}
+            events.append(event)
+        return {"traceEvents" : events, "beer" : self.as_dict()}
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_trace(), f, indent=1)
+
+    def summary(self):
+        summary = "{} layers compiled in {:.2f} ms".format(len(self.layers), self.total_time * 1000.0)
+        if self.recompile is False:
+            summary += ", shader unchanged"
+        return summary
+
+
+_local = threading.local()
+
+#Last finished record, and the last one of each material
+last_record = None
+material_records = {}
+
+def get_current_record():
+    return getattr(_local, "record", None)
+
+def get_last_record(name=None):
+    if name is None:
+        return last_record
+    return material_records.get(name)
+
+def add_record(record):
+    """ Keep a finished record as the last one, also for records made in another process. """
+    global last_record
+    last_record = record
+    material_records[record.name] = record
+
+@contextmanager
+def record_compile(name):
+    """ Collect the stages run inside this block into a new CompileRecord. """
+    record = CompileRecord(name)
+    previous = get_current_record()
+    _local.record = record
+    try:
+        yield record
+    finally:
+        record.finish()
+        _local.record = previous
+        add_record(record)
+
+@contextmanager
+def stage(name):
+    record = get_current_record()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add_time(name, start, time.perf_counter() - start)
+
+@contextmanager
+def layer(index, source):
+    record = get_current_record()
+    if record is None:
+        yield
+        return
+    record.begin_layer(index, source)
+    try:
+        yield
+    finally:
+        record.end_layer()
+
+def count(key, value):
+    record = get_current_record()
+    if record is not None:
+        record.count(key, value)
+
+def set_value(key, value):
+    record = get_current_record()
+    if record is not None:
+        record.set(key, value)
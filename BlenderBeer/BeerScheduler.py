@@ -0,0 +1,176 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Automatic recompiles of BEER materials. Edits are debounced, the shader source is
+# generated on a worker thread, and the result is written back by a main thread timer.
+# Every request bumps the generation of its material, so older compiles are dropped.
+
+import os
+import time
+import threading
+import bpy
+from bpy.app.handlers import persistent
+from . import BeerCompiler
+from . import BeerProfile
+from .BeerCompiler import CompileCancelled
+from .BeerStore import get_shader_store
+
+DEBOUNCE = 0.3
+BUSY_INTERVAL = 0.05
+WATCH_INTERVAL = 0.5
+
+#Latest request of each material, keyed by material name
+generations = {}
+
+_deadlines = {}
+_source_mtimes = {}
+_last_watch = 0.0
+
+#Shared with the worker thread, guarded by _condition
+_requests = {}
+_results = {}
+_active = set()
+_condition = threading.Condition()
+_running = False
+_worker = None
+
+
+def request_compile(beer_mat):
+    """ Compile the material once its edits settle for DEBOUNCE seconds. """
+    name = beer_mat.material.name
+    generations[name] = generations.get(name, 0) + 1
+    _deadlines[name] = time.monotonic() + DEBOUNCE
+    if bpy.app.timers.is_registered(tick):
+        bpy.app.timers.unregister(tick)
+    bpy.app.timers.register(tick, first_interval=DEBOUNCE, persistent=True)
+
+def cancel_compile(beer_mat):
+    """ Drop the pending and in-flight automatic compiles of the material. """
+    name = beer_mat.material.name
+    generations[name] = generations.get(name, 0) + 1
+    _deadlines.pop(name, None)
+    with _condition:
+        _requests.pop(name, None)
+
+def is_compiling(beer_mat):
+    name = beer_mat.material.name
+    with _condition:
+        return name in _deadlines or name in _requests or name in _active
+
+def submit(name):
+    material = bpy.data.materials.get(name)
+    if material is None or not material.beer.can_compile():
+        return
+    layers = material.beer.get_layer_specs()
+    start_worker()
+    with _condition:
+        #A queued request of the same material is replaced, not queued behind
+        _requests[name] = (generations.get(name, 0), material.beer.as_pointer(), layers, get_shader_store(),
+            material.beer.mask_early_out)
+        _condition.notify()
+
+def work():
+    while True:
+        with _condition:
+            while _running and not _requests:
+                _condition.wait()
+            if not _running:
+                return
+            name, (generation, key, layers, store, mask_early_out) = _requests.popitem()
+            _active.add(name)
+        cancelled = lambda: generations.get(name) != generation
+        source = None
+        error = None
+        try:
+            with BeerProfile.record_compile(name):
+                source = BeerCompiler.compile_incremental(key, layers, cancelled, store, mask_early_out=mask_early_out)
+        except CompileCancelled:
+            pass
+        except Exception as e:
+            error = e
+        with _condition:
+            _active.discard(name)
+            if source is not None or error is not None:
+                _results[name] = (generation, source, error)
+
+def start_worker():
+    global _running, _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    _running = True
+    _worker = threading.Thread(target=work, name="BEER compile", daemon=True)
+    _worker.start()
+
+def stop_worker():
+    global _running, _worker
+    with _condition:
+        _running = False
+        _requests.clear()
+        _condition.notify_all()
+    _worker = None
+
+def apply_results():
+    with _condition:
+        results = dict(_results)
+        _results.clear()
+    for name, (generation, source, error) in results.items():
+        material = bpy.data.materials.get(name)
+        if material is None or generations.get(name) != generation:
+            continue
+        if error is not None:
+            print("BEER auto compile of {} failed: {}".format(name, error))
+            continue
+        material.beer.update_file(source)
+
+def watch_sources():
+    """ Request a compile of the auto compiled materials whose layer files changed on disk. """
+    for material in bpy.data.materials:
+        beer_mat = material.beer
+        if not (beer_mat.is_beer_mat and beer_mat.auto_compile):
+            continue
+        mtimes = {}
+        for layer in beer_mat.layers:
+            if layer.material:
+                path = layer.material.malt.get_source_path()
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtimes[path] = None
+        previous = _source_mtimes.get(material.name)
+        _source_mtimes[material.name] = mtimes
+        if previous and any(path in previous and previous[path] != mtime for path, mtime in mtimes.items()):
+            request_compile(beer_mat)
+
+def tick():
+    global _last_watch
+    apply_results()
+    now = time.monotonic()
+    for name, deadline in list(_deadlines.items()):
+        if deadline <= now:
+            del _deadlines[name]
+            submit(name)
+    if now - _last_watch >= WATCH_INTERVAL:
+        _last_watch = now
+        watch_sources()
+    with _condition:
+        busy = _deadlines or _requests or _active or _results
+    return BUSY_INTERVAL if busy else WATCH_INTERVAL
+
+@persistent
+def on_load(dummy):
+    generations.clear()
+    _deadlines.clear()
+    _source_mtimes.clear()
+    with _condition:
+        _requests.clear()
+        _results.clear()
+
+
+def register():
+    bpy.app.handlers.load_post.append(on_load)
+    bpy.app.timers.register(tick, first_interval=WATCH_INTERVAL, persistent=True)
+
+def unregister():
+    if bpy.app.timers.is_registered(tick):
+        bpy.app.timers.unregister(tick)
+    bpy.app.handlers.load_post.remove(on_load)
+    stop_worker()
@@ -0,0 +1,319 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Content-addressed store of generated shaders, shared by every material and .blend file.
+# Files are named after the hash of their source, so equal stacks share one file and Malt
+# compiles it once. An index maps the hash of a stack spec to the file it compiled to.
+
+import os
+import time
+import json
+import hashlib
+import tempfile
+import threading
+
+SHADER_EXTENSION = ".mesh.glsl"
+INDEX_NAME = "index.json"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+#Seconds waited before each new try to replace a file another process has open
+REPLACE_RETRY_DELAYS = (0.01, 0.05, 0.1, 0.25)
+
+#Generated shaders go to the shared store when enabled, otherwise each material writes its own file next to the .blend.
+#Stored shaders are referenced by absolute paths in the user data directory, which other machines don't have,
+#so saved files only find them on the machine they were saved on.
+#Set by the Shader Store addon preference, this is only read when the addon isn't registered.
+use_shader_store = False
+shader_store = None
+
+#Content hash of the files written by write_if_changed, with the stat they were written with
+_file_hashes = {}
+
+#os.umask can only be read by setting it, it is read once here before any thread writes files
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def hash_content(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+def get_file_mode(path):
+    """ Mode of the file at path, or the one a new file gets with the current umask. """
+    try:
+        return os.stat(path).st_mode & 0o777
+    except OSError:
+        return 0o666 & ~_umask
+
+def replace_file(temp_path, path):
+    """ os.replace, retried while another process has path open, as Windows refuses to replace it then. """
+    for delay in REPLACE_RETRY_DELAYS + (None,):
+        try:
+            os.replace(temp_path, path)
+            return True
+        except PermissionError:
+            if delay is None:
+                return False
+            time.sleep(delay)
+
+def write_atomic(path, text):
+    """
+    Write text to a temporary file next to path and rename it into place, readers never see a partial file.
+    When path stays open in another process that doesn't let it be replaced, it is overwritten in place instead.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, 'w', newline='') as f:
+            f.write(text)
+        #mkstemp files are private to the user, the shader keeps the mode of the file it replaces
+        os.chmod(temp_path, get_file_mode(path))
+        replaced = replace_file(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    if not replaced:
+        #Still locked, a plain write can share the file where a rename can't
+        os.remove(temp_path)
+        with open(path, 'w', newline='') as f:
+            f.write(text)
+
+def get_file_hash(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    entry = _file_hashes.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    try:
+        with open(path, newline='') as f:
+            content_hash = hash_content(f.read())
+    except (OSError, UnicodeDecodeError):
+        return None
+    _file_hashes[path] = (key, content_hash)
+    return content_hash
+
+def write_if_changed(path, text):
+    """ Write text to path unless the file holds it already. Returns True when the file was written. """
+    content_hash = hash_content(text)
+    if get_file_hash(path) == content_hash:
+        return False
+    write_atomic(path, text)
+    stat = os.stat(path)
+    _file_hashes[path] = ((stat.st_mtime_ns, stat.st_size), content_hash)
+    return True
+
+
+class ShaderStore():
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.index = None
+        #Files handed out in this session, never evicted while Blender runs
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        #(files, bytes) of the stored shaders, counted once and then kept up to date by put and evict
+        self.usage = None
+
+    def get_path(self, content_hash):
+        return os.path.join(self.directory, content_hash + SHADER_EXTENSION)
+
+    def load_index(self):
+        if self.index is None:
+            self.index = {}
+            try:
+                with open(os.path.join(self.directory, INDEX_NAME)) as f:
+                    self.index = json.load(f).get("keys", {})
+            except (OSError, ValueError):
+                pass
+        return self.index
+
+    def save_index(self):
+        write_atomic(os.path.join(self.directory, INDEX_NAME), json.dumps({"keys" : self.index}, sort_keys=True))
+
+    def pin(self, path):
+        """ Keep a stored shader a loaded material points to from being evicted in this session. """
+        with self.lock:
+            self.pinned.add(path)
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def lookup(self, stack_key):
+        """ Path of the shader a stack compiled to, or None. """
+        with self.lock:
+            content_hash = self.load_index().get(stack_key)
+            path = self.get_path(content_hash) if content_hash else None
+            if path is None or not os.path.isfile(path):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touch(path)
+            self.pinned.add(path)
+            return path
+
+    def read(self, stack_key):
+        path = self.lookup(stack_key)
+        if path is None:
+            return None
+        with open(path, newline='') as f:
+            return f.read()
+
+    def put(self, source, stack_key=None):
+        """ Store source, returning its path. Nothing is written when the same source is stored already. """
+        content_hash = hash_content(source)
+        path = self.get_path(content_hash)
+        with self.lock:
+            written = not os.path.isfile(path)
+            if written:
+                write_atomic(path, source)
+                self.writes += 1
+                files, size = self.get_usage()
+                self.usage = (files + 1, size + os.path.getsize(path))
+            else:
+                self.touch(path)
+            self.pinned.add(path)
+            if stack_key is not None and self.load_index().get(stack_key) != content_hash:
+                self.index[stack_key] = content_hash
+                self.save_index()
+            if written and self.usage[1] > self.max_bytes:
+                self.evict()
+        return path
+
+    def get_files(self):
+        files = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return files
+        for entry in entries:
+            if entry.name.endswith(SHADER_EXTENSION) and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def get_usage(self):
+        with self.lock:
+            if self.usage is None:
+                files = self.get_files()
+                self.usage = (len(files), sum(size for mtime, size, path in files))
+            return self.usage
+
+    def evict(self, max_bytes=None):
+        """ Remove the least recently used shaders until the store fits in max_bytes, counting the files again. """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self.lock:
+            files = sorted(self.get_files())
+            total = sum(size for mtime, size, path in files)
+            removed = set()
+            for mtime, size, path in files:
+                if total <= max_bytes:
+                    break
+                if path in self.pinned:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed.add(os.path.basename(path)[:-len(SHADER_EXTENSION)])
+                self.evictions += 1
+            self.usage = (len(files) - len(removed), total)
+            if removed:
+                index = self.load_index()
+                for stack_key in [key for key, content_hash in index.items() if content_hash in removed]:
+                    del index[stack_key]
+                self.save_index()
+            return len(removed)
+
+    def cleanup(self):
+        """ Trim the store to its size cap, dropping index entries and temporary files left behind. """
+        with self.lock:
+            removed = self.evict()
+            index = self.load_index()
+            stale = [key for key, content_hash in index.items() if not os.path.isfile(self.get_path(content_hash))]
+            for stack_key in stale:
+                del index[stack_key]
+            if stale:
+                self.save_index()
+            #Temporary files of a write still in progress in another Blender instance are left alone
+            expired = time.time() - 3600.0
+            try:
+                for entry in os.scandir(self.directory):
+                    if entry.name.endswith(".tmp") and entry.stat().st_mtime < expired:
+                        os.remove(entry.path)
+                        removed += 1
+            except OSError:
+                pass
+            return removed
+
+    def clear(self):
+        """ Remove every shader not used in this session. """
+        return self.evict(0)
+
+    def stats(self):
+        """ Counters of the store, cheap enough to draw, the files are only counted the first time. """
+        with self.lock:
+            files, size = self.get_usage()
+            return {
+                "directory" : self.directory,
+                "files" : files,
+                "bytes" : size,
+                "max_bytes" : self.max_bytes,
+                "keys" : len(self.load_index()),
+                "pinned" : len(self.pinned),
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "writes" : self.writes,
+                "evictions" : self.evictions,
+            }
+
+
+class DeferredStore(ShaderStore):
+    """
+    A store for the worker processes of a batch compile. It reads the shaders stored already,
+    its writes are kept in pending for the process owning the store to put them.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        ShaderStore.__init__(self, directory, max_bytes)
+        #(source, stack key) of every put, in order
+        self.pending = []
+
+    def read(self, stack_key):
+        for source, pending_key in self.pending:
+            if pending_key == stack_key:
+                return source
+        return ShaderStore.read(self, stack_key)
+
+    def put(self, source, stack_key=None):
+        self.pending.append((source, stack_key))
+        return self.get_path(hash_content(source))
+
+
+def get_use_shader_store():
+    """ The Shader Store addon preference, or use_shader_store when the addon isn't registered. """
+    import bpy
+    addon = bpy.context.preferences.addons.get(__package__)
+    if addon is None:
+        return use_shader_store
+    return addon.preferences.use_shader_store
+
+def get_shader_store():
+    """ The store in the Blender user data directory, None when the store is disabled. """
+    global shader_store
+    if not get_use_shader_store():
+        return None
+    if shader_store is None:
+        import bpy
+        shader_store = ShaderStore(bpy.utils.user_resource('DATAFILES', path="beer_shaders"))
+    return shader_store
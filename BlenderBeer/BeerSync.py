@@ -0,0 +1,245 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Live propagation of layer uniforms into the BEER material.
+# Edits to a layer material are picked up by a depsgraph handler, and the changed
+# values are pushed on a timer, so a burst of updates is applied once per redraw.
+# Layers culled under an opaque layer stay culled only while its alpha parameters keep it opaque,
+# when one of them changes the verdict the material is recompiled. The verdict of the last compile is saved
+# with the material and the layer sources are analyzed again when linked, so this also works after a reload.
+# Baked uniforms are constants of the generated shader, they are not pushed, a change to one of them
+# requests a recompile when the material compiles automatically.
+
+import bpy
+from bpy.app.handlers import persistent
+from .BeerLexer import rename_symbol
+from . import BeerCompiler
+from . import BeerScheduler
+from .BeerCompiler import get_prefix
+from .BeerGraph import can_hide
+from .BeerOpacity import source_alpha
+from .BeerUniforms import flatten
+
+_MISSING = object()
+
+#Links of each layer material, keyed by name, and the values last pushed from it
+links = {}
+snapshots = {}
+
+_dirty = set()
+_scheduled = False
+
+
+class ParameterLink():
+    """ The uniforms of a layer material and their prefixed names in a BEER material. """
+
+    def __init__(self, beer_material, index, baked=frozenset()):
+        self.beer_material = beer_material
+        self.prefix = get_prefix(index)
+        self.baked = baked
+        self.names = {}
+        #Values whose uniform does not exist yet, until Malt compiles the new shader
+        self.pending = {}
+
+    def get_name(self, key):
+        name = self.names.get(key)
+        if name is None:
+            name = rename_symbol(key, self.prefix)
+            self.names[key] = name
+        return name
+
+    def push(self, values):
+        material = bpy.data.materials.get(self.beer_material)
+        if material is None:
+            return
+        parameters = material.malt.parameters
+        if self.baked:
+            values = {key : value for key, value in values.items() if key not in self.baked}
+        for key, value in values.items():
+            name = self.get_name(key)
+            if name in parameters:
+                parameters[name] = value
+                self.pending.pop(key, None)
+            else:
+                self.pending[key] = value
+
+
+def get_layer_parameters(material):
+    resources = {}
+    overrides = {}
+    return material.malt.parameters.get_parameters(resources, overrides)
+
+def get_bake_values(material):
+    """ The numeric parameters of a layer material, as plain values the compiler can write as constants. """
+    values = {}
+    for key, value in get_layer_parameters(material).items():
+        if isinstance(value, (bool, int, float)):
+            values[key] = value
+        else:
+            try:
+                values[key] = flatten(value)
+            except TypeError:
+                pass
+    return values
+
+def get_layer_opacity(material):
+    """ Whether a layer material is opaque with its current parameters, None before its source is analyzed. """
+    source_path = material.malt.get_source_path()
+    if source_path not in source_alpha:
+        return None
+    alpha = source_alpha[source_path]
+    if alpha is None:
+        return False
+    return alpha.is_opaque(get_layer_parameters(material))
+
+def check_opacity(beer_mat):
+    """ Recompile the material when the opacity of a layer no longer matches its last compile. """
+    report = BeerCompiler.compile_reports.get(beer_mat.as_pointer())
+    #Without a compile in this session, the verdict saved with the material by its last one
+    opaque = report.get("opaque", ()) if report is not None else beer_mat.get("opaque_layers")
+    if opaque is None:
+        return
+    opaque = set(opaque)
+    for layer in beer_mat.layers:
+        if not layer.material or not can_hide(layer):
+            continue
+        opacity = get_layer_opacity(layer.material)
+        if opacity is not None and opacity != (layer["index"] in opaque):
+            #Not gated by auto compile, a stale cull hides layers that should show
+            BeerScheduler.request_compile(beer_mat)
+            return
+
+def analyze_layers(beer_mat):
+    """ Analyze the alpha of the layers that can hide others, when no compile did it in this session. """
+    for layer in beer_mat.layers:
+        if not layer.material or not can_hide(layer):
+            continue
+        source_path = layer.material.malt.get_source_path()
+        if source_path not in source_alpha:
+            try:
+                BeerCompiler.get_source_alpha(source_path)
+            except OSError:
+                pass
+
+def to_snapshot(value):
+    if isinstance(value, str):
+        return value
+    try:
+        return tuple(value)
+    except TypeError:
+        return value
+
+def unlink_material(name):
+    for layer_links in links.values():
+        layer_links[:] = [link for link in layer_links if link.beer_material != name]
+
+def link_material(beer_mat, push=True):
+    """ Map the uniforms of every layer to the BEER material, pushing all of them when push is set. """
+    beer_name = beer_mat.material.name
+    unlink_material(beer_name)
+    report = BeerCompiler.compile_reports.get(beer_mat.as_pointer())
+    baked = report.get("baked", {}) if report is not None else {}
+    for layer in beer_mat.layers:
+        if not layer.material:
+            continue
+        name = layer.material.name
+        link = ParameterLink(beer_name, layer["index"], frozenset(baked.get(layer["index"], ())))
+        links.setdefault(name, []).append(link)
+        parameters = get_layer_parameters(layer.material)
+        for key in parameters:
+            link.get_name(key)
+        if push:
+            link.push(parameters)
+        snapshots[name] = {key : to_snapshot(value) for key, value in parameters.items()}
+    analyze_layers(beer_mat)
+    check_opacity(beer_mat)
+
+def link_all_materials():
+    links.clear()
+    snapshots.clear()
+    _dirty.clear()
+    for material in bpy.data.materials:
+        if material.beer.is_beer_mat and material.beer.material:
+            link_material(material.beer, push=False)
+
+def get_changed_values(name):
+    material = bpy.data.materials.get(name)
+    if material is None:
+        return {}
+    snapshot = snapshots.setdefault(name, {})
+    changed = {}
+    for key, value in get_layer_parameters(material).items():
+        value_snapshot = to_snapshot(value)
+        if snapshot.get(key, _MISSING) != value_snapshot:
+            snapshot[key] = value_snapshot
+            changed[key] = value
+    return changed
+
+def flush():
+    """ Push the values changed since the last flush. Runs as a one-shot timer. """
+    global _scheduled
+    _scheduled = False
+    dirty = set(_dirty)
+    _dirty.clear()
+    for name in dirty:
+        layer_links = links.get(name)
+        if layer_links:
+            changed = get_changed_values(name)
+            if changed:
+                for link in layer_links:
+                    link.push(changed)
+                check_alpha_changes(name, changed, layer_links)
+                check_baked_changes(changed, layer_links)
+    for layer_links in links.values():
+        for link in layer_links:
+            if link.pending and link.beer_material in dirty:
+                link.push(dict(link.pending))
+    return None
+
+def check_alpha_changes(name, changed, layer_links):
+    alpha = source_alpha.get(bpy.data.materials[name].malt.get_source_path())
+    if alpha is None or alpha.names.isdisjoint(changed):
+        return
+    for beer_name in set(link.beer_material for link in layer_links):
+        beer_material = bpy.data.materials.get(beer_name)
+        if beer_material is not None:
+            check_opacity(beer_material.beer)
+
+def check_baked_changes(changed, layer_links):
+    for beer_name in set(link.beer_material for link in layer_links if not link.baked.isdisjoint(changed)):
+        beer_material = bpy.data.materials.get(beer_name)
+        if beer_material is not None and beer_material.beer.auto_compile:
+            BeerScheduler.request_compile(beer_material.beer)
+
+def is_linked(name):
+    if name in links:
+        return True
+    return any(link.pending and link.beer_material == name
+        for layer_links in links.values() for link in layer_links)
+
+@persistent
+def on_depsgraph_update(scene, depsgraph):
+    global _scheduled
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Material):
+            name = update.id.original.name
+            if is_linked(name):
+                _dirty.add(name)
+    if _dirty and not _scheduled:
+        _scheduled = True
+        #A zero interval timer runs on the next pass of the event loop, once all pending updates are in
+        bpy.app.timers.register(flush, first_interval=0.0)
+
+@persistent
+def on_load(dummy):
+    link_all_materials()
+
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(on_depsgraph_update)
+    bpy.app.handlers.load_post.append(on_load)
+
+def unregister():
+    if bpy.app.timers.is_registered(flush):
+        bpy.app.timers.unregister(flush)
+    bpy.app.handlers.load_post.remove(on_load)
+    bpy.app.handlers.depsgraph_update_post.remove(on_depsgraph_update)
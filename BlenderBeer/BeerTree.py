@@ -0,0 +1,734 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# The front end shared by the passes over a layer. A layer is split into its top level declarations,
+# the symbols they declare go in a symbol table, and every identifier is resolved through the scopes
+# of the function it is in. Locals, parameters, struct members and the names of the pipeline are never
+# taken for layer symbols. The tree of a layer is built once, the passes of BeerPasses annotate it.
+
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+from .BeerLexer import NAME, NAME_FUNCTION, KEYWORD_TYPE, PUNCTUATION, GENERIC, PREPROC, GLSL_TYPES, is_blank
+
+ENTRY_POINT = "COMMON_PIXEL_SHADER"
+PRECISION_QUALIFIERS = ("lowp", "mediump", "highp")
+CONDITIONAL_OPEN = ("#if", "#ifdef", "#ifndef")
+CONDITIONAL_CLOSE = "#endif"
+
+IDENTIFIERS = frozenset((NAME, NAME_FUNCTION, GENERIC, KEYWORD_TYPE))
+BUILTIN_TYPES = frozenset(GLSL_TYPES)
+QUALIFIERS = frozenset(('const', 'in', 'out', 'inout', 'uniform', 'buffer', 'shared', 'attribute', 'varying',
+    'flat', 'smooth', 'noperspective', 'centroid', 'sample', 'patch', 'invariant', 'precise',
+    'coherent', 'volatile', 'restrict', 'readonly', 'writeonly') + PRECISION_QUALIFIERS)
+#Suffixes the tokenizer splits from number literals, like the u of 1u
+NUMBER_SUFFIXES = frozenset(('u', 'U', 'f', 'F', 'lf', 'LF'))
+
+#Directives whose names can refer to layer symbols
+SYMBOL_DIRECTIVES = frozenset(('#define', '#undef', '#if', '#ifdef', '#ifndef', '#elif'))
+DIRECTIVE_PATTERN = re.compile(r'#\s*(\w*)\s*')
+MACRO_PATTERN = re.compile(r'(\w+)(?:\(([^)]*)\))?')
+#Names in a directive, members and number suffixes left out
+DIRECTIVE_NAME_PATTERN = re.compile(r'(?<![\w.])[A-Za-z_]\w*')
+
+
+class Declaration():
+    """ A top level chunk of a layer token stream. """
+
+    def __init__(self, kind, tokens):
+        self.kind = kind
+        self.tokens = tokens
+        self.name = None
+        self.hoisted = False
+        #Inside an #if block of the layer source
+        self.conditional = False
+        #Set when LayerTree resolves the declaration, text keeps them empty.
+        #(token index, Symbol) of the tokens that refer to a layer symbol, in token order
+        self.references = ()
+        #(closing parenthesis token index, Symbol, has arguments) of the calls to layer functions
+        self.calls = ()
+        #Token index of a directive to its text split around the symbols it refers to, or None
+        self.directives = None
+        #Has preprocessor lines of its own, inside a function body
+        self.preprocessed = False
+
+
+class FunctionDeclaration(Declaration):
+
+    def __init__(self, tokens):
+        Declaration.__init__(self, "function", tokens)
+        self.name_index = None
+        self.param_open = None
+        self.param_close = None
+        self.void_param = None
+        self.returns_void = False
+        self.uniforms = frozenset()
+        self.callees = ()
+        self.shareable = True
+        self.key = None
+
+    def get_param_names(self):
+        names = []
+        last_name = None
+        depth = 0
+        for ptype, value in self.tokens[self.param_open + 1 : self.param_close]:
+            if ptype == PUNCTUATION and value in "([":
+                depth += 1
+            elif ptype == PUNCTUATION and value in ")]":
+                depth -= 1
+            elif ptype == PUNCTUATION and value == "," and depth == 0:
+                names.append(last_name)
+                last_name = None
+            elif ptype == NAME and depth == 0:
+                last_name = value
+        if last_name is not None:
+            names.append(last_name)
+        return names
+
+
+class Symbol():
+    """ A name declared at the top level of a layer, with the declarations that declare it. """
+
+    def __init__(self, name, kind):
+        self.name = name
+        #function, uniform, block, global, struct or macro
+        self.kind = kind
+        self.declarations = []
+
+
+class BlankTypes(dict):
+    """ is_blank of each token type, computed the first time the type is seen. """
+
+    def __missing__(self, ptype):
+        blank = self[ptype] = is_blank(ptype)
+        return blank
+
+blank_types = BlankTypes()
+
+def is_space(ptype, value):
+    # Whitespace after a member access is classified as Token.Other
+    return blank_types[ptype] or value.isspace()
+
+def significant(tokens):
+    return [token for token in tokens if not (blank_types[token[0]] or token[1].isspace())]
+
+def find_matching(tokens, open_index):
+    depth = 0
+    for index in range(open_index, len(tokens)):
+        ptype, value = tokens[index]
+        if ptype == PUNCTUATION:
+            if value == "(":
+                depth += 1
+            elif value == ")":
+                depth -= 1
+                if depth == 0:
+                    return index
+    return None
+
+def match_brackets(sig):
+    matches = {}
+    stack = []
+    for index, (ptype, value) in enumerate(sig):
+        if ptype != PUNCTUATION:
+            continue
+        if value in "({[":
+            stack.append(index)
+        elif value in ")}]" and stack:
+            matches[stack.pop()] = index
+    return matches
+
+def get_statement_end(sig, start, matches):
+    """ Index of the last token of the statement or block starting at start. """
+    if start >= len(sig):
+        return len(sig) - 1
+    if sig[start][1] == "{":
+        return matches.get(start, len(sig) - 1)
+    index = start
+    while index < len(sig):
+        value = sig[index][1]
+        if value in "({[" and index in matches:
+            index = matches[index]
+        elif value == ";":
+            return index
+        index += 1
+    return len(sig) - 1
+
+def split_directive(value):
+    """ (directive with its #, text after it) of a preprocessor line. """
+    match = DIRECTIVE_PATTERN.match(value)
+    if match is None:
+        return None, value
+    return "#" + match.group(1), value[match.end():]
+
+def skip_layout(values):
+    """ Index of the first value after the layout(...) qualifiers a declaration starts with. """
+    start = 0
+    while values[start:start + 2] == ["layout", "("]:
+        depth = 0
+        for index in range(start + 1, len(values)):
+            if values[index] == "(":
+                depth += 1
+            elif values[index] == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+        else:
+            return start
+        start = index + 1
+    return start
+
+def make_declaration(tokens):
+    sig = significant(tokens)
+    values = [value for ptype, value in sig]
+    brace = values.index("{") if "{" in values else len(values)
+    #layout(std140) and layout(location = 1) don't make a uniform a function
+    start = skip_layout(values)
+    paren = values.index("(", start) if "(" in values[start:] else len(values)
+
+    if "struct" in values[:brace]:
+        declaration = Declaration("struct", tokens)
+        declaration.name = values[values.index("struct") + 1]
+        return declaration
+
+    if "uniform" in values[:min(brace, paren)]:
+        return make_uniform(tokens, sig)
+
+    if paren < brace < len(values) and sig[paren - 1][0] in (NAME_FUNCTION, NAME, GENERIC):
+        declaration = FunctionDeclaration(tokens)
+        declaration.name = sig[paren - 1][1]
+        declaration.returns_void = paren >= 2 and values[paren - 2] == "void"
+        seen = 0
+        for index, (ptype, value) in enumerate(tokens):
+            if is_space(ptype, value):
+                continue
+            if seen == paren - 1:
+                declaration.name_index = index
+            elif seen == paren:
+                declaration.param_open = index
+                break
+            seen += 1
+        declaration.param_close = find_matching(tokens, declaration.param_open)
+        params = [index for index in range(declaration.param_open + 1, declaration.param_close)
+            if not is_space(*tokens[index])]
+        if len(params) == 1 and tokens[params[0]][1] == "void":
+            declaration.void_param = params[0]
+        return declaration
+
+    if paren < len(values) and values[-1:] == [";"] and "=" not in values[:paren] and sig[paren - 1][0] == NAME_FUNCTION:
+        declaration = Declaration("prototype", tokens)
+        declaration.name = sig[paren - 1][1]
+        return declaration
+
+    declaration = Declaration("global", tokens)
+    declaration.names = set(value for ptype, value in sig if ptype in (NAME, NAME_FUNCTION))
+    return declaration
+
+def make_uniform(tokens, sig):
+    declaration = Declaration("uniform", tokens)
+    values = [value for ptype, value in sig]
+    declaration.names = set(value for ptype, value in sig if ptype == NAME)
+    declaration.uniform_type = None
+    declaration.array = ""
+    position = values.index("uniform") + 1
+    while position < len(values) and values[position] in PRECISION_QUALIFIERS:
+        position += 1
+    if position + 1 >= len(values) or sig[position + 1][0] != NAME:
+        return declaration
+    declaration.name = values[position + 1]
+    rest = values[position + 2:]
+    if rest[:1] == ["["] and "]" in rest:
+        declaration.array = "".join(rest[:rest.index("]") + 1])
+        rest = rest[rest.index("]") + 1:]
+    depth = 0
+    for value in rest:
+        if value in ("(", "["):
+            depth += 1
+        elif value in (")", "]"):
+            depth -= 1
+        elif (value == "," and depth == 0) or value == "{":
+            return declaration
+    if rest[:1] == ["="] or rest == [";"]:
+        declaration.uniform_type = values[position]
+    return declaration
+
+def split_declarations(tokens):
+    """ Split a classified token stream into top level declarations, keeping every token. """
+    declarations = []
+    blank = []
+    current = []
+    paren_depth = 0
+    brace_depth = 0
+    is_struct = False
+
+    for token in tokens:
+        ptype, value = token
+        if not current:
+            if blank_types[ptype]:
+                blank.append(token)
+                continue
+            if blank:
+                declarations.append(Declaration("text", blank))
+                blank = []
+            if ptype == PREPROC:
+                declaration = Declaration("preproc", [token])
+                declaration.name = value.split()[0] if value.split() else value
+                declarations.append(declaration)
+                continue
+            is_struct = False
+
+        current.append(token)
+        #Structs and uniform blocks go on to their instance names
+        if (value == "struct" or value == "uniform") and brace_depth == 0 and paren_depth == 0:
+            is_struct = True
+        if ptype != PUNCTUATION:
+            continue
+        if value == "(":
+            paren_depth += 1
+        elif value == ")":
+            paren_depth -= 1
+        elif value == "{":
+            brace_depth += 1
+        elif value == "}":
+            brace_depth -= 1
+            if brace_depth == 0 and paren_depth == 0 and not is_struct:
+                declarations.append(make_declaration(current))
+                current = []
+        elif value == ";" and brace_depth == 0 and paren_depth == 0:
+            declarations.append(make_declaration(current))
+            current = []
+
+    if current:
+        declarations.append(Declaration("other", current))
+    if blank:
+        declarations.append(Declaration("text", blank))
+    return declarations
+
+def get_global_names(sig):
+    """ Names declared by a global declaration, leaving out the ones read by its initializers. """
+    names = set()
+    depth = 0
+    initializer = False
+    for index, (ptype, value) in enumerate(sig):
+        if value in ("(", "[", "{"):
+            depth += 1
+        elif value in (")", "]", "}"):
+            depth -= 1
+        elif depth == 0 and value == "=":
+            initializer = True
+        elif depth == 0 and value == ",":
+            initializer = False
+        elif depth == 0 and not initializer and ptype == NAME:
+            following = sig[index + 1][1] if index + 1 < len(sig) else None
+            if following in ("=", ";", ",", "["):
+                names.add(value)
+    return names
+
+def get_declared_names(declarations):
+    """ Every top level symbol a list of declarations defines, macros included. """
+    names = set()
+    for declaration in declarations:
+        kind = declaration.kind
+        if kind in ("function", "prototype", "struct"):
+            names.add(declaration.name)
+        elif kind == "uniform":
+            if declaration.name:
+                names.add(declaration.name)
+            else:
+                names |= declaration.names
+        elif kind == "global":
+            names |= get_global_names(significant(declaration.tokens))
+        elif kind == "preproc" and declaration.name == "#define":
+            words = declaration.tokens[0][1].split()
+            if len(words) > 1:
+                names.add(words[1].split("(")[0])
+    return names
+
+def get_body(sig):
+    """ (opening, closing) index of the braces of a struct or uniform block, None when it has none. """
+    for index, (ptype, value) in enumerate(sig):
+        if value == "{":
+            for close in range(len(sig) - 1, index, -1):
+                if sig[close][1] == "}":
+                    return index, close
+            return None
+    return None
+
+def get_uniform_symbols(declaration, sig):
+    """ (name, kind) of the symbols a uniform declaration declares. """
+    if declaration.name:
+        return [(declaration.name, "uniform")]
+    body = get_body(sig)
+    if body is None:
+        return [(name, "uniform") for name in sorted(get_global_names(sig))]
+    open_index, close = body
+    symbols = []
+    if open_index > 0 and sig[open_index - 1][0] in (NAME, KEYWORD_TYPE):
+        symbols.append((sig[open_index - 1][1], "block"))
+    instances = get_global_names(sig[close + 1:])
+    if instances:
+        symbols += [(name, "block") for name in sorted(instances)]
+    else:
+        #Without an instance name, the members are used as they are
+        symbols += [(name, "uniform") for name in sorted(get_global_names(sig[open_index + 1 : close]))]
+    return symbols
+
+
+class Resolver():
+    """ Walks the significant tokens of a declaration and records the ones that refer to layer symbols. """
+
+    def __init__(self, tree, declaration):
+        self.tree = tree
+        self.symbols = tree.symbols
+        self.declaration = declaration
+        tokens = self.tokens = declaration.tokens
+        self.indices = [index for index, (ptype, value) in enumerate(tokens)
+            if not (blank_types[ptype] or value.isspace())]
+        self.sig = [tokens[index] for index in self.indices]
+        self.matches = match_brackets(self.sig)
+        self.scopes = []
+        self.references = []
+        self.calls = []
+
+    def resolve(self):
+        declaration = self.declaration
+        kind = declaration.kind
+        sig = self.sig
+        if kind == "function":
+            self.function(bisect_left(self.indices, declaration.param_open))
+        elif kind == "prototype":
+            values = [value for ptype, value in sig]
+            self.function(values.index("("))
+        elif kind == "struct" or (kind == "uniform" and get_body(sig) is not None):
+            open_index, close = get_body(sig)
+            self.names(0, open_index)
+            if kind == "struct" or get_global_names(sig[close + 1:]):
+                #Members are only reached through an instance
+                self.block(open_index + 1, close)
+            else:
+                self.names(open_index + 1, close)
+            self.names(close + 1, len(sig))
+        else:
+            self.names(0, len(sig))
+        #Declarations without references keep the shared empty defaults
+        if self.references:
+            declaration.references = self.references
+        if self.calls:
+            declaration.calls = self.calls
+
+    def name(self, position, call=True):
+        """ Record the token at position when it refers to a layer symbol. """
+        ptype, value = self.sig[position]
+        symbol = self.symbols.get(value)
+        if symbol is None:
+            if ptype == PREPROC:
+                self.tree.resolve_directive(self.declaration, self.indices[position])
+                self.declaration.preprocessed = True
+            return
+        if ptype not in IDENTIFIERS or value in BUILTIN_TYPES:
+            return
+        index = self.indices[position]
+        if value in NUMBER_SUFFIXES and index > 0 and self.tokens[index - 1][0].startswith("Token.Literal.Number"):
+            return
+        for scope in self.scopes:
+            if value in scope:
+                return
+        self.references.append((index, symbol))
+        following = position + 1
+        if call and symbol.kind == "function" and following < len(self.sig) and self.sig[following][1] == "(":
+            close = self.matches.get(following)
+            if close is not None:
+                self.calls.append((self.indices[close], symbol, close > following + 1))
+
+    def names(self, start, end):
+        for position in range(start, end):
+            self.name(position)
+
+    def function(self, open_position):
+        sig = self.sig
+        close = self.matches.get(open_position, len(sig) - 1)
+        for position in range(open_position):
+            self.name(position, False)
+        self.scopes.append(set())
+        self.parameters(open_position + 1, close)
+        body = close + 1
+        if body < len(sig) and sig[body][1] == "{":
+            self.block(body + 1, self.matches.get(body, len(sig)))
+        else:
+            self.names(body, len(sig))
+        self.scopes.pop()
+
+    def parameters(self, start, end):
+        """ Declare the parameters of sig[start:end] in the current scope, resolving the rest. """
+        sig = self.sig
+        matches = self.matches
+        scope = self.scopes[-1]
+        position = start
+        while position < end:
+            names = []
+            parameter_start = position
+            while position < end and sig[position][1] != ",":
+                if sig[position][1] in ("(", "[") and position in matches:
+                    position = matches[position]
+                elif sig[position][0] in IDENTIFIERS:
+                    names.append(position)
+                position += 1
+            #A parameter name follows its type, void and unnamed parameters have a single one
+            declared = names[-1] if len(names) > 1 else None
+            for index in range(parameter_start, position):
+                if index == declared:
+                    scope.add(sig[index][1])
+                else:
+                    self.name(index)
+            position += 1
+
+    def block(self, start, end):
+        """ The statements of sig[start:end], in a scope of their own. """
+        sig = self.sig
+        self.scopes.append(set())
+        position = start
+        while position < end:
+            value = sig[position][1]
+            if value == "{":
+                close = min(self.matches.get(position, end), end)
+                self.block(position + 1, close)
+                position = close + 1
+            elif value == "for" and position + 1 < end and position + 1 in self.matches:
+                position = self.for_loop(position, end)
+            elif sig[position][0] == PREPROC:
+                self.name(position)
+                position += 1
+            else:
+                position = self.statement(position, end)
+        self.scopes.pop()
+
+    def for_loop(self, position, end):
+        """ A for loop, its header declaring the loop variables for its body. Returns the position after it. """
+        sig = self.sig
+        open_index = position + 1
+        close = min(self.matches[open_index], end)
+        self.scopes.append(set())
+        header = self.statement(open_index + 1, close)
+        self.names(header, close)
+        body = close + 1
+        body_end = min(get_statement_end(sig, body, self.matches), end - 1)
+        if body < end and sig[body][1] == "{":
+            self.block(body + 1, body_end)
+        else:
+            self.block(body, body_end + 1)
+        self.scopes.pop()
+        return body_end + 1
+
+    def is_declaration(self, position, end):
+        """ Whether sig[position:] starts with a type followed by a variable name. """
+        sig = self.sig
+        ptype, value = sig[position]
+        if ptype not in IDENTIFIERS:
+            return False
+        position += 1
+        if position < end and sig[position][1] == "[" and position in self.matches:
+            position = self.matches[position] + 1
+        return position < end and sig[position][0] == NAME
+
+    def statement(self, start, end):
+        """ A declaration or an expression statement, returns the position after it. """
+        sig = self.sig
+        position = start
+        while position < end and sig[position][1] in QUALIFIERS:
+            position += 1
+        if position < end and self.is_declaration(position, end):
+            return self.declarators(position, end)
+        return self.expression(start, end)
+
+    def expression(self, start, end):
+        """ Resolve up to the end of a statement, stopping before a block or a loop inside it. """
+        sig = self.sig
+        position = start
+        while position < end:
+            value = sig[position][1]
+            if value == ";":
+                return position + 1
+            if position > start and (value == "{" or value == "for"):
+                return position
+            self.name(position)
+            position += 1
+        return position
+
+    def declarators(self, position, end):
+        sig = self.sig
+        matches = self.matches
+        self.name(position)
+        position += 1
+        if sig[position][1] == "[" and position in matches:
+            self.names(position + 1, matches[position])
+            position = matches[position] + 1
+        scope = self.scopes[-1]
+        while position < end:
+            name = sig[position][1]
+            position += 1
+            if position < end and sig[position][1] == "[" and position in matches:
+                self.names(position + 1, matches[position])
+                position = matches[position] + 1
+            if position < end and sig[position][1] == "=":
+                position = self.initializer(position + 1, end)
+            #A variable is only in scope after its initializer
+            scope.add(name)
+            if position + 1 < end and sig[position][1] == "," and sig[position + 1][0] == NAME:
+                position += 1
+                continue
+            break
+        return self.expression(position, end)
+
+    def initializer(self, start, end):
+        sig = self.sig
+        depth = 0
+        position = start
+        while position < end:
+            value = sig[position][1]
+            if value in ("(", "[", "{"):
+                depth += 1
+            elif value in (")", "]", "}"):
+                depth -= 1
+            elif depth == 0 and (value == "," or value == ";"):
+                return position
+            self.name(position)
+            position += 1
+        return position
+
+
+class LayerTree():
+    """ Top level declarations of a layer source, its symbol table and the references to it. """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.declarations = split_declarations(tokens)
+        self.symbols = {}
+        self.uniforms = {}
+        self.functions = {}
+        self.includes = []
+        self.declared_names = get_declared_names(self.declarations)
+        #Preprocessor logic other than includes, which ties the layer code to its place in the source
+        self.macros = False
+        #Definitions and prototypes of each function name
+        self.definitions = {}
+        #Results of the passes run on the tree, by pass name
+        self.results = {}
+        self.declare()
+        for declaration in self.declarations:
+            if declaration.kind == "preproc":
+                self.resolve_directive(declaration, 0)
+            elif declaration.kind != "text":
+                Resolver(self, declaration).resolve()
+
+    def add_symbol(self, name, kind, declaration):
+        symbol = self.symbols.get(name)
+        if symbol is None:
+            symbol = self.symbols[name] = Symbol(name, kind)
+        symbol.declarations.append(declaration)
+
+    def declare(self):
+        conditional_depth = 0
+        #Macros defined before an include can configure it, they keep their name
+        last_include = -1
+        for position, declaration in enumerate(self.declarations):
+            if declaration.kind == "preproc" and declaration.name == "#include":
+                last_include = position
+
+        for position, declaration in enumerate(self.declarations):
+            kind = declaration.kind
+            declaration.conditional = conditional_depth > 0
+            if kind == "uniform":
+                if declaration.name and declaration.uniform_type:
+                    self.uniforms[declaration.name] = declaration
+                for name, symbol_kind in get_uniform_symbols(declaration, significant(declaration.tokens)):
+                    self.add_symbol(name, symbol_kind, declaration)
+            elif kind == "function":
+                self.definitions[declaration.name] = self.definitions.get(declaration.name, 0) + 1
+                self.add_symbol(declaration.name, "function", declaration)
+            elif kind == "prototype":
+                self.definitions[declaration.name] = self.definitions.get(declaration.name, 0) + 1
+            elif kind == "global":
+                for name in sorted(get_global_names(significant(declaration.tokens))):
+                    self.add_symbol(name, "global", declaration)
+            elif kind == "struct":
+                self.add_symbol(declaration.name, "struct", declaration)
+                sig = significant(declaration.tokens)
+                body = get_body(sig)
+                if body is not None:
+                    for name in sorted(get_global_names(sig[body[1] + 1:])):
+                        self.add_symbol(name, "global", declaration)
+            elif kind == "preproc" and declaration.name == "#include":
+                #Includes under a condition or after a macro definition depend on their place
+                declaration.hoisted = conditional_depth == 0 and not self.macros
+                self.includes.append(declaration)
+            elif kind == "preproc":
+                self.macros = True
+                directive, text = split_directive(declaration.tokens[0][1])
+                if directive in CONDITIONAL_OPEN:
+                    conditional_depth += 1
+                elif directive == CONDITIONAL_CLOSE:
+                    conditional_depth -= 1
+                elif directive == "#define" and position > last_include:
+                    match = MACRO_PATTERN.match(text)
+                    if match is not None:
+                        self.add_symbol(match.group(1), "macro", declaration)
+            elif kind == "other":
+                self.macros = True
+
+        for declaration in self.declarations:
+            kind = declaration.kind
+            if kind == "prototype":
+                #Only the prototypes of layer functions are symbols, the others declare a pipeline function
+                symbol = self.symbols.get(declaration.name)
+                if symbol is not None and symbol.kind == "function":
+                    symbol.declarations.append(declaration)
+            elif kind == "function" and self.definitions[declaration.name] == 1:
+                self.functions[declaration.name] = declaration
+
+    def resolve_directive(self, declaration, index):
+        """ Split a directive around the layer symbols it names, macro parameters left out. """
+        value = declaration.tokens[index][1]
+        directive, text = split_directive(value)
+        if directive not in SYMBOL_DIRECTIVES:
+            return
+        parameters = ()
+        if directive == "#define":
+            match = MACRO_PATTERN.match(text)
+            if match is not None and match.group(2):
+                parameters = set(parameter.strip() for parameter in match.group(2).split(","))
+        pieces = []
+        last = 0
+        for match in DIRECTIVE_NAME_PATTERN.finditer(value, len(value) - len(text)):
+            symbol = self.symbols.get(match.group())
+            if symbol is None or match.group() in parameters:
+                continue
+            pieces += [value[last : match.start()], symbol]
+            last = match.end()
+        if pieces:
+            pieces.append(value[last:])
+            if declaration.directives is None:
+                declaration.directives = {}
+            declaration.directives[index] = pieces
+
+    def get_names(self, kind):
+        return frozenset(name for name, symbol in self.symbols.items() if symbol.kind == kind)
+
+    def get_referenced(self, declaration):
+        """ The symbols a declaration refers to, in its code and in its directives. """
+        symbols = set(symbol for index, symbol in declaration.references)
+        for pieces in (declaration.directives or {}).values():
+            symbols.update(piece for piece in pieces if piece.__class__ is Symbol)
+        return symbols
+
+
+_layer_trees = OrderedDict()
+
+def get_layer_tree(tokens, max_entries=64):
+    """ LayerTree of a cached token stream, reused while the tokens stay cached. """
+    entry = _layer_trees.get(id(tokens))
+    if entry is not None and entry[0] is tokens:
+        _layer_trees.move_to_end(id(tokens))
+        return entry[1]
+    tree = LayerTree(tokens)
+    _layer_trees[id(tokens)] = (tokens, tree)
+    while len(_layer_trees) > max_entries:
+        _layer_trees.popitem(last=False)
+    return tree
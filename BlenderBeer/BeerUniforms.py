@@ -0,0 +1,274 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Optional packing of the layer uniforms into std140 uniform blocks, one per layer or one per stack.
+# The blocks have no instance name, so their members keep the names the layer code already uses.
+# Samplers, uniforms under a preprocessor condition and uniforms whose default is not a literal stay loose.
+# Blocks are only compiled headless, Malt can't bind a uniform buffer. Their members have no initializers,
+# so the layout written next to the shader holds the defaults for the program that fills the buffers.
+# The same uniforms can be baked instead, declared as constants holding the current parameter values.
+
+import math
+from .BeerLexer import OPERATOR, rename_symbol
+from .BeerTree import significant
+
+BLOCK_MODES = ("NONE", "LAYER", "STACK")
+STACK_BLOCK_NAME = "BEER_UNIFORMS"
+
+#(struct format, rows, columns) of the types a block can hold
+TYPE_FORMATS = {
+    'float' : ('f', 1, 1), 'vec2' : ('f', 2, 1), 'vec3' : ('f', 3, 1), 'vec4' : ('f', 4, 1),
+    'int' : ('i', 1, 1), 'ivec2' : ('i', 2, 1), 'ivec3' : ('i', 3, 1), 'ivec4' : ('i', 4, 1),
+    'uint' : ('I', 1, 1), 'uvec2' : ('I', 2, 1), 'uvec3' : ('I', 3, 1), 'uvec4' : ('I', 4, 1),
+    'bool' : ('I', 1, 1), 'bvec2' : ('I', 2, 1), 'bvec3' : ('I', 3, 1), 'bvec4' : ('I', 4, 1),
+    'mat2' : ('f', 2, 2), 'mat3' : ('f', 3, 3), 'mat4' : ('f', 4, 4),
+    'mat2x2' : ('f', 2, 2), 'mat2x3' : ('f', 3, 2), 'mat2x4' : ('f', 4, 2),
+    'mat3x2' : ('f', 2, 3), 'mat3x3' : ('f', 3, 3), 'mat3x4' : ('f', 4, 3),
+    'mat4x2' : ('f', 2, 4), 'mat4x3' : ('f', 3, 4), 'mat4x4' : ('f', 4, 4),
+}
+
+
+def get_layer_block_name(prefix):
+    return STACK_BLOCK_NAME + "_" + prefix
+
+def round_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+def get_std140(uniform_type, count):
+    """ (alignment, size, array stride) of a member, following the std140 rules. """
+    base, rows, columns = TYPE_FORMATS[uniform_type]
+    vector_size = 4 * rows
+    vector_alignment = 16 if rows >= 3 else vector_size
+    if columns > 1 or count > 1:
+        #Matrix columns and array elements are padded to a vec4
+        stride = 16 * columns
+        return 16, stride * count, stride
+    return vector_alignment, vector_size, vector_size
+
+def parse_array(sig):
+    """ Element count of a [N] suffix, 1 when there is none, None when N is not a literal. """
+    if sig[:1] != ["["]:
+        return 1
+    if len(sig) >= 3 and sig[2] == "]" and sig[1].isdigit():
+        return int(sig[1])
+    return None
+
+def parse_default(sig, uniform_type):
+    """ Flat list of the values of a literal initializer, None when it is anything else. """
+    base, rows, columns = TYPE_FORMATS[uniform_type]
+    components = rows * columns
+    values = []
+    negate = False
+    after_integer = False
+    start = 0
+    if len(sig) > 1 and sig[0][1] == uniform_type and sig[1][1] == "(" and sig[-1][1] == ")":
+        start = 2
+        sig = sig[:-1]
+    for ptype, value in sig[start:]:
+        #The lexer splits the suffix of an unsigned literal like 1u off the number
+        if after_integer and value in ("u", "U"):
+            after_integer = False
+            continue
+        after_integer = False
+        if ptype == OPERATOR and value == "-" and not negate:
+            negate = True
+            continue
+        if value == ",":
+            continue
+        if value in ("true", "false"):
+            number = 1.0 if value == "true" else 0.0
+        elif ptype.startswith("Token.Literal.Number"):
+            try:
+                number = float(int(value, 0)) if ptype != "Token.Literal.Number.Float" else float(value.rstrip("fF"))
+            except ValueError:
+                return None
+            after_integer = ptype != "Token.Literal.Number.Float"
+        else:
+            return None
+        values.append(-number if negate else number)
+        negate = False
+    if len(values) == components:
+        return values
+    if len(values) == 1 and columns > 1:
+        #A single value makes a diagonal matrix
+        return [values[0] if row == column else 0.0 for column in range(columns) for row in range(rows)]
+    if len(values) == 1:
+        return values * components
+    return None
+
+
+class BlockMember():
+
+    def __init__(self, name, key, uniform_type, count, default):
+        self.name = name
+        self.key = key
+        self.uniform_type = uniform_type
+        self.count = count
+        self.default = default
+        self.offset = 0
+        self.alignment, self.size, self.stride = get_std140(uniform_type, count)
+
+    def get_declaration(self):
+        return "{} {}{}".format(self.uniform_type, self.name, "[{}]".format(self.count) if self.count > 1 else "")
+
+    def as_dict(self):
+        return {
+            "type" : self.uniform_type,
+            "count" : self.count,
+            "offset" : self.offset,
+            "size" : self.size,
+            "stride" : self.stride,
+            "key" : self.key,
+            "default" : self.default,
+        }
+
+
+class UniformBlock():
+    """ A std140 uniform block and the byte layout of its members. """
+
+    def __init__(self, name):
+        self.name = name
+        self.members = []
+        self.names = {}
+        self.end = 0
+        self.size = 0
+
+    def add(self, member):
+        member.offset = round_up(self.end, member.alignment)
+        self.end = member.offset + member.size
+        self.size = round_up(self.end, 16)
+        self.members.append(member)
+        self.names[member.name] = member
+
+    def get_source(self):
+        if not self.members:
+            return ""
+        lines = ["layout(std140) uniform " + self.name, "{"]
+        lines += ["    " + member.get_declaration() + ";" for member in self.members]
+        return "\n".join(lines) + "\n};\n"
+
+    def as_dict(self):
+        return {
+            "size" : self.size,
+            "members" : {member.name : member.as_dict() for member in self.members},
+        }
+
+def flatten(value):
+    if isinstance(value, (int, float, bool)):
+        return [value]
+    if isinstance(value, str):
+        raise TypeError("not a number: " + value)
+    values = []
+    for item in value:
+        if isinstance(item, (int, float, bool)):
+            values.append(item)
+        else:
+            values += flatten(item)
+    return values
+
+
+def get_packable_uniforms(layer_functions):
+    """ (declaration, type, count, default) of the uniforms of a layer a block can hold, in order. """
+    packable = []
+    for declaration in layer_functions.declarations:
+        if declaration.kind != "uniform" or declaration.conditional:
+            continue
+        if declaration.name is None or declaration.uniform_type not in TYPE_FORMATS:
+            continue
+        sig = significant(declaration.tokens)
+        values = [value for ptype, value in sig]
+        position = values.index(declaration.name) + 1
+        count = parse_array(values[position:])
+        if count is None:
+            continue
+        if count > 1:
+            position += 3
+        default = None
+        if values[position] == "=":
+            if count > 1:
+                continue
+            default = parse_default(sig[position + 1 : -1], declaration.uniform_type)
+            if default is None:
+                continue
+        packable.append((declaration, declaration.uniform_type, count, default))
+    return packable
+
+
+def to_literal(uniform_type, value):
+    """ GLSL literal of a parameter value, None when the value does not fit the uniform type. """
+    base, rows, columns = TYPE_FORMATS[uniform_type]
+    try:
+        values = flatten(value)
+    except TypeError:
+        return None
+    if len(values) != rows * columns:
+        return None
+    literals = []
+    for number in values:
+        if not math.isfinite(number):
+            return None
+        if uniform_type.startswith("b"):
+            literals.append("true" if number else "false")
+        elif base == 'f':
+            literals.append(repr(float(number)))
+        elif int(number) != number or (base == 'I' and number < 0):
+            return None
+        else:
+            literals.append(str(int(number)) + ("u" if base == 'I' else ""))
+    if len(literals) == 1:
+        return literals[0]
+    return "{}({})".format(uniform_type, ", ".join(literals))
+
+def get_baked_uniforms(layer_functions, values, prefix):
+    """ The const declaration replacing each uniform of a layer that has a value in values. """
+    baked = {}
+    for declaration, uniform_type, count, default in get_packable_uniforms(layer_functions):
+        if count > 1 or declaration.name not in values:
+            continue
+        literal = to_literal(uniform_type, values[declaration.name])
+        if literal is not None:
+            baked[declaration] = "const {} {} = {};".format(uniform_type, rename_symbol(declaration.name, prefix), literal)
+    return baked
+
+
+class StackBlocks():
+    """ The uniform blocks of a stack and the uniform declarations they replace, baked uniforms left out. """
+
+    def __init__(self, stack_functions, prefixes, mode="LAYER", baked=None):
+        self.mode = mode
+        self.blocks = []
+        self.layer_blocks = []
+        self.packed = []
+        stack_block = UniformBlock(STACK_BLOCK_NAME)
+        for position, (layer_functions, prefix) in enumerate(zip(stack_functions, prefixes)):
+            block = stack_block if mode == "STACK" else UniformBlock(get_layer_block_name(prefix))
+            packed = set()
+            for declaration, uniform_type, count, default in get_packable_uniforms(layer_functions):
+                if baked is not None and declaration in baked[position]:
+                    continue
+                name = rename_symbol(declaration.name, prefix)
+                block.add(BlockMember(name, declaration.name, uniform_type, count, default))
+                packed.add(declaration)
+            self.packed.append(packed)
+            if mode == "LAYER":
+                self.layer_blocks.append(block)
+                if block.members:
+                    self.blocks.append(block)
+        if mode == "STACK" and stack_block.members:
+            self.blocks.append(stack_block)
+
+    def get_header(self):
+        """ The stack block, written after the includes. """
+        if self.mode != "STACK":
+            return ""
+        return "".join(block.get_source() for block in self.blocks)
+
+    def get_layer_source(self, position):
+        if self.mode != "LAYER":
+            return ""
+        return self.layer_blocks[position].get_source()
+
+    def get_packed(self, position):
+        return self.packed[position]
+
+    def get_layout(self):
+        return {block.name : block.as_dict() for block in self.blocks}
@@ -11,18 +11,21 @@ bl_info = {
 
 import sys, os
 from os import path
-import bpy
+
+#bpy is only imported when the addon is registered, so the bpy-free modules
+#like BeerCompiler can be used outside of Blender
 
 
 def get_modules():
-    from . import BeerMaterial, BeerPanel
-    return [ BeerMaterial, BeerPanel ]
+    from . import BeerMaterial, BeerPanel, BeerSync, BeerScheduler
+    return [ BeerMaterial, BeerPanel, BeerSync, BeerScheduler ]
 
 classes=[
 ]
 
 def register():
     import importlib
+    import bpy
     for module in get_modules():
         importlib.reload(module)
 
@@ -33,6 +36,7 @@ def register():
 
 
 def unregister():
+    import bpy
     for _class in reversed(classes): bpy.utils.unregister_class(_class)
 
     for module in reversed(get_modules()):
@@ -0,0 +1,112 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Just enough of bpy and BlenderMalt to import the BEER modules that need them outside Blender.
+# Materials are plain objects, their Malt parameters a dict.
+
+import sys
+import types
+
+
+class MaltParameters(dict):
+
+    def get_parameters(self, resources, overrides):
+        return dict(self)
+
+
+class MaltSettings():
+
+    def __init__(self, source_path="", parameters=None):
+        self.shader_source = source_path
+        self.compiler_error = ""
+        self.parameters = MaltParameters(parameters or {})
+
+    def get_source_path(self):
+        return self.shader_source
+
+
+class Material():
+
+    def __init__(self, name, source_path="", parameters=None):
+        self.name = name
+        self.original = self
+        self.malt = MaltSettings(source_path, parameters)
+        self.beer = None
+
+    def as_pointer(self):
+        return id(self)
+
+
+class Layer(dict):
+    """ A BeerLayer, the index is read both as an attribute and as an ID property. """
+
+    def __init__(self, index, material, blend="DEFAULT", masked_layer=False, mute_layer=False):
+        super().__init__(index=index)
+        self.index = index
+        self.material = material
+        self.blend = blend
+        self.masked_layer = masked_layer
+        self.mute_layer = mute_layer
+
+
+class BeerMaterial(dict):
+    """ A BeerMaterial, its ID properties are the dict items. """
+
+    def __init__(self, material, layers):
+        super().__init__()
+        self.material = material
+        self.layers = layers
+        self.is_beer_mat = True
+        material.beer = self
+
+    def as_pointer(self):
+        return id(self)
+
+
+class Materials(dict):
+
+    def new(self, name):
+        material = Material(name)
+        self[name] = material
+        return material
+
+    def __iter__(self):
+        return iter(self.values())
+
+
+class Timers():
+
+    def __init__(self):
+        self.functions = []
+
+    def register(self, function, first_interval=0.0, persistent=False):
+        self.functions.append(function)
+
+    def unregister(self, function):
+        self.functions.remove(function)
+
+    def is_registered(self, function):
+        return function in self.functions
+
+
+def persistent(function):
+    return function
+
+def install():
+    """ Add the stub modules to sys.modules, unless the real ones are importable already. """
+    if 'bpy' in sys.modules:
+        return sys.modules['bpy']
+    bpy = types.ModuleType('bpy')
+    bpy.types = types.ModuleType('bpy.types')
+    bpy.types.Material = Material
+    bpy.props = types.ModuleType('bpy.props')
+    bpy.app = types.ModuleType('bpy.app')
+    bpy.app.timers = Timers()
+    bpy.app.handlers = types.ModuleType('bpy.app.handlers')
+    bpy.app.handlers.persistent = persistent
+    for name in ('depsgraph_update_post', 'load_post', 'undo_post', 'redo_post'):
+        setattr(bpy.app.handlers, name, [])
+    bpy.data = types.SimpleNamespace(materials=Materials())
+    malt = types.ModuleType('BlenderMalt')
+    for module in (bpy, bpy.types, bpy.props, bpy.app, bpy.app.handlers, malt):
+        sys.modules[module.__name__] = module
+    return bpy
@@ -0,0 +1,259 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Times the stages of the BEER compiler on synthetic shaders and stacks, without Blender.
+# Usage: python benchmarks/compiler_benchmark.py [--quick] [--save] [--baseline path] [--only pattern]
+# Every stage is compared with the stored baseline, and the run fails when one got slower or
+# uses more memory than the tolerance allows. --save stores the results as the new baseline.
+# Timings are divided by a pure Python calibration loop, so baselines carry over between machines.
+
+import os, sys, time, json, fnmatch, argparse, tempfile, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bpy_stub
+bpy = bpy_stub.install()
+
+import synthetic
+from BlenderBeer import BeerCompiler, BeerInclude, BeerSync
+from BlenderBeer.BeerLexer import tokenize, lex_passes, lex_source
+from BlenderBeer.BeerCompiler import LayerSpec
+from BlenderBeer.BeerGraph import prune_layers
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+SHADER_LINES = (50, 200, 1000, 5000, 20000)
+STACK_LAYERS = (1, 10, 50, 200, 500)
+QUICK_SHADER_LINES = (50, 1000, 5000)
+QUICK_STACK_LAYERS = (1, 50, 200)
+#Worker processes of the batch case
+BATCH_JOBS = 4
+
+#Differences below these are noise, whatever the ratio
+MIN_TIME = 0.001
+MIN_MEMORY = 64 * 1024
+
+
+class Case():
+    """ A stack of synthetic layers and the stages timed on it. """
+
+    def __init__(self, name, lines, layers, pattern, shaders, stages):
+        self.name = name
+        self.lines = lines
+        self.layers = layers
+        self.pattern = pattern
+        self.shaders = shaders
+        self.stages = stages
+
+    def setup(self, directory):
+        paths = synthetic.write_shaders(os.path.join(directory, 'shaders'), self.lines, self.shaders)
+        self.texts = []
+        for path in paths:
+            with open(path) as f:
+                self.texts.append(f.read())
+        stack = synthetic.generate_stack(self.layers, self.pattern, paths)
+        self.specs = [LayerSpec.from_dict(layer) for layer in stack]
+        self.live_layers, pruned = prune_layers(self.specs)
+        self.beer_mat = make_beer_material(self.name, stack, paths, self.texts)
+
+    def get_stage(self, stage):
+        if stage == "lex_passes":
+            return lambda: [list(lex_passes(tokenize(text))) for text in self.texts]
+        if stage == "classify":
+            return lambda: [tuple(lex_source(text)) for text in self.texts]
+        if stage == "compile_layer_source":
+            def compile_layers():
+                #Start from cold token caches, the cost of lexing is part of the stage
+                BeerCompiler.token_cache.clear()
+                return BeerCompiler.compile_layer_source(self.live_layers)
+            return compile_layers
+        if stage == "compile_function_source":
+            return lambda: BeerCompiler.compile_function_source(self.live_layers)
+        if stage == "copy_properties":
+            return lambda: BeerSync.link_material(self.beer_mat)
+        raise ValueError("Unknown stage " + stage)
+
+
+class BatchCase(Case):
+    """ Stacks that all start with the same layer source, compiled together by compile_batch. """
+
+    def __init__(self, name, lines, layers, stacks, shaders, jobs):
+        super().__init__(name, lines, layers, "mixed", shaders, ("compile_batch",))
+        self.stacks = stacks
+        self.jobs = jobs
+
+    def setup(self, directory):
+        paths = synthetic.write_shaders(os.path.join(directory, 'shaders'), self.lines, self.shaders)
+        self.requests = []
+        for i in range(self.stacks):
+            #The first source is in every stack, the others differ from one stack to the next
+            shift = 1 + i % (len(paths) - 1)
+            stack = synthetic.generate_stack(self.layers, self.pattern, [paths[0]] + paths[shift:] + paths[1:shift])
+            layers = [LayerSpec.from_dict(layer) for layer in stack]
+            self.requests.append((self.name + str(i), BeerCompiler.StackSpec(self.name + str(i), layers)))
+
+    def get_stage(self, stage):
+        if stage == "compile_batch":
+            def compile_batch():
+                BeerCompiler.token_cache.clear()
+                BeerCompiler.layer_code_cache.clear()
+                return BeerCompiler.compile_batch(self.requests, self.jobs)
+            return compile_batch
+        raise ValueError("Unknown stage " + stage)
+
+
+def make_beer_material(name, stack, paths, texts):
+    """ A stub BEER material whose Malt material has every prefixed uniform of its layers. """
+    materials = bpy.data.materials
+    layer_materials = {}
+    for path, text in zip(paths, texts):
+        layer_materials[path] = bpy_stub.Material(os.path.basename(path), path, synthetic.get_uniforms(text))
+    layers = []
+    parameters = {}
+    for layer in stack:
+        material = layer_materials[layer["source_path"]]
+        materials[material.name] = material
+        layers.append(bpy_stub.Layer(layer["index"], material))
+        prefix = BeerCompiler.get_prefix(layer["index"])
+        for key, value in material.malt.parameters.items():
+            parameters[BeerSync.rename_symbol(key, prefix)] = value
+    material = bpy_stub.Material(name, "", parameters)
+    materials[name] = material
+    return bpy_stub.BeerMaterial(material, layers)
+
+def get_cases(quick=False):
+    cases = []
+    for lines in (QUICK_SHADER_LINES if quick else SHADER_LINES):
+        cases.append(Case("lines-{}".format(lines), lines, 4, "mixed", 4,
+            ("lex_passes", "classify", "compile_layer_source", "compile_function_source", "copy_properties")))
+    for layers in (QUICK_STACK_LAYERS if quick else STACK_LAYERS):
+        cases.append(Case("layers-{}".format(layers), 200, layers, "mixed", 16,
+            ("compile_layer_source", "compile_function_source", "copy_properties")))
+    for pattern in synthetic.PATTERNS:
+        cases.append(Case("pattern-{}".format(pattern), 200, 50, pattern, 16,
+            ("compile_layer_source", "compile_function_source")))
+    cases.append(BatchCase("batch-shared", 1000, 8, 16, 16, BATCH_JOBS))
+    return cases
+
+def best_time(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def peak_memory(function):
+    """ Peak of the memory allocated while function runs, over what was allocated before. """
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+def calibrate(repeat=5):
+    """ Time of a fixed pure Python workload, the unit timings are compared in. """
+    def workload():
+        table = {}
+        for i in range(200000):
+            key = "name_" + str(i % 1000)
+            table[key] = table.get(key, 0) + len(key)
+        return table
+    return best_time(workload, repeat)
+
+def run(cases, repeat, directory):
+    results = {}
+    for case in cases:
+        case.setup(directory)
+        results[case.name] = {}
+        for stage in case.stages:
+            function = case.get_stage(stage)
+            function()
+            results[case.name][stage] = {
+                "time" : best_time(function, repeat),
+                "peak" : peak_memory(function),
+            }
+            print('{:<20} {:<26} {:>12.3f} ms {:>10.1f} KB'.format(case.name, stage,
+                results[case.name][stage]["time"] * 1000.0, results[case.name][stage]["peak"] / 1024.0), flush=True)
+    return results
+
+def compare(results, calibration, baseline, tolerance, memory_tolerance):
+    """ The stages that got slower or use more memory than the baseline allows. """
+    regressions = []
+    scale = calibration / baseline["calibration"]
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline["cases"].get(case, {}).get(stage)
+            if base is None:
+                continue
+            expected_time = base["time"] * scale
+            if result["time"] > expected_time * (1.0 + tolerance) and result["time"] - expected_time > MIN_TIME:
+                regressions.append("{} {}: {:.3f} ms, baseline {:.3f} ms".format(
+                    case, stage, result["time"] * 1000.0, expected_time * 1000.0))
+            if result["peak"] > base["peak"] * (1.0 + memory_tolerance) and result["peak"] - base["peak"] > MIN_MEMORY:
+                regressions.append("{} {}: {:.1f} KB peak, baseline {:.1f} KB".format(
+                    case, stage, result["peak"] / 1024.0, base["peak"] / 1024.0))
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmark the BEER compiler stages against a stored baseline.")
+    parser.add_argument('--quick', action='store_true', help="run a smaller set of cases")
+    parser.add_argument('--only', help="only run the cases whose name matches this pattern, like 'layers-*'")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each stage, the best one is kept")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument('--memory-tolerance', type=float, default=0.10, help="allowed relative peak memory growth")
+    args = parser.parse_args(args)
+
+    #Only the synthetic pipeline is searched, not a Malt install that happens to be importable
+    BeerInclude._default_paths = []
+    cases = get_cases(args.quick)
+    if args.only:
+        cases = [case for case in cases if fnmatch.fnmatch(case.name, args.only)]
+
+    calibration = calibrate()
+    print('calibration: {:.3f} ms'.format(calibration * 1000.0))
+    with tempfile.TemporaryDirectory() as directory:
+        BeerInclude.include_paths[:] = [synthetic.write_pipeline(directory)]
+        results = run(cases, args.repeat, directory)
+
+    baseline = None
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.save:
+        cases_data = {}
+        if baseline is not None and (args.only or args.quick):
+            #Partial runs update their own cases, the others are kept in the units of this machine
+            cases_data = baseline["cases"]
+            scale = calibration / baseline["calibration"]
+            for stages in cases_data.values():
+                for result in stages.values():
+                    result["time"] *= scale
+        cases_data.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({"calibration" : calibration, "python" : sys.version.split()[0], "cases" : cases_data},
+                f, indent=1, sort_keys=True)
+        print('baseline saved to ' + args.baseline)
+        return 0
+
+    if baseline is None:
+        print('no baseline at {}, run with --save to store one'.format(args.baseline))
+        return 0
+    regressions = compare(results, calibration, baseline, args.tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if regressions:
+        return 1
+    print('no regressions')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Compares the built-in GLSL tokenizer with pygments on a set of layer shaders.
+# Usage: python benchmarks/lexer_benchmark.py [shader files or folders...]
+# With no arguments, the shaders of the Malt submodule are used.
+
+import os, sys, glob, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'BlenderBeer'))
+
+import BeerLexer
+
+
+def collect_shaders(paths):
+    shaders = []
+    for path in paths:
+        if os.path.isdir(path):
+            shaders += sorted(glob.glob(os.path.join(path, '**', '*.glsl'), recursive=True))
+        else:
+            shaders.append(path)
+    return shaders
+
+def best_time(function, text, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for token in function(text):
+            pass
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(args):
+    repeat = 5
+    shaders = collect_shaders(args or [os.path.join(ROOT, 'Malt')])
+    if not shaders:
+        print("No shaders found, pass shader files or folders as arguments.")
+        return 1
+
+    try:
+        import pygments
+    except ImportError:
+        pygments = None
+
+    total_builtin = 0.0
+    total_pygments = 0.0
+    print('{:<60} {:>10} {:>12} {:>12} {:>8}'.format('shader', 'bytes', 'builtin ms', 'pygments ms', 'speedup'))
+    for path in shaders:
+        with open(path) as f:
+            text = f.read()
+        builtin = best_time(BeerLexer.lex_source, text, repeat)
+        total_builtin += builtin
+        name = os.path.relpath(path, ROOT) if path.startswith(ROOT) else path
+        row = [name[-60:], len(text), builtin * 1000.0]
+        if pygments:
+            reference = best_time(BeerLexer.lex_source_pygments, text, repeat)
+            total_pygments += reference
+            row += [reference * 1000.0, reference / builtin if builtin else 0.0]
+            print('{:<60} {:>10} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(*row))
+        else:
+            print('{:<60} {:>10} {:>12.3f}'.format(*row))
+
+    print('total builtin: {:.3f} ms'.format(total_builtin * 1000.0))
+    if pygments:
+        print('total pygments: {:.3f} ms ({:.2f}x)'.format(total_pygments * 1000.0, total_pygments / total_builtin))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,151 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# Synthetic layer shaders and stacks for the compiler benchmark.
+# Every shader shares a few helper functions with the others, so deduplication has work to do,
+# and grows with functions of its own until it reaches the requested line count.
+
+import os
+import random
+
+BLEND_MODES = ("DEFAULT", "ADD", "SUBTRACT", "MULTIPLY", "DIVIDE", "SCREEN",
+    "OVERLAY", "DIFFERENCE", "LIGHTEN", "DARKEN", "DODGE", "BURN")
+
+PATTERNS = ("flat", "blends", "chain", "mask", "mixed")
+
+PIPELINE = """
+struct Surface
+{
+    vec3 position;
+    vec3 normal;
+    vec2 uv[4];
+};
+
+struct PixelOutput
+{
+    vec4 color;
+    vec4 line_color;
+    float line_width;
+};
+
+vec3 pipeline_light_direction(vec3 position);
+float pipeline_shadow(vec3 position, vec3 normal);
+"""
+
+SHARED_FUNCTIONS = """
+float luma(vec3 color)
+{
+    return dot(color, vec3(0.2126, 0.7152, 0.0722));
+}
+
+vec3 saturate_color(vec3 color, float amount)
+{
+    return mix(vec3(luma(color)), color, amount);
+}
+"""
+
+FUNCTION = """
+// helper {i} of layer shader {seed}
+vec3 shade_{i}(vec3 normal, float k)
+{{
+    vec3 light = pipeline_light_direction(normal * {a:.3f});
+    float d = clamp(dot(normal, light) * k + _bias_{u}, 0.0, 1.0);
+    vec3 color = tint_{u}.rgb * d * {b:.3f};
+    color = saturate_color(color, steps_{u} / {c:.1f});
+    return color + {call};
+}}
+"""
+
+MAIN = """
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{{
+    float shadow = pipeline_shadow(S.position, S.normal);
+    vec3 color = shade_{last}(S.normal, shadow);
+    PO.color = vec4(color, 1.0) * texture(ramp, S.uv[0]);
+    PO.line_color = LINE_COLOR;
+    PO.line_width = line_width;
+}}
+"""
+
+
+def generate_shader(lines, seed=0):
+    """ GLSL source of a layer shader of about lines lines. """
+    rng = random.Random(seed)
+    uniforms = max(1, lines // 200)
+    parts = ['#include "Pipelines/NPR_Pipeline.glsl"\n\n']
+    parts.append("#define LINE_COLOR vec4(0.0, 0.0, 0.0, 1.0)\n\n")
+    for u in range(uniforms):
+        parts.append("uniform vec4 tint_{} = vec4({:.2f}, {:.2f}, {:.2f}, 1.0);\n".format(u, rng.random(), rng.random(), rng.random()))
+        parts.append("uniform float steps_{} = {:.1f};\n".format(u, rng.randint(2, 8)))
+        parts.append("uniform float _bias_{} = {:.2f};\n".format(u, rng.random()))
+    parts.append("uniform float line_width = 1.0;\nuniform sampler2D ramp;\n")
+    parts.append(SHARED_FUNCTIONS)
+    count = "".join(parts).count("\n") + MAIN.count("\n")
+    i = 0
+    while count < lines or i == 0:
+        call = "shade_{}(normal.zyx, k * 0.5)".format(i - 1) if i else "vec3(0.0)"
+        function = FUNCTION.format(i=i, seed=seed, u=rng.randrange(uniforms),
+            a=rng.random(), b=rng.random(), c=rng.uniform(1.0, 8.0), call=call)
+        parts.append(function)
+        count += function.count("\n")
+        i += 1
+    parts.append(MAIN.format(last=i - 1))
+    return "".join(parts)
+
+def write_pipeline(directory):
+    """ A stand-in for the Malt pipeline include, so include scanning has a file to read. """
+    path = os.path.join(directory, "Pipelines", "NPR_Pipeline.glsl")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(PIPELINE)
+    return directory
+
+def write_shaders(directory, lines, count):
+    """ Write count distinct shaders of about lines lines, returning their paths. """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for seed in range(count):
+        path = os.path.join(directory, "layer_{}_{}.mesh.glsl".format(lines, seed))
+        if not os.path.isfile(path):
+            with open(path, 'w') as f:
+                f.write(generate_shader(lines, seed))
+        paths.append(path)
+    return paths
+
+def get_uniforms(source):
+    """ Default values of the uniforms of a generated shader, the way Malt lists material parameters. """
+    uniforms = {}
+    for line in source.splitlines():
+        if line.startswith("uniform ") and "=" in line:
+            name = line.split("=")[0].split()[-1]
+            value = line.split("=")[1].strip().rstrip(";")
+            if value.startswith("vec4("):
+                uniforms[name] = tuple(float(x) for x in value[5:-1].split(","))
+            else:
+                uniforms[name] = float(value)
+    return uniforms
+
+def generate_stack(count, pattern, paths):
+    """ Layer field dicts of a stack of count layers, cycling through paths. """
+    layers = []
+    for i in range(count):
+        index = i + 1
+        layer = {"index" : index, "source_path" : paths[i % len(paths)]}
+        if pattern == "blends":
+            layer["blend"] = BLEND_MODES[i % len(BLEND_MODES)]
+        elif pattern == "chain":
+            layer["input_index"] = i
+        elif pattern == "mask":
+            if i % 2:
+                layer["masked_layer"] = True
+                layer["masking_index"] = i
+        elif pattern == "mixed":
+            layer["blend"] = BLEND_MODES[i % len(BLEND_MODES)]
+            if i % 3 == 1:
+                layer["input_index"] = i
+            if i % 4 == 2:
+                layer["masked_layer"] = True
+                layer["masking_index"] = i - 1
+            if i % 7 == 5:
+                layer["mute_layer"] = True
+        layers.append(layer)
+    return layers
@@ -0,0 +1,12 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# The tests import BlenderBeer from the repository root, and the bpy stub and
+# synthetic shaders from benchmarks, the same way the benchmarks do.
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
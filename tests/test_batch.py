@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer import BeerCompiler
+from BlenderBeer.BeerCompiler import LayerSpec, StackSpec, compile_batch, compile_incremental
+from BlenderBeer.BeerCompiler import get_source_groups, split_source_groups
+
+LAYER_SOURCE = """
+uniform float strength = {strength};
+
+vec4 shade(vec4 color)
+{{
+    return color * strength;
+}}
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{{
+    PO.color = shade(vec4(1.0, 0.5, 0.25, 0.5));
+}}
+"""
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = {}
+        for name, strength in (("shared", 0.5), ("rim", 0.25), ("glow", 2.0)):
+            path = self.paths[name] = os.path.join(directory.name, name + ".mesh.glsl")
+            with open(path, 'w') as f:
+                f.write(LAYER_SOURCE.format(strength=strength))
+        self.missing = os.path.join(directory.name, "missing.mesh.glsl")
+
+    def get_stacks(self):
+        return [
+            StackSpec("first", [LayerSpec(1, self.paths["shared"]), LayerSpec(2, self.paths["rim"], blend="ADD")]),
+            StackSpec("second", [LayerSpec(1, self.paths["glow"]),
+                LayerSpec(2, self.paths["shared"], blend="MULTIPLY", masked_layer=True, masking_index=1)],
+                mask_early_out=True),
+        ]
+
+    def get_expected(self, stack):
+        return compile_incremental(self.id() + ".expected." + stack.name, stack.layers,
+            mask_early_out=stack.mask_early_out)
+
+    def compile(self, stacks, jobs):
+        return compile_batch([(self.id() + "." + stack.name, stack) for stack in stacks], jobs)
+
+    def test_shared_source(self):
+        stacks = self.get_stacks()
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                results = self.compile(stacks, jobs)
+                self.assertEqual([result["name"] for result in results], ["first", "second"])
+                for stack, result in zip(stacks, results):
+                    self.assertIsNone(result["error"])
+                    self.assertEqual(result["source"], self.get_expected(stack))
+
+    def test_merge(self):
+        #A stack compiled in a worker leaves its layer code here, so the next compile rebuilds nothing
+        stacks = self.get_stacks()
+        self.compile(stacks, 2)
+        for stack in stacks:
+            key = self.id() + "." + stack.name
+            self.assertEqual(BeerCompiler.compile_reports[key]["rebuilt"], [1, 2])
+            self.assertEqual(compile_incremental(key, stack.layers, mask_early_out=stack.mask_early_out),
+                self.get_expected(stack))
+            self.assertEqual(BeerCompiler.compile_reports[key]["rebuilt"], [])
+
+    def test_failing_member(self):
+        stacks = self.get_stacks()
+        stacks.insert(1, StackSpec("broken", [LayerSpec(1, self.paths["shared"]), LayerSpec(2, self.missing)]))
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                results = self.compile(stacks, jobs)
+                self.assertIsNone(results[1]["source"])
+                self.assertTrue(results[1]["error"].startswith("FileNotFoundError"))
+                for position in (0, 2):
+                    self.assertIsNone(results[position]["error"])
+                    self.assertEqual(results[position]["source"], self.get_expected(stacks[position]))
+
+
+class SourceGroupTest(unittest.TestCase):
+
+    def get_stack(self, *sources):
+        return StackSpec("stack", [LayerSpec(index + 1, source) for index, source in enumerate(sources)])
+
+    def test_groups(self):
+        #0 and 2 share b, 3 joins them through d, 1 and 4 share nothing with them
+        stacks = [self.get_stack("a", "b"), self.get_stack("c"), self.get_stack("b", "d"), self.get_stack("d"),
+            self.get_stack("e", "c")]
+        self.assertEqual(get_source_groups(stacks), [[0, 2, 3], [1, 4]])
+
+    def test_merged_group(self):
+        #The last stack joins two groups found before it
+        stacks = [self.get_stack("a"), self.get_stack("b"), self.get_stack("a", "b")]
+        self.assertEqual(get_source_groups(stacks), [[0, 1, 2]])
+
+    def test_split(self):
+        stacks = [self.get_stack("a", "b"), self.get_stack("a"), self.get_stack("a", "c"), self.get_stack("d")]
+        groups = get_source_groups(stacks)
+        self.assertEqual(groups, [[0, 1, 2], [3]])
+        #Six layers in at most three chunks of two, the large group is cut and keeps its order
+        self.assertEqual(split_source_groups(groups, stacks, 3), [[0], [1, 2], [3]])
+        self.assertEqual(split_source_groups(groups, stacks, 1), [[0, 1, 2, 3]])
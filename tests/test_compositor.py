@@ -0,0 +1,135 @@
+import unittest
+
+import numpy as np
+
+from BlenderBeer.BeerCompiler import LayerSpec
+from BlenderBeer.BeerCompositor import PixelOutput, MIX_FUNCTIONS, alpha_blend, blend, composite_stack
+
+BASE = [0.2, 0.6, 0.0, 0.8]
+#Its alpha is the blend factor
+COLOR = [0.5, 0.25, 1.0, 0.5]
+
+#The GLSL of get_blend_source worked out by hand for BASE and COLOR, the alpha of BASE is kept
+GOLDEN = {
+    "DEFAULT" : [0.33 / 0.9, 0.365 / 0.9, 0.5 / 0.9, 0.9],
+    "ADD" : [0.45, 0.725, 0.5, 0.8],
+    "SUBTRACT" : [-0.05, 0.475, -0.5, 0.8],
+    "MULTIPLY" : [0.15, 0.375, 0.0, 0.8],
+    "DIVIDE" : [0.3, 1.5, 0.0, 0.8],
+    "SCREEN" : [0.4, 0.65, 0.5, 0.8],
+    "OVERLAY" : [0.2, 0.5, 0.0, 0.8],
+    "DIFFERENCE" : [0.25, 0.475, 0.5, 0.8],
+    "LIGHTEN" : [0.35, 0.6, 0.5, 0.8],
+    "DARKEN" : [0.2, 0.425, 0.0, 0.8],
+    "DODGE" : [0.2 / 0.75, 0.6 / 0.875, 0.0, 0.8],
+    "BURN" : [0.0, 0.36, 0.0, 0.8],
+}
+
+#Branches of the GLSL: zero divisors, dodge and burn clipping, overlay at 0.5, out of range factors
+EDGES = {
+    "DIVIDE" : ([0.4, 0.4, 0.4, 1.0], [0.0, 2.0, 0.5, 1.0], [0.4, 0.2, 0.8, 1.0]),
+    "DODGE" : ([0.0, 0.5, 0.9, 1.0], [1.0, 1.0, 0.5, 1.0], [0.0, 1.0, 1.0, 1.0]),
+    "BURN" : ([0.5, 1.0, 0.9, 1.0], [0.0, 0.0, 0.5, 1.0], [0.0, 0.0, 0.8, 1.0]),
+    "OVERLAY" : ([0.5, 0.25, 0.75, 1.0], [1.0, 1.0, 0.0, 1.0], [1.0, 0.5, 0.5, 1.0]),
+    "ADD" : ([0.1, 0.2, 0.3, 0.5], [0.5, 0.5, 0.5, 1.5], [0.6, 0.7, 0.8, 0.5]),
+    "MULTIPLY" : ([0.1, 0.2, 0.3, 0.5], [0.5, 0.5, 0.5, -0.5], [0.1, 0.2, 0.3, 0.5]),
+}
+
+
+def pixel(color, line_color=(0.0, 0.0, 0.0, 0.0), line_width=0.0):
+    return PixelOutput(np.array([color]), np.array([line_color]), np.array([line_width]))
+
+
+class BlendModeTest(unittest.TestCase):
+
+    def test_golden(self):
+        for mode, expected in GOLDEN.items():
+            with self.subTest(mode=mode):
+                result = blend(mode, pixel(BASE), pixel(COLOR))
+                np.testing.assert_allclose(result.color[0], expected, rtol=1e-6, atol=1e-6)
+
+    def test_edges(self):
+        for mode, (col1, col2, expected) in EDGES.items():
+            with self.subTest(mode=mode):
+                result = MIX_FUNCTIONS[mode](col2[3], np.array(col1, np.float32), np.array(col2, np.float32))
+                np.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-6)
+
+    def test_transparent(self):
+        #Both alphas zero, the color of alpha_blend is zero instead of a division by zero
+        result = alpha_blend(np.array([0.5, 0.5, 0.5, 0.0]), np.array([1.0, 1.0, 1.0, 0.0]))
+        np.testing.assert_array_equal(result, [0.0, 0.0, 0.0, 0.0])
+
+    def test_opacity(self):
+        #The alpha of the blending color is the factor, zero leaves the base and one is the full mode
+        for mode in GOLDEN:
+            with self.subTest(mode=mode):
+                result = blend(mode, pixel(BASE), pixel(COLOR[:3] + [0.0]))
+                np.testing.assert_allclose(result.color[0], BASE, rtol=1e-6, atol=1e-6)
+        result = blend("ADD", pixel(BASE), pixel(COLOR[:3] + [1.0]))
+        np.testing.assert_allclose(result.color[0], [0.7, 0.85, 1.0, 0.8], rtol=1e-6)
+        result = blend("DEFAULT", pixel(BASE), pixel(COLOR[:3] + [1.0]))
+        np.testing.assert_allclose(result.color[0], COLOR[:3] + [1.0], rtol=1e-6)
+
+    def test_line(self):
+        #line_color is blended over base.color with its own alpha, line_width is replaced
+        result = blend("MULTIPLY", pixel(BASE, [0.9, 0.9, 0.9, 0.7]), pixel(COLOR, [0.5, 0.5, 0.5, 1.0], 2.0))
+        np.testing.assert_allclose(result.line_color[0], [0.1, 0.3, 0.0, 0.8], rtol=1e-6, atol=1e-6)
+        np.testing.assert_array_equal(result.line_width, [2.0])
+
+    def test_out(self):
+        random = np.random.RandomState(5)
+        base = PixelOutput(random.uniform(-0.5, 1.5, (64, 4)))
+        blending = PixelOutput(random.uniform(-0.5, 1.5, (64, 4)), random.uniform(-0.5, 1.5, (64, 4)),
+            random.uniform(0.0, 2.0, 64))
+        out = PixelOutput(np.full((64, 4), np.nan))
+        for mode in GOLDEN:
+            with self.subTest(mode=mode):
+                expected = blend(mode, base, blending)
+                result = blend(mode, base, blending, out)
+                self.assertIs(result, out)
+                np.testing.assert_array_equal(result.color, expected.color)
+                np.testing.assert_array_equal(result.line_color, expected.line_color)
+                np.testing.assert_array_equal(result.line_width, expected.line_width)
+
+
+class CompositeStackTest(unittest.TestCase):
+
+    def test_mask(self):
+        #The green channel of layer 1 masks every channel of layer 2, alpha included
+        po = PixelOutput(np.array([[0.0, 0.0, 0.0, 1.0]] * 2))
+        outputs = {
+            1 : PixelOutput(np.array([[0.5, 1.0, 0.2, 1.0], [0.5, 0.0, 0.2, 1.0]])),
+            2 : PixelOutput(np.array([[0.2, 0.2, 0.2, 1.0]] * 2)),
+        }
+        layers = [LayerSpec(1, "base.mesh.glsl"),
+            LayerSpec(2, "add.mesh.glsl", blend="ADD", masked_layer=True, masking_index=1)]
+        result = composite_stack(layers, outputs, po)
+        np.testing.assert_allclose(result.color, [[0.7, 1.2, 0.4, 1.0], [0.5, 0.0, 0.2, 1.0]], rtol=1e-6)
+        #Layer results are not written to
+        np.testing.assert_allclose(outputs[2].color, [[0.2, 0.2, 0.2, 1.0]] * 2)
+
+    def test_partial_mask(self):
+        #A half mask halves the blend factor too
+        po = PixelOutput(np.array([[0.5, 0.5, 0.5, 1.0]]))
+        outputs = {
+            1 : PixelOutput(np.array([[0.0, 0.5, 0.0, 0.0]])),
+            2 : PixelOutput(np.array([[1.0, 1.0, 1.0, 1.0]])),
+        }
+        layers = [LayerSpec(1, "mask.mesh.glsl", blend="ADD"),
+            LayerSpec(2, "white.mesh.glsl", blend="MULTIPLY", masked_layer=True, masking_index=1)]
+        result = composite_stack(layers, outputs, po)
+        #ADD of a zero alpha layer keeps PO, MULTIPLY by 0.5 with a factor of 0.5
+        np.testing.assert_allclose(result.color, [[0.375, 0.375, 0.375, 1.0]], rtol=1e-6)
+
+    def test_input(self):
+        po = PixelOutput(np.array([[0.25, 0.25, 0.25, 1.0]]))
+        seen = {}
+        def shade(layer, input):
+            seen[layer.index] = input.color.copy()
+            return PixelOutput(input.color * [2.0, 2.0, 2.0, 1.0])
+        layers = [LayerSpec(1, "a.mesh.glsl"), LayerSpec(2, "b.mesh.glsl", input_index=1)]
+        result = composite_stack(layers, shade, po)
+        np.testing.assert_array_equal(seen[1], po.color)
+        np.testing.assert_array_equal(seen[2], [[0.5, 0.5, 0.5, 1.0]])
+        np.testing.assert_allclose(result.color, [[1.0, 1.0, 1.0, 1.0]], rtol=1e-6)
+        np.testing.assert_array_equal(po.color, [[0.25, 0.25, 0.25, 1.0]])
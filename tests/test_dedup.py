@@ -0,0 +1,171 @@
+import os
+import re
+import tempfile
+import unittest
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer.BeerCompiler import LayerSpec, compile_layer_source
+
+#The overloads of scale keep shade and the entry point unshared, helper reads a uniform
+OVERLOAD_SOURCE = """
+uniform float strength = {strength};
+
+float helper(float x)
+{{
+    return x * strength;
+}}
+
+float scale(float x)
+{{
+    return x * 2.0;
+}}
+
+vec2 scale(vec2 x)
+{{
+    return x * 2.0;
+}}
+
+vec4 shade(vec4 color)
+{{
+    return color * helper(scale(0.5));
+}}
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{{
+    PO.color = shade(vec4(scale(vec2(1.0)), 1.0, 1.0));
+}}
+"""
+
+#Every function is shareable, the entry point included
+SIMPLE_SOURCE = """
+uniform float strength = {strength};
+uniform vec4 tint = vec4(1.0);
+
+float helper(float x)
+{{
+    return x * strength;
+}}
+
+vec4 tinted(float x)
+{{
+    return tint * helper(x);
+}}
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{{
+    PO.color = tinted(0.5);
+}}
+"""
+
+PREFIX = re.compile(r"\bbeer(?:shared[0-9a-f]{8}|gen\d+)_")
+#The uniforms shared functions get as extra arguments
+UNIFORM_ARGUMENT = re.compile(r"(?:, |(?<=\())(?:strength|tint)(?=[,)])")
+DEFINITION = re.compile(r"^\w+ (beer\w+)\(.*?\)\n\{\n(.*?)\n\}", re.M | re.S)
+CALL = re.compile(r"\b(beer\w+)\(")
+
+
+def get_definitions(source):
+    definitions = {}
+    for name, body in DEFINITION.findall(source):
+        definitions.setdefault(name, []).append(body)
+    return definitions
+
+def normalize(text):
+    return UNIFORM_ARGUMENT.sub("", PREFIX.sub("", text))
+
+def get_call_targets(source, index):
+    """ The functions the entry point of a layer reaches, by name and body, without prefixes and uniform arguments. """
+    definitions = get_definitions(source)
+    targets = set()
+    pending = ["beergen{}_COMMON_PIXEL_SHADER".format(index)]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for body in definitions[name]:
+            calls = CALL.findall(body)
+            pending += calls
+            #The wrapper of a shared entry point only forwards to it
+            if [normalize(call) for call in calls] == [normalize(name)]:
+                continue
+            targets.add((normalize(name), normalize(body)))
+    return targets
+
+def get_layer_sections(source):
+    """ The code of each layer, by layer index. """
+    sections = source.split("LAYER INFO = [\nlayer:")[1:]
+    return {int(section.split("\n", 1)[0]) : section for section in sections}
+
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def get_layers(self, *sources):
+        layers = []
+        for index, source in enumerate(sources, 1):
+            path = os.path.join(self.directory, "layer{}.mesh.glsl".format(index))
+            with open(path, 'w') as f:
+                f.write(source)
+            layers.append(LayerSpec(index, path))
+        return layers
+
+    def compile(self, layers):
+        return "".join(compile_layer_source(layers))
+
+    def test_call_targets(self):
+        #Compiled alone a layer shares nothing, in the stack every call must still reach the same code
+        layers = self.get_layers(OVERLOAD_SOURCE.format(strength=0.5), OVERLOAD_SOURCE.format(strength=0.25),
+            SIMPLE_SOURCE.format(strength=0.5), SIMPLE_SOURCE.format(strength=2.0))
+        source = self.compile(layers)
+        self.assertIn("beershared", source)
+        for layer in layers:
+            with self.subTest(layer=layer.index):
+                alone = self.compile([layer])
+                self.assertNotIn("beershared", alone)
+                self.assertEqual(get_call_targets(source, layer.index), get_call_targets(alone, layer.index))
+
+    def test_uniform_parameters(self):
+        layers = self.get_layers(OVERLOAD_SOURCE.format(strength=0.5), OVERLOAD_SOURCE.format(strength=0.25))
+        source = self.compile(layers)
+        helpers = [name for name in get_definitions(source) if name.endswith("_helper")]
+        self.assertEqual(len(helpers), 1)
+        shared_prefix = helpers[0][:-len("helper")]
+        self.assertTrue(shared_prefix.startswith("beershared"))
+        self.assertIn("float {0}helper(float x, float {0}strength)".format(shared_prefix), source)
+        for index, section in get_layer_sections(source).items():
+            with self.subTest(layer=index):
+                #Each layer passes its own uniform, the shared code reads no layer uniform
+                self.assertIn("{}helper(beergen{}_scale(0.5), beergen{}_strength)".format(shared_prefix, index, index),
+                    section)
+                self.assertEqual(set(re.findall(r"\bbeergen(\d+)_", section)), {str(index)})
+
+    def test_wrappers(self):
+        layers = self.get_layers(SIMPLE_SOURCE.format(strength=0.5), SIMPLE_SOURCE.format(strength=2.0))
+        source = self.compile(layers)
+        definitions = get_definitions(source)
+        shared = [name for name in definitions if name.startswith("beershared")]
+        self.assertEqual(len(shared), 3)
+        entry = [name for name in shared if name.endswith("_COMMON_PIXEL_SHADER")][0]
+        for index in (1, 2):
+            with self.subTest(layer=index):
+                self.assertEqual(definitions["beergen{}_COMMON_PIXEL_SHADER".format(index)],
+                    ["    {}(S, PO, beergen{}_strength, beergen{}_tint);".format(entry, index, index)])
+                self.assertNotIn("beergen{}_helper".format(index), definitions)
+                self.assertNotIn("beergen{}_tinted".format(index), definitions)
+
+    def test_overloads_unshared(self):
+        layers = self.get_layers(OVERLOAD_SOURCE.format(strength=0.5), OVERLOAD_SOURCE.format(strength=0.5))
+        definitions = get_definitions(self.compile(layers))
+        self.assertFalse([name for name in definitions if name.startswith("beershared") and name.endswith("_scale")])
+        for index in (1, 2):
+            self.assertEqual(len(definitions["beergen{}_scale".format(index)]), 2)
+            #shade calls the overloads, so it stays with its layer too
+            self.assertIn("beergen{}_shade".format(index), definitions)
@@ -0,0 +1,78 @@
+import re
+import unittest
+
+import numpy as np
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer.BeerCompiler import LayerSpec, compile_function_source
+from BlenderBeer.BeerGraph import OutputPlan
+from BlenderBeer.BeerCompositor import PixelOutput, composite_stack
+
+PIXELS = 64
+
+
+def get_stack():
+    return [
+        #Unmasked, its green channel masks 2 and 4
+        LayerSpec(1, "base.mesh.glsl"),
+        #Masked and only blended, can be skipped
+        LayerSpec(2, "rim.mesh.glsl", blend="ADD", masked_layer=True, masking_index=1),
+        LayerSpec(3, "shade.mesh.glsl", blend="MULTIPLY"),
+        #Masked, but its output is the input of 5
+        LayerSpec(4, "line.mesh.glsl", blend="SCREEN", masked_layer=True, masking_index=1),
+        LayerSpec(5, "glow.mesh.glsl", blend="ADD", input_index=4),
+        #Masked and the last blend, its line color would show
+        LayerSpec(6, "top.mesh.glsl", blend="OVERLAY", masked_layer=True, masking_index=3),
+    ]
+
+def get_shade(zero_mask):
+    random = np.random.RandomState(7)
+    colors = {}
+    for index in range(1, 7):
+        color = random.uniform(0.0, 1.0, (PIXELS, 4)).astype(np.float32)
+        line_color = random.uniform(0.0, 1.0, (PIXELS, 4)).astype(np.float32)
+        line_width = random.uniform(0.0, 3.0, PIXELS).astype(np.float32)
+        colors[index] = color, line_color, line_width
+    #Masks zero on every other pixel
+    colors[1][0][::2, 1] = 0.0 if zero_mask else 0.5
+    colors[3][0][::2, 1] = 0.0 if zero_mask else 0.5
+
+    def shade(layer, input):
+        color, line_color, line_width = colors[layer.index]
+        return PixelOutput(color + input.color * 0.25, line_color + input.line_color * 0.25, line_width)
+    return shade
+
+
+class MaskEarlyOutTest(unittest.TestCase):
+
+    def test_branches(self):
+        layers = get_stack()
+        plan = OutputPlan(layers, mask_early_out=True)
+        self.assertEqual([step[0].index for step in plan.steps if step[6]], [2])
+
+        source = "".join(compile_function_source(layers, mask_early_out=True))
+        branches = re.findall(r"if \((\w+) != 0\.0\) \{\s*(\w+)_COMMON_PIXEL_SHADER", source)
+        self.assertEqual([prefix for mask, prefix in branches], ["beergen2"])
+        self.assertEqual(source.count("!= 0.0) {"), 1)
+
+        source = "".join(compile_function_source(layers))
+        self.assertNotIn("!= 0.0) {", source)
+
+    def test_output(self):
+        po = PixelOutput(np.random.RandomState(3).uniform(0.0, 1.0, (PIXELS, 4)))
+        for zero_mask in (True, False):
+            with self.subTest(zero_mask=zero_mask):
+                shade = get_shade(zero_mask)
+                expected = composite_stack(get_stack(), shade, po)
+                result = composite_stack(get_stack(), shade, po, mask_early_out=True)
+                np.testing.assert_array_equal(result.color, expected.color)
+                np.testing.assert_array_equal(result.line_color, expected.line_color)
+                np.testing.assert_array_equal(result.line_width, expected.line_width)
+
+    def test_last_blend_kept(self):
+        #Flagging the last blend would leave the line color of its input in PO
+        layers = get_stack()[:2]
+        plan = OutputPlan(layers, mask_early_out=True)
+        self.assertFalse(any(step[6] for step in plan.steps))
@@ -0,0 +1,202 @@
+import re
+import unittest
+
+from BlenderBeer.BeerCompiler import LayerSpec, compile_function_source
+from BlenderBeer.BeerGraph import OutputPlan, prune_layers, get_layer_inserts, get_layer_deletes, get_layer_moves
+
+
+def apply_moves(layers, moves):
+    """ Do the moves the way a CollectionProperty does them. """
+    layers = list(layers)
+    for index, target in moves:
+        layers.insert(target, layers.pop(index))
+    return layers
+
+def get_steps(plan):
+    """ (index, slot, declare, input location, mask location, keep mask) of every step. """
+    return [(step[0].index,) + step[1:6] for step in plan.steps]
+
+
+class OutputPlanTest(unittest.TestCase):
+
+    def check_source(self, layers, plan):
+        #The generated function declares as many slots as the plan counts
+        source = "".join(compile_function_source(layers))
+        self.assertEqual(len(set(re.findall(r"beergen_slot\d+", source))), plan.get_peak_live_outputs())
+
+    def test_chain_in_place(self):
+        #Each layer is the only reader of the one before, they all shade in the first slot
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", input_index=1), LayerSpec(3, "c", input_index=2),
+            LayerSpec(4, "d", input_index=3)]
+        plan = OutputPlan(layers)
+        self.assertEqual(get_steps(plan), [
+            (1, 0, True, ("PO", 0), None, False),
+            (2, 0, False, None, None, False),
+            (3, 0, False, None, None, False),
+            (4, 0, False, None, None, False),
+        ])
+        self.assertIsNone(plan.saved_input)
+        self.assertEqual(plan.get_peak_live_outputs(), 1)
+        self.check_source(layers, plan)
+
+    def test_mask_after_producer(self):
+        #The mask of 1 is read by 3, after 2 reused the slot 1 was shaded in
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b"), LayerSpec(3, "c", masked_layer=True, masking_index=1)]
+        plan = OutputPlan(layers)
+        self.assertEqual(plan.saved_input, ("SLOT", 0))
+        self.assertEqual(get_steps(plan), [
+            (1, 1, True, ("SLOT", 0), None, True),
+            (2, 1, False, ("SLOT", 0), None, False),
+            (3, 0, False, None, ("MASK", 1), False),
+        ])
+        self.assertEqual(plan.get_peak_live_outputs(), 2)
+        self.check_source(layers, plan)
+
+    def test_shared_masks(self):
+        #Two layers masked by 1, the mask is kept as a float so both reuse the slot 1 was shaded in
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", masked_layer=True, masking_index=1),
+            LayerSpec(3, "c", masked_layer=True, masking_index=1), LayerSpec(4, "d")]
+        plan = OutputPlan(layers)
+        self.assertEqual(get_steps(plan), [
+            (1, 1, True, ("SLOT", 0), None, True),
+            (2, 1, False, ("SLOT", 0), ("MASK", 1), False),
+            (3, 1, False, ("SLOT", 0), ("MASK", 1), False),
+            (4, 0, False, None, None, False),
+        ])
+        self.assertEqual(plan.get_peak_live_outputs(), 2)
+        self.check_source(layers, plan)
+
+    def test_mask_and_input(self):
+        #1 is read as an input too, so its whole output stays in a slot until its last reader
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", input_index=1),
+            LayerSpec(3, "c", masked_layer=True, masking_index=1)]
+        plan = OutputPlan(layers)
+        self.assertEqual(get_steps(plan), [
+            (1, 1, True, ("SLOT", 0), None, False),
+            (2, 2, True, ("SLOT", 1), None, False),
+            (3, 0, False, None, ("SLOT", 1), False),
+        ])
+        self.assertEqual(plan.get_peak_live_outputs(), 3)
+        self.check_source(layers, plan)
+
+    def test_mask_of_input(self):
+        #A layer masked by its own input can't be shaded in place, the mask would be overwritten
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", input_index=1, masked_layer=True, masking_index=1)]
+        plan = OutputPlan(layers)
+        self.assertEqual(get_steps(plan), [
+            (1, 0, True, ("PO", 0), None, False),
+            (2, 1, True, ("SLOT", 0), ("SLOT", 0), False),
+        ])
+        self.assertEqual(plan.get_peak_live_outputs(), 2)
+        self.check_source(layers, plan)
+
+    def test_freed_slot_reused(self):
+        #The slots of 1 and 2 are free after 2, 3 takes the lowest one instead of declaring a new one
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", input_index=1, masked_layer=True, masking_index=1),
+            LayerSpec(3, "c"), LayerSpec(4, "d")]
+        plan = OutputPlan(layers)
+        self.assertEqual([step[1:3] for step in plan.steps], [(1, True), (2, True), (1, False), (0, False)])
+        self.assertEqual(plan.get_peak_live_outputs(), 3)
+        self.check_source(layers, plan)
+
+
+class PruneTest(unittest.TestCase):
+
+    def prune(self, layers, opaque=frozenset()):
+        live_layers, pruned = prune_layers(layers, opaque)
+        #Every layer is either compiled or reported, in stack order
+        self.assertEqual(sorted([layer.index for layer in live_layers] + pruned), [layer.index for layer in layers])
+        return [layer.index for layer in live_layers], pruned
+
+    def test_muted(self):
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", mute_layer=True), LayerSpec(3, "c")]
+        self.assertEqual(self.prune(layers), ([1, 3], [2]))
+
+    def test_muted_read(self):
+        #A muted layer is not blended, but its output is still computed for its readers
+        layers = [LayerSpec(1, "a", mute_layer=True), LayerSpec(2, "b", mute_layer=True),
+            LayerSpec(3, "c", input_index=1), LayerSpec(4, "d", masked_layer=True, masking_index=2)]
+        self.assertEqual(self.prune(layers), ([1, 2, 3, 4], []))
+
+    def test_solo(self):
+        #Layers before a solo layer are hidden, unless a later layer reads them
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b"), LayerSpec(3, "c", solo_layer=True),
+            LayerSpec(4, "d", masked_layer=True, masking_index=2)]
+        self.assertEqual(self.prune(layers), ([2, 3, 4], [1]))
+
+    def test_muted_solo(self):
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", solo_layer=True, mute_layer=True), LayerSpec(3, "c")]
+        self.assertEqual(self.prune(layers), ([1, 3], [2]))
+
+    def test_chain(self):
+        #1 is only read by 2, which is hidden by the solo layer 3, so both go
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", input_index=1), LayerSpec(3, "c", solo_layer=True)]
+        self.assertEqual(self.prune(layers), ([3], [1, 2]))
+
+    def test_opaque(self):
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b"), LayerSpec(3, "c"), LayerSpec(4, "d", blend="ADD")]
+        self.assertEqual(self.prune(layers, frozenset([3])), ([3, 4], [1, 2]))
+        #Only unmasked DEFAULT layers hide the layers before them
+        layers[2] = LayerSpec(3, "c", blend="MULTIPLY")
+        self.assertEqual(self.prune(layers, frozenset([3])), ([1, 2, 3, 4], []))
+
+    def test_solo_before_opaque(self):
+        #The solo layer sets the PO fields the opaque layer doesn't write, so it stays
+        layers = [LayerSpec(1, "a"), LayerSpec(2, "b", solo_layer=True), LayerSpec(3, "c")]
+        self.assertEqual(self.prune(layers, frozenset([3])), ([2, 3], [1]))
+
+
+class StackEditTest(unittest.TestCase):
+
+    def move(self, indices, offset, active, length=6):
+        moves, positions, active = get_layer_moves(length, indices, offset, active)
+        layers = apply_moves("abcdef"[:length], moves)
+        #The layers returned as moved are the ones that were at indices
+        self.assertEqual(sorted("abcdef"[index] for index in indices if 0 <= index < length),
+            sorted(layers[position] for position in positions))
+        return "".join(layers), positions, active
+
+    def test_move(self):
+        self.assertEqual(self.move([2], -1, 0), ("acbdef", [1], 0))
+        self.assertEqual(self.move([2], 2, 0), ("abdecf", [4], 0))
+
+    def test_move_across_active(self):
+        #The active layer follows its layer, whether it is moved or moved over
+        self.assertEqual(self.move([3], -2, 2), ("adbcef", [1], 3))
+        self.assertEqual(self.move([3], -2, 1), ("adbcef", [1], 2))
+        self.assertEqual(self.move([3], -2, 3), ("adbcef", [1], 1))
+        self.assertEqual(self.move([1], 3, 4), ("acdebf", [4], 3))
+        self.assertEqual(self.move([1], 3, 5), ("acdebf", [4], 5))
+
+    def test_move_selection(self):
+        #Selected layers keep their order and gaps close up against the end they move to
+        self.assertEqual(self.move([1, 3], -1, 3), ("badcef", [0, 2], 2))
+        self.assertEqual(self.move([1, 3], -2, 3), ("bdacef", [0, 1], 1))
+        self.assertEqual(self.move([3, 1, 4], 1, 0), ("acbfde", [2, 4, 5], 0))
+        self.assertEqual(self.move([0, 1, 5], 2, 5), ("cdabef", [2, 3, 5], 5))
+
+    def test_move_ends(self):
+        #Layers at an end don't move and stop the layers behind them
+        self.assertEqual(self.move([0], -1, 0), ("abcdef", [0], 0))
+        self.assertEqual(self.move([5], 1, 5), ("abcdef", [5], 5))
+        self.assertEqual(self.move([0, 2], -3, 2), ("acbdef", [0, 1], 1))
+        self.assertEqual(self.move([4, 5], 2, 0), ("abcdef", [4, 5], 0))
+        self.assertEqual(self.move([0, 1, 2, 3, 4, 5], 1, 2), ("abcdef", [0, 1, 2, 3, 4, 5], 2))
+        self.assertEqual(get_layer_moves(6, [7, -1], 1, 2), ([], [], 2))
+        self.assertEqual(get_layer_moves(6, [2], 0, 2), ([], [2], 2))
+
+    def test_insert(self):
+        moves, positions = get_layer_inserts(4, 1, 2)
+        self.assertEqual("".join(apply_moves("abcdXY", moves)), "aXYbcd")
+        self.assertEqual(positions, [1, 2])
+        self.assertEqual(get_layer_inserts(4, None, 2), ([], [4, 5]))
+        self.assertEqual(get_layer_inserts(4, 9, 1), ([], [4]))
+        moves, positions = get_layer_inserts(4, -3, 1)
+        self.assertEqual(("".join(apply_moves("abcdX", moves)), positions), ("Xabcd", [0]))
+
+    def test_delete(self):
+        #Removed last first, the active layer goes to the one before the first removed
+        self.assertEqual(get_layer_deletes(6, [1, 4, 4, 9], 5), ([4, 1], 0))
+        self.assertEqual(get_layer_deletes(6, [3, 5], 0), ([5, 3], 2))
+        self.assertEqual(get_layer_deletes(3, [0, 1, 2], 1), ([2, 1, 0], -1))
+        self.assertEqual(get_layer_deletes(3, [], 1), ([], 1))
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer import BeerInclude
+from BlenderBeer.BeerCompiler import LayerSpec, compile_layer_source
+
+LAYER_SOURCE = """#include "Pipelines/NPR_Pipeline.glsl"
+#include "util.glsl"
+#include "library.glsl"
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{{
+    PO.color = vec4({}());
+}}
+"""
+
+
+class HoistedIncludeTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        library = self.write("library/library.glsl", "float library_value() { return 1.0; }\n")
+        self.write("library/Pipelines/NPR_Pipeline.glsl", "struct Surface { float x; };\n")
+        patcher = mock.patch.object(BeerInclude, "include_paths", [os.path.dirname(library)])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.layers = []
+        for index, (folder, function) in enumerate((("a", "util_a"), ("b", "util_b"), ("a", "util_a"))):
+            self.write(folder + "/util.glsl", "float {}() {{ return 0.5; }}\n".format(function))
+            path = self.write("{}/layer{}.mesh.glsl".format(folder, index), LAYER_SOURCE.format(function))
+            self.layers.append(LayerSpec(index + 1, path, blend="ADD"))
+
+    def write(self, name, text):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def get_include(self, folder):
+        path = os.path.abspath(os.path.join(self.root, folder, "util.glsl"))
+        return '#include "{}"\n'.format(path.replace(os.sep, "/"))
+
+    def test_relative_includes(self):
+        source = "".join(compile_layer_source(self.layers))
+        #Each util.glsl once, by its own path
+        self.assertEqual(source.count(self.get_include("a")), 1)
+        self.assertEqual(source.count(self.get_include("b")), 1)
+        self.assertNotIn('#include "util.glsl"', source)
+        #Includes found on the search paths keep their name
+        self.assertEqual(source.count('#include "library.glsl"\n'), 1)
+        self.assertEqual(source.count('#include "Pipelines/NPR_Pipeline.glsl"\n'), 1)
+        #Both util functions are included symbols, not renamed as layer ones
+        self.assertIn("vec4(util_a())", source)
+        self.assertIn("vec4(util_b())", source)
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from dataclasses import replace
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer import BeerCompiler
+from BlenderBeer.BeerCompiler import LayerSpec, compile_full_source, compile_incremental
+
+LAYER_SOURCE = """
+uniform vec4 color = vec4({value}, 0.5, 0.25, 1.0);
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{{
+    PO.color = color;
+}}
+"""
+
+
+class DirtyTrackingTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = []
+        for index in range(4):
+            path = os.path.join(directory.name, "layer{}.mesh.glsl".format(index))
+            self.write(path, index)
+            self.paths.append(path)
+        self.layers = [LayerSpec(index + 1, path, blend="ADD") for index, path in enumerate(self.paths)]
+
+    def write(self, path, value):
+        with open(path, 'w') as f:
+            f.write(LAYER_SOURCE.format(value=float(value)))
+
+    def compile(self, layers):
+        """ Compile under the key of the test and check the result against a full compile. """
+        source = compile_incremental(self.id(), layers)
+        self.assertEqual(source, "".join(compile_full_source(layers)))
+        return BeerCompiler.compile_reports[self.id()]
+
+    def test_first_compile(self):
+        report = self.compile(self.layers)
+        self.assertEqual(report["rebuilt"], [1, 2, 3, 4])
+        self.assertEqual(report["reused"], [])
+        self.assertGreater(report["rebuild_time"], 0.0)
+        self.assertGreaterEqual(report["total_time"], report["rebuild_time"])
+        self.assertFalse(report["stored"])
+
+    def test_unchanged(self):
+        self.compile(self.layers)
+        report = self.compile(self.layers)
+        self.assertEqual(report["rebuilt"], [])
+        self.assertEqual(report["reused"], [1, 2, 3, 4])
+        self.assertEqual(report["rebuild_time"], 0.0)
+
+    def test_layer_state(self):
+        #Each field of the layer state only rebuilds the layer it was changed on
+        changes = {"blend" : "MULTIPLY", "masked_layer" : True, "input_index" : 1}
+        for field, value in changes.items():
+            with self.subTest(field=field):
+                self.compile(self.layers)
+                layers = list(self.layers)
+                layers[2] = replace(layers[2], **{field : value})
+                if field == "masked_layer":
+                    layers[2] = replace(layers[2], masking_index=1)
+                report = self.compile(layers)
+                self.assertEqual(report["rebuilt"], [3])
+                self.assertEqual(report["reused"], [1, 2, 4])
+
+    def test_source_change(self):
+        self.compile(self.layers)
+        self.write(self.paths[1], 0.75)
+        report = self.compile(self.layers)
+        self.assertEqual(report["rebuilt"], [2])
+        self.assertEqual(report["reused"], [1, 3, 4])
+
+    def test_index_change(self):
+        #Inserting a layer renumbers the layers after it, which changes their generated names
+        self.compile(self.layers)
+        layers = self.layers[:1] + [LayerSpec(2, self.paths[3])]
+        layers += [replace(layer, index=layer.index + 1) for layer in self.layers[1:]]
+        report = self.compile(layers)
+        self.assertEqual(report["rebuilt"], [2, 3, 4, 5])
+        self.assertEqual(report["reused"], [1])
+
+    def test_separate_keys(self):
+        #The layer code is kept per key, another material compiling the same layers rebuilds them
+        self.compile(self.layers)
+        compile_incremental(self.id() + ".other", self.layers)
+        self.assertEqual(BeerCompiler.compile_reports[self.id() + ".other"]["rebuilt"], [1, 2, 3, 4])
@@ -0,0 +1,83 @@
+# Copyright (c) 2021 BlenderNPR and contributors. MIT license.
+
+# classify_tokens against the two-pass reference lex_passes, on the same token streams.
+
+import unittest
+import synthetic
+from BlenderBeer.BeerLexer import TEXT, WHITESPACE, tokenize, tokenize_pygments, lex_passes, classify_tokens
+
+try:
+    import pygments
+except ImportError:
+    pygments = None
+
+SOURCES = {
+    "members" : """
+#include "Pipelines/NPR_Pipeline.glsl"
+#define SCALE 2.0 // a comment
+uniform vec4 color = vec4(1.0, 0.5, 0.0, 1.0);
+uniform float strength = 1.0;
+
+struct Light { vec3 direction; float power; };
+
+float shade(Light light, vec3 normal);
+
+float shade(Light light, vec3 normal)
+{
+    return max(dot(light.direction, normal), 0.0) * light.power;
+}
+
+/* block
+   comment */
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{
+    Light light = Light(normalize(vec3(1, 1, 1)), strength);
+    vec3 n = S.normal . xyz;
+    PO.color = color * shade(light, n) * SCALE;
+    PO.color.a = 1.0;
+    PO.line_color = PO.color;
+}
+""",
+    "unknown calls" : """
+float helper ( float x ) { return x * 2.0; }
+void main()
+{
+    float y = helper(1.0) + undeclared(2.0) + texture(tex, uv).r;
+    for (int i = 0; i < 4; i++) { y += float(i); }
+    #ifdef FOO
+    y = -y;
+    #endif
+}
+""",
+    "synthetic" : synthetic.generate_shader(300, seed=3),
+}
+
+
+def retype_whitespace(tokens, whitespace_type):
+    """ The tokens with their whitespace typed as whitespace_type, as one pygments version or the other does. """
+    return [(whitespace_type if str(ttype) in (TEXT, WHITESPACE) and value.isspace() else ttype, value)
+        for ttype, value in tokens]
+
+
+class ClassifyTokensTest(unittest.TestCase):
+
+    def check(self, tokens):
+        for whitespace_type in (None, TEXT, WHITESPACE):
+            stream = tokens if whitespace_type is None else retype_whitespace(tokens, whitespace_type)
+            with self.subTest(whitespace=whitespace_type):
+                self.assertEqual(list(classify_tokens(iter(stream))), lex_passes(iter(stream)))
+
+    def test_builtin_tokenizer(self):
+        for name, source in SOURCES.items():
+            with self.subTest(source=name):
+                self.check(list(tokenize(source)))
+
+    @unittest.skipIf(pygments is None, "pygments is not installed")
+    def test_pygments(self):
+        for name, source in SOURCES.items():
+            with self.subTest(source=name):
+                self.check(list(tokenize_pygments(source)))
+
+
+if __name__ == "__main__":
+    unittest.main()
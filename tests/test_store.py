@@ -0,0 +1,31 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from BlenderBeer import BeerStore
+
+
+class WriteAtomicTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "shader.mesh.glsl")
+
+    @unittest.skipIf(os.name == 'nt', "file modes are not kept on Windows")
+    def test_mode(self):
+        BeerStore.write_atomic(self.path, "a")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o666 & ~BeerStore._umask)
+        os.chmod(self.path, 0o640)
+        BeerStore.write_atomic(self.path, "b")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+    def test_locked_target(self):
+        BeerStore.write_atomic(self.path, "a")
+        with mock.patch.object(BeerStore, "REPLACE_RETRY_DELAYS", (0.0,)), \
+            mock.patch("os.replace", side_effect=PermissionError):
+            BeerStore.write_atomic(self.path, "b")
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "b")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["shader.mesh.glsl"])
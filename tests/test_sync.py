@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import bpy_stub
+bpy = bpy_stub.install()
+
+from BlenderBeer import BeerCompiler, BeerSync
+from BlenderBeer.BeerOpacity import source_alpha
+
+OPAQUE_SOURCE = """#include "Pipelines/NPR_Pipeline.glsl"
+
+uniform float opacity = 1.0;
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{
+    PO.color = vec4(1.0, 0.5, 0.0, opacity);
+    PO.line_color = vec4(0.0, 0.0, 0.0, opacity);
+}
+"""
+
+
+class CullReversalTest(unittest.TestCase):
+    """ A layer culled under an opaque layer shows again when the opaque one gets transparent, after a reload too. """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "opaque.mesh.glsl")
+        with open(path, 'w') as f:
+            f.write(OPAQUE_SOURCE)
+        self.base = bpy_stub.Material("cull_base", path, {"opacity" : 1.0})
+        self.top = bpy_stub.Material("cull_top", path, {"opacity" : 1.0})
+        material = bpy_stub.Material("cull_beer")
+        for each in (self.base, self.top, material):
+            bpy.data.materials[each.name] = each
+            self.addCleanup(bpy.data.materials.pop, each.name, None)
+        self.beer_mat = bpy_stub.BeerMaterial(material, [bpy_stub.Layer(1, self.base), bpy_stub.Layer(2, self.top)])
+        #What a reopened .blend has: the verdict of the last compile, and no compile state
+        self.beer_mat["opaque_layers"] = [1, 2]
+        BeerCompiler.compile_reports.pop(self.beer_mat.as_pointer(), None)
+        source_alpha.clear()
+        self.addCleanup(BeerSync.unlink_material, material.name)
+
+    def test_opaque_kept(self):
+        with mock.patch.object(BeerSync.BeerScheduler, "request_compile") as request_compile:
+            BeerSync.link_material(self.beer_mat, push=False)
+        request_compile.assert_not_called()
+        self.assertIn(self.top.malt.get_source_path(), source_alpha)
+
+    def test_transparent_after_reload(self):
+        self.top.malt.parameters["opacity"] = 0.5
+        with mock.patch.object(BeerSync.BeerScheduler, "request_compile") as request_compile:
+            BeerSync.link_material(self.beer_mat, push=False)
+        request_compile.assert_called_once_with(self.beer_mat)
+
+    def test_edit_after_reload(self):
+        with mock.patch.object(BeerSync.BeerScheduler, "request_compile") as request_compile:
+            BeerSync.link_material(self.beer_mat, push=False)
+            self.top.malt.parameters["opacity"] = 0.25
+            BeerSync.check_alpha_changes(self.top.name, {"opacity" : 0.25}, BeerSync.links[self.top.name])
+        request_compile.assert_called_once_with(self.beer_mat)
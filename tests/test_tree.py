@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer.BeerCompiler import LayerSpec, compile_layer_source, get_uniform_layout
+
+LAYOUT_SOURCE = """#include "Pipelines/NPR_Pipeline.glsl"
+
+layout(std140) uniform MyBlock { vec4 bcol; float bval; };
+layout(location = 3) uniform float x = 0.5;
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{
+    PO.color = bcol * bval * x;
+}
+"""
+
+
+class LayoutQualifierTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "layout.mesh.glsl")
+        with open(self.path, 'w') as f:
+            f.write(LAYOUT_SOURCE)
+        self.layers = [LayerSpec(1, self.path), LayerSpec(2, self.path, blend="ADD")]
+
+    def test_uniform_block(self):
+        source = "".join(compile_layer_source(self.layers))
+        for prefix in ("beergen1", "beergen2"):
+            self.assertIn("layout(std140) uniform {0}_MyBlock {{ vec4 {0}_bcol; float {0}_bval; }};".format(prefix), source)
+            self.assertIn("PO.color = {0}_bcol * {0}_bval * {0}_x;".format(prefix), source)
+        self.assertNotIn("uniform MyBlock", source)
+
+    def test_location_uniform(self):
+        source = "".join(compile_layer_source(self.layers))
+        self.assertIn("layout(location = 3) uniform float beergen1_x = 0.5;", source)
+        layout = get_uniform_layout(self.layers, "LAYER")
+        self.assertIn("beergen1_x", layout["BEER_UNIFORMS_beergen1"]["members"])
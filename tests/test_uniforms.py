@@ -0,0 +1,146 @@
+import os
+import tempfile
+import unittest
+
+import bpy_stub
+bpy_stub.install()
+
+from BlenderBeer.BeerCompiler import LayerSpec, compile_layer_source, get_uniform_layout
+from BlenderBeer.BeerUniforms import to_literal
+
+LAYER_SOURCE = """#include "Pipelines/NPR_Pipeline.glsl"
+
+uniform float strength = 0.5;
+uniform vec4 tint = vec4(0.25, 0.5, 0.75, 1.0);
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{
+    PO.color = tint * strength;
+}
+"""
+
+SWITCH_SOURCE = """
+uniform int steps = 4;
+uniform uint seed = 1u;
+uniform bool enabled = true;
+uniform bvec2 axes = bvec2(true, false);
+uniform ivec2 offset = ivec2(0, 0);
+
+void COMMON_PIXEL_SHADER(Surface S, inout PixelOutput PO)
+{
+    if (enabled && axes.x)
+    {
+        PO.color = vec4(float(steps + offset.x) / float(seed));
+    }
+}
+"""
+
+
+class BlockLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "layer.mesh.glsl")
+        with open(path, 'w') as f:
+            f.write(LAYER_SOURCE)
+        self.layers = [LayerSpec(1, path)]
+
+    def test_layout(self):
+        members = get_uniform_layout(self.layers, "LAYER")["BEER_UNIFORMS_beergen1"]["members"]
+        self.assertEqual(members["beergen1_strength"]["offset"], 0)
+        self.assertEqual(members["beergen1_strength"]["default"], [0.5])
+        #vec4 is aligned to 16 bytes
+        self.assertEqual(members["beergen1_tint"]["offset"], 16)
+        self.assertEqual(members["beergen1_tint"]["default"], [0.25, 0.5, 0.75, 1.0])
+
+    def test_block_source(self):
+        source = "".join(compile_layer_source(self.layers, "LAYER"))
+        self.assertIn("layout(std140) uniform BEER_UNIFORMS_beergen1\n{\n    float beergen1_strength;\n    vec4 beergen1_tint;\n};", source)
+        self.assertNotIn("uniform float beergen1_strength", source)
+
+
+class LiteralTest(unittest.TestCase):
+
+    def test_float(self):
+        #Floats always get a decimal point or an exponent, GLSL doesn't convert an int literal in a const
+        self.assertEqual(to_literal("float", 1), "1.0")
+        self.assertEqual(to_literal("float", True), "1.0")
+        self.assertEqual(to_literal("float", 0.5), "0.5")
+        self.assertEqual(to_literal("float", -2.0), "-2.0")
+        self.assertEqual(to_literal("float", 1e-07), "1e-07")
+        self.assertEqual(to_literal("float", 1e20), "1e+20")
+        self.assertIsNone(to_literal("float", float("nan")))
+        self.assertIsNone(to_literal("float", float("inf")))
+
+    def test_vector(self):
+        self.assertEqual(to_literal("vec3", (1, 0.5, 0)), "vec3(1.0, 0.5, 0.0)")
+        self.assertEqual(to_literal("vec4", [0.25, 0.5, 0.75, 1.0]), "vec4(0.25, 0.5, 0.75, 1.0)")
+        self.assertEqual(to_literal("mat2", [[1, 0], [0, 1]]), "mat2(1.0, 0.0, 0.0, 1.0)")
+        self.assertIsNone(to_literal("vec3", [1.0, 2.0]))
+        self.assertIsNone(to_literal("vec2", 1.0))
+        self.assertIsNone(to_literal("vec2", "1.0, 2.0"))
+
+    def test_int(self):
+        self.assertEqual(to_literal("int", 3), "3")
+        self.assertEqual(to_literal("int", -3.0), "-3")
+        self.assertEqual(to_literal("ivec2", [1, 2.0]), "ivec2(1, 2)")
+        self.assertEqual(to_literal("uint", 4), "4u")
+        self.assertEqual(to_literal("uvec2", [0, 7]), "uvec2(0u, 7u)")
+        self.assertIsNone(to_literal("int", 2.5))
+        self.assertIsNone(to_literal("uint", -1))
+
+    def test_bool(self):
+        self.assertEqual(to_literal("bool", True), "true")
+        self.assertEqual(to_literal("bool", 0), "false")
+        self.assertEqual(to_literal("bvec2", [1, 0]), "bvec2(true, false)")
+        self.assertEqual(to_literal("bvec3", (True, True, False)), "bvec3(true, true, false)")
+
+
+class BakedUniformTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = []
+        for index, source in enumerate((LAYER_SOURCE, SWITCH_SOURCE)):
+            path = os.path.join(directory.name, "layer{}.mesh.glsl".format(index))
+            with open(path, 'w') as f:
+                f.write(source)
+            self.paths.append(path)
+
+    def compile(self, baked, uniform_blocks="NONE", source=0):
+        return "".join(compile_layer_source([LayerSpec(1, self.paths[source], baked=baked)], uniform_blocks))
+
+    def test_const(self):
+        source = self.compile({"strength" : 2, "tint" : [1, 0, 0, 1], "unknown" : 1.0})
+        self.assertIn("const float beergen1_strength = 2.0;", source)
+        self.assertIn("const vec4 beergen1_tint = vec4(1.0, 0.0, 0.0, 1.0);", source)
+        self.assertNotIn("uniform float beergen1_strength", source)
+        self.assertNotIn("uniform vec4 beergen1_tint", source)
+        #The code reading them is renamed as before
+        self.assertIn("PO.color = beergen1_tint * beergen1_strength;", source)
+
+    def test_not_fitting(self):
+        #A value of the wrong size leaves the uniform live
+        source = self.compile({"strength" : 0.25, "tint" : [1.0, 0.0]})
+        self.assertIn("const float beergen1_strength = 0.25;", source)
+        self.assertIn("uniform vec4 beergen1_tint = vec4(0.25, 0.5, 0.75, 1.0);", source)
+
+    def test_int_and_bool(self):
+        source = self.compile({"steps" : 8, "seed" : 3, "enabled" : False, "axes" : [0, 1], "offset" : [2, -1]},
+            source=1)
+        self.assertIn("const int beergen1_steps = 8;", source)
+        self.assertIn("const uint beergen1_seed = 3u;", source)
+        self.assertIn("const bool beergen1_enabled = false;", source)
+        self.assertIn("const bvec2 beergen1_axes = bvec2(false, true);", source)
+        self.assertIn("const ivec2 beergen1_offset = ivec2(2, -1);", source)
+        self.assertNotIn("uniform ", source.split("*/", 1)[1])
+
+    def test_blocks(self):
+        #Baked uniforms are left out of the block, the others are still packed
+        source = self.compile({"strength" : 2.0}, "LAYER")
+        self.assertIn("const float beergen1_strength = 2.0;", source)
+        self.assertIn("layout(std140) uniform BEER_UNIFORMS_beergen1\n{\n    vec4 beergen1_tint;\n};", source)
+        members = get_uniform_layout([LayerSpec(1, self.paths[0], baked={"strength" : 2.0})], "LAYER")
+        self.assertEqual(list(members["BEER_UNIFORMS_beergen1"]["members"]), ["beergen1_tint"])